@@ -0,0 +1,626 @@
+"""
+Qrtmp's asyncio NetConnection which handles the main connection to an RTMP server without a thread per socket.
+
+All of the connection's reading is driven by the event loop, so a single loop can hold many RTMP connections
+at once. The methods which would block in the NetConnection return futures instead, these can be awaited
+from a coroutine or run with loop.run_until_complete().
+
+NOTE: Python 2.7 does not come with asyncio, the trollius backport is used in it's place if it is installed.
+"""
+
+import collections
+import logging
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+import pyamf.util
+
+from qrtmp.base import data_wrapper
+from qrtmp.base.net_connection import NetConnection
+from qrtmp.formats import handshake
+from qrtmp.formats import types
+from qrtmp.io.net_connection import transactions
+
+log = logging.getLogger(__name__)
+
+# The stages of the RTMP handshake the connection can be in.
+HANDSHAKE_WAITING_S0_S1 = 0
+HANDSHAKE_WAITING_S2 = 1
+HANDSHAKE_COMPLETE = 2
+
+
+class TransportFile(object):
+    """
+    A file-object which reads from the data the protocol has received so far and writes into the
+    asyncio transport.
+
+    NOTE: Reading more data than has been received raises an IOError, the position of the file-object can then
+          be set back with seek() to read the same data again once more data has arrived.
+    """
+
+    def __init__(self, transport, loop=None):
+        """
+        Initialise the file-object with the transport to write into.
+
+        :param transport: asyncio transport object.
+        :param loop: the event loop to flush the data written on, once per loop iteration (default None - the data
+                     is written into the transport straight away).
+        """
+        self._transport = transport
+        self._loop = loop
+        self._received = pyamf.util.BufferedByteStream()
+
+        # The data written since the last flush, along with the scheduled flush.
+        self._written = []
+        self._flush_handle = None
+
+    def feed(self, data):
+        """
+        Add the data received from the transport to the end of the file-object.
+
+        :param data: str the data received.
+        """
+        self._received.append(data)
+
+    def remaining(self):
+        """
+        Returns the number of bytes which have been received but not yet read.
+
+        :return: int
+        """
+        return self._received.remaining()
+
+    def compact(self):
+        """ Discards the data which has already been read. """
+        self._received.consume()
+
+    def tell(self):
+        """
+        :return: int the position of the file-object in the received data.
+        """
+        return self._received.tell()
+
+    def seek(self, position):
+        """
+        :param position: int the position in the received data to read from next.
+        """
+        self._received.seek(position)
+
+    def read(self, length):
+        """
+        :param length: int
+        :return: str
+        """
+        return self._received.read(length)
+
+    def readinto(self, buffer):
+        """
+        :param buffer: bytearray or memoryview to fill.
+        :return: int the number of bytes read.
+        """
+        data = self._received.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        """
+        Writes the data into the transport, or with an event loop, keeps it to be written with the rest
+        of the data written in this iteration of the loop.
+
+        :param data: str
+        """
+        if self._loop is None:
+            self._transport.write(data)
+            return
+
+        self._written.append(data)
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_soon(self.flush)
+
+    def flush(self):
+        """ Writes the data which has been kept into the transport in a single write. """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if self._written:
+            written, self._written = self._written, []
+            self._transport.write(b''.join(written))
+
+
+class RtmpProtocol(asyncio.Protocol):
+    """ The asyncio protocol which passes the transport events on to the AsyncNetConnection. """
+
+    def __init__(self, net_connection):
+        """
+        :param net_connection: AsyncNetConnection object.
+        """
+        self._net_connection = net_connection
+
+    def connection_made(self, transport):
+        self._net_connection._connection_made(transport)
+
+    def data_received(self, data):
+        self._net_connection._data_received(data)
+
+    def connection_lost(self, exc):
+        self._net_connection._connection_lost(exc)
+
+    def pause_writing(self):
+        self._net_connection._set_write_paused(True)
+
+    def resume_writing(self):
+        self._net_connection._set_write_paused(False)
+
+
+class AsyncNetConnection(NetConnection):
+    """
+    The asyncio version of the NetConnection, it uses the same RTMP parameters, header handler,
+    RtmpReader and RtmpWriter as the NetConnection.
+
+    :inherits: qrtmp.base.net_connection.NetConnection
+    """
+
+    def __init__(self, loop=None):
+        """
+        Initialise the AsyncNetConnection variables along with the NetConnection variables.
+
+        :param loop: the event loop to run the connection on (default None - the current event loop).
+        """
+        NetConnection.__init__(self)
+
+        self._loop = loop
+
+        self._transport = None
+        self._transport_file = None
+
+        self._handshake_state = None
+
+        # The futures returned to the client which we resolve as the connection changes state.
+        self._connect_future = None
+        self._disconnect_future = None
+
+        # The packets which have been read but not yet returned, along with the futures waiting for a packet.
+        self._received_packets = collections.deque()
+        self._packet_waiters = collections.deque()
+
+        # The transport can ask us to stop writing when it's buffer is full.
+        self._write_paused = False
+        self._drain_waiters = []
+
+        # The call to send the packets left in the output shaper's queue, once the output window allows it.
+        self._send_queued_handle = None
+
+        # The call to send the media messages held in the aggregator, once they have been held for long enough.
+        self._send_aggregate_handle = None
+
+    def _get_loop(self):
+        """
+        :return: the event loop the connection runs on.
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def _new_future(self):
+        """
+        :return: a new future attached to the connection's event loop.
+        """
+        return asyncio.Future(loop=self._get_loop())
+
+    def rtmp_connect(self):
+        """
+        Attempt to make an RTMP connection given the parameters.
+
+        :return: future which is resolved once the handshake is complete and the "connect" message has been sent.
+        """
+        self._connect_future = self._new_future()
+
+        if self._proxy:
+            self._connect_future.set_exception(ValueError('Proxies are not supported by the AsyncNetConnection.'))
+            return self._connect_future
+
+        log.info('Connecting RTMP AsyncNetConnection.')
+        loop = self._get_loop()
+        create_connection = loop.create_task(asyncio.wait_for(
+            loop.create_connection(lambda: RtmpProtocol(self), self._ip, self._port),
+            self.socket_options.connect_timeout, loop=loop))
+        create_connection.add_done_callback(self._create_connection_done)
+
+        return self._connect_future
+
+    def _create_connection_done(self, create_connection):
+        """
+        :param create_connection: the finished task which created the connection.
+        """
+        if create_connection.cancelled():
+            self._connect_future.cancel()
+        elif create_connection.exception() is not None:
+            log.error('The connection could not be made: {0}'.format(create_connection.exception()))
+            if not self._connect_future.done():
+                self._connect_future.set_exception(create_connection.exception())
+
+    def _connection_made(self, transport):
+        """
+        Sets up the RTMP stream on the transport and begins the RTMP handshake by sending C0 and C1.
+
+        :param transport: asyncio transport object.
+        """
+        log.info('Connected transport to IP ({0}) and PORT ({1}).'.format(self._ip, self._port))
+        self._transport = transport
+
+        # The socket options are set once the transport has connected, the read timeout is not used as reads never
+        # block (asyncio.wait_for can be used on read_packet instead).
+        transport_socket = transport.get_extra_info('socket')
+        if transport_socket is not None:
+            self.socket_options.apply(transport_socket)
+
+        self._transport_file = TransportFile(transport, self._get_loop() if self.coalesce_writes else None)
+        self._rtmp_stream = data_wrapper.SocketDataTypeMixInFile(self._transport_file)
+
+        self._client_handshake = handshake.ClientHandshake(self.handshake_type, self.handshake_payload_pool)
+
+        self._rtmp_stream.write_uchar(handshake.RTMP_VERSION)
+        self._client_handshake.create_c1().encode(self._rtmp_stream)
+        self._handshake_state = HANDSHAKE_WAITING_S0_S1
+        log.info('Written C0 and C1 handshake chunks into RTMP stream.')
+
+    def _continue_handshake(self):
+        """ Continues the RTMP handshake with the handshake chunks received so far. """
+        if self._handshake_state == HANDSHAKE_WAITING_S0_S1:
+            if self._transport_file.remaining() < 1 + handshake.HandshakeChunk.handshake_length:
+                return
+
+            handshake.verify_s0(self._rtmp_stream.read_uchar())
+            s1 = handshake.HandshakeChunk()
+            s1.decode(self._rtmp_stream)
+            log.info('Read S0 and S1 handshake chunk reply from server in RTMP stream.')
+
+            self._client_handshake.create_c2(s1).encode(self._rtmp_stream)
+            log.info('Written C2 handshake chunk into RTMP stream.')
+
+            self._handshake_state = HANDSHAKE_WAITING_S2
+
+            # In the pipelined handshake the "connect" message follows C2 straight away, S2 is read when it arrives.
+            if self.pipelined_handshake:
+                self._handshake_complete()
+
+        if self._handshake_state == HANDSHAKE_WAITING_S2:
+            if self._transport_file.remaining() < handshake.HandshakeChunk.handshake_length:
+                return
+
+            s2 = handshake.HandshakeChunk()
+            s2.decode(self._rtmp_stream)
+            self._transport_file.compact()
+            log.info('Read S2 handshake chunk reply from server in RTMP stream.')
+
+            if not self._client_handshake.verify_s2(s2):
+                log.warning('The S2 handshake chunk from the server is not the correct response to C1.')
+            self._client_handshake = None
+
+            self._handshake_state = HANDSHAKE_COMPLETE
+            if not self.pipelined_handshake:
+                self._handshake_complete()
+
+    def _handshake_complete(self):
+        """ Sets up the RTMP I/O once the handshake is complete and sends the RTMP "connect" message. """
+        self._set_rtmp_io()
+        log.info('Set up RTMP I/O (RtmpReader and RtmpWriter).')
+
+        # The packets are always sent through the output shaper's queue, so they can wait in it (rather than the
+        # transport's buffer) while the transport is paused.
+        self._get_output_shaper()
+        self.rtmp_writer.aggregate_held = self._aggregate_held
+
+        # The writer stays corked, the packets written in an iteration of the event loop are sent together
+        # once it is over (see TransportFile) unless the connection is flushed before then.
+        if self.coalesce_writes:
+            self.rtmp_writer.cork()
+
+        self.rtmp_writer.send_packet(self.create_connection_message())
+        log.info('Sent RTMP "connect" message/packet.')
+
+        self.initialise_net_connection_messages()
+
+        self.active_connection = True
+        log.info('RTMP connection is active.')
+
+        if not self._connect_future.done():
+            self._connect_future.set_result(True)
+
+    def _data_received(self, data):
+        """
+        Reads all the complete chunks from the data received so far, any data left over is kept until the
+        rest of the chunk arrives.
+
+        :param data: str the data received from the transport.
+        """
+        self._transport_file.feed(data)
+
+        if self.socket_options.quick_ack:
+            transport_socket = self._transport.get_extra_info('socket')
+            if transport_socket is not None:
+                self.socket_options.set_quick_ack(transport_socket)
+
+        try:
+            if self._handshake_state != HANDSHAKE_COMPLETE:
+                self._continue_handshake()
+                if self._handshake_state != HANDSHAKE_COMPLETE:
+                    return
+
+            while True:
+                chunk_position = self._transport_file.tell()
+                try:
+                    complete_message = self.rtmp_reader.read_chunk()
+                except IOError:
+                    # The rest of the chunk has not arrived yet, read it again once it has.
+                    self._transport_file.seek(chunk_position)
+                    break
+
+                if complete_message is not None:
+                    decoded_header, decoded_body = complete_message
+                    self._packet_received(self.rtmp_reader.generate_packet(decoded_header, decoded_body))
+
+            self._transport_file.compact()
+
+            # Acknowledge the bytes received once a window of them has been received.
+            if self.window_ack_size is not None:
+                self._acknowledge_bytes_received()
+        except Exception as ex:
+            log.error('Closing the connection after failing to read from the RTMP stream: {0}'.format(ex))
+            self._transport.abort()
+            self._fail_waiters(ex)
+
+    def _packet_received(self, received_packet):
+        """
+        Handles default RTMP messages automatically and passes the packet on to the next read_packet() call.
+
+        :param received_packet: RtmpPacket object
+        """
+        if received_packet is None:
+            log.warning('No packet was read from the stream.')
+            return
+
+        if self.split_aggregates and received_packet.header.data_type == types.DT_AGGREGATE_MESSAGE:
+            for aggregated_packet in received_packet.body['messages']:
+                self._packet_received(aggregated_packet)
+            return
+
+        if self._handle_messages:
+            if self.handle_packet(received_packet) is True:
+                received_packet.handled = True
+                if not self._handle_messages_return:
+                    return
+
+        log.info('Received Packet: %r', received_packet)
+        while self._packet_waiters:
+            packet_waiter = self._packet_waiters.popleft()
+            if not packet_waiter.done():
+                packet_waiter.set_result(received_packet)
+                return
+        self._received_packets.append(received_packet)
+
+    def read_packet(self):
+        """
+        Returns the next packet received from the server.
+
+        :return: future which is resolved with the RtmpPacket object (with the header and body).
+        """
+        packet_future = self._new_future()
+
+        if self._received_packets:
+            packet_future.set_result(self._received_packets.popleft())
+        elif self._transport is None:
+            packet_future.set_exception(EOFError('The RTMP connection is not open.'))
+        else:
+            self._packet_waiters.append(packet_future)
+
+        return packet_future
+
+    def _set_write_paused(self, paused):
+        """
+        :param paused: boolean True/False stating if the transport wants us to stop writing.
+        """
+        self._write_paused = paused
+
+        if self.rtmp_writer is not None:
+            self.rtmp_writer.paused = paused
+            if not paused:
+                wait = self.rtmp_writer.send_queued()
+                if wait:
+                    self._output_blocked(wait)
+
+        if not paused:
+            drain_waiters, self._drain_waiters = self._drain_waiters, []
+            for drain_waiter in drain_waiters:
+                if not drain_waiter.done():
+                    drain_waiter.set_result(None)
+
+    def _output_blocked(self, wait):
+        """
+        Sends the packets queued in the output shaper later on, rather than blocking the event loop.
+
+        :param wait: float the number of seconds until the next packet can be sent.
+        """
+        if self._send_queued_handle is None:
+            self._send_queued_handle = self._get_loop().call_later(wait, self._send_queued)
+
+    def _send_queued(self):
+        """ Sends the packets queued in the output shaper which the output window now allows. """
+        self._send_queued_handle = None
+
+        if self._transport is None:
+            return
+
+        wait = self.rtmp_writer.send_queued()
+        if wait:
+            self._output_blocked(wait)
+
+    def _aggregate_held(self, wait):
+        """
+        Sends the media messages held in the aggregator later on, if no other message has sent them by then.
+
+        :param wait: float the number of seconds until they should be sent.
+        """
+        if self._send_aggregate_handle is None:
+            self._send_aggregate_handle = self._get_loop().call_later(wait, self._send_aggregate)
+
+    def _send_aggregate(self):
+        """ Sends the media messages which have been held in the aggregator for long enough. """
+        self._send_aggregate_handle = None
+
+        if self._transport is None:
+            return
+
+        wait = self.rtmp_writer.send_aggregate_due()
+        if wait is not None:
+            self._aggregate_held(wait)
+
+    def drain(self):
+        """
+        :return: future which is resolved once the transport is ready to be written into again.
+        """
+        drain_future = self._new_future()
+
+        if self._write_paused:
+            self._drain_waiters.append(drain_future)
+        else:
+            drain_future.set_result(None)
+
+        return drain_future
+
+    def call(self, procedure_name, parameters=None, transaction_id=None, command_object=None, amf3=False,
+             timeout=None, template_key=None):
+        """
+        Attempts to call a remote procedure call (RPC) on the RTMP server.
+
+        NOTE: Any number of calls can be waiting for their replies at once, each reply is matched to its call
+              by the transaction id.
+
+        :param procedure_name: str
+        :param parameters: list
+        :param transaction_id: int (default None - the next transaction id)
+        :param command_object: list
+        :param amf3: boolean True/False
+        :param timeout: float the number of seconds to wait for the reply (default None - the call_timeout).
+        :param template_key: the key which identifies the command object (see NetConnection.call).
+        :return: future which is resolved with the reply (RtmpPacket) from the server, or if the transaction id
+                 was 0 (no reply is expected), once the transport is ready to be written into again.
+        """
+        transaction = NetConnection.call(self, procedure_name, parameters, transaction_id, command_object, amf3,
+                                         timeout=timeout, template_key=template_key)
+        if transaction is None:
+            return self.drain()
+
+        reply_future = self._new_future()
+        transaction.add_done_callback(lambda done_transaction: self._transaction_done(reply_future, done_transaction))
+        return reply_future
+
+    def _create_transaction(self, transaction_id, procedure_name, timeout):
+        """
+        Creates the transaction for a call, the timeout is enforced by the event loop rather than when reading
+        the next packet.
+
+        :param transaction_id: int
+        :param procedure_name: str
+        :param timeout: float the number of seconds to wait for the reply (None - the call_timeout).
+        :return: L{transactions.Transaction}
+        """
+        transaction = transactions.Transaction(transaction_id, procedure_name)
+        self._transactions.add(transaction)
+
+        if timeout is None:
+            timeout = self.call_timeout
+
+        if timeout is not None:
+            timeout_handle = self._get_loop().call_later(timeout, self._transaction_timeout, transaction)
+            transaction.add_done_callback(lambda _: timeout_handle.cancel())
+
+        return transaction
+
+    @staticmethod
+    def _transaction_done(reply_future, transaction):
+        """
+        :param reply_future: the future returned by call().
+        :param transaction: the transaction which is done.
+        """
+        if reply_future.done():
+            return
+
+        if transaction.exception() is not None:
+            reply_future.set_exception(transaction.exception())
+        else:
+            reply_future.set_result(transaction.result())
+
+    def _transaction_timeout(self, transaction):
+        """
+        :param transaction: the transaction which did not get a reply in time.
+        """
+        self._transactions.cancel(transaction.transaction_id, transactions.TransactionTimeout(
+            'No reply to %s (transaction %s) was received in time.' %
+            (transaction.procedure_name, transaction.transaction_id)))
+
+    def disconnect(self):
+        """
+        Closes the transport and stops the RTMP connection.
+
+        :return: future which is resolved once the transport has been closed.
+        """
+        log.info('Disconnecting AsyncNetConnection.')
+        self.active_connection = False
+
+        if self._transport is None:
+            disconnect_future = self._new_future()
+            disconnect_future.set_result(None)
+            return disconnect_future
+
+        if self._disconnect_future is None:
+            self._disconnect_future = self._new_future()
+            self._transport.close()
+
+        return self._disconnect_future
+
+    def _fail_waiters(self, exception):
+        """
+        Fails every future which is still waiting on the connection.
+
+        :param exception: the exception to pass on to the futures.
+        """
+        waiters = list(self._packet_waiters) + self._drain_waiters
+        if self._connect_future is not None:
+            waiters.append(self._connect_future)
+
+        self._packet_waiters.clear()
+        self._drain_waiters = []
+
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(exception)
+
+    def _connection_lost(self, exc):
+        """
+        :param exc: the exception the transport was closed with, or None if it was closed normally.
+        """
+        log.info('Transport has been closed: {0}'.format(exc))
+        self.active_connection = False
+        self._transport = None
+
+        if self._send_queued_handle is not None:
+            self._send_queued_handle.cancel()
+            self._send_queued_handle = None
+        if self._send_aggregate_handle is not None:
+            self._send_aggregate_handle.cancel()
+            self._send_aggregate_handle = None
+
+        # The server rejected the handshake if it closed the connection before the handshake was complete.
+        if self._handshake_state != HANDSHAKE_COMPLETE:
+            exc = handshake.HandshakeError('The server closed the connection during the handshake: %s' % exc)
+
+        self._fail_waiters(exc or EOFError('The RTMP connection has been closed.'))
+        self._transactions.fail_all(exc or EOFError('The RTMP connection has been closed.'))
+
+        if self._disconnect_future is not None and not self._disconnect_future.done():
+            self._disconnect_future.set_result(None)
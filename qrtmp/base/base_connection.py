@@ -5,17 +5,21 @@
 
 import logging
 import socket
+import struct
 
 from qrtmp.base import data_wrapper
+from qrtmp.base import socket_options
 from qrtmp.formats import handshake
 from qrtmp.formats import rtmp_header
 from qrtmp.io import rtmp_reader
 from qrtmp.io import rtmp_writer
-from qrtmp.util import miscellaneous
 from qrtmp.util import socks
 
 log = logging.getLogger(__name__)
 
+# The number of bytes the server sends in the handshake: S0 (the version), S1 and S2.
+_SERVER_HANDSHAKE_SIZE = 1 + 2 * handshake.HandshakeChunk.handshake_length
+
 
 class BaseConnection:
     """ The base connection class to handle the underlying socket connection to an RTMP server. """
@@ -27,13 +31,43 @@ class BaseConnection:
         self._socket_module = socket
 
         self._socket_object = None
+        self._socket_reader = None
         self._socket_file = None
 
         self._rtmp_stream = None
 
+        self._rtmp_header_handler = None
         self.rtmp_reader = None
         self.rtmp_writer = None
 
+        # Send each message in a single write (sendmsg where it is available) rather than a write per chunk.
+        self.scatter_gather_writes = False
+
+        # The media aggregator (see aggregator.MediaAggregator) the audio and video messages we send are packed into
+        # aggregate messages with, each message is sent on its own by default.
+        self.media_aggregator = None
+
+        # The pool of precomputed C1 handshake payloads to use (see handshake.PayloadPool),
+        # by default a new payload is created for every handshake.
+        self.handshake_payload_pool = None
+
+        # In the pipelined handshake the "connect" message is sent straight after C2 instead of waiting for S2,
+        # S2 is read (and checked) before the first packet is read.
+        self.pipelined_handshake = False
+
+        # The client side of the handshake, while S2 is still to be read in the pipelined handshake.
+        self._client_handshake = None
+
+        # The type of handshake to make with the server, handshake.HANDSHAKE_SIMPLE or handshake.HANDSHAKE_DIGEST
+        # (for servers which require the HMAC-SHA256 digest handshake).
+        self.handshake_type = handshake.HANDSHAKE_SIMPLE
+
+        # The trace callback given to the RTMP reader, writer and header handler (see set_trace).
+        self.trace = None
+
+        # DONE: Ported set_socket_options - the options the socket is set up with (see set_socket_options).
+        self.socket_options = socket_options.SocketOptions()
+
         self._proxy = None
 
         self._ip = None
@@ -54,46 +88,103 @@ class BaseConnection:
 
         log.info('Set base parameters: %s, %s, %s' % (self._ip, self._port, self._proxy))
 
+    def set_socket_options(self, options=None, **kwargs):
+        """
+        Sets the options (TCP tuning) to make the connection with, e.g.:
+            set_socket_options('low_latency')
+            set_socket_options(receive_buffer_size=1048576, read_timeout=30)
+
+        NOTE: The options are used the next time the connection is made.
+
+        :param options: L{socket_options.SocketOptions} object or the name of a preset (PRESET_LOW_LATENCY or
+                        PRESET_HIGH_THROUGHPUT) (default None - the options already set).
+        :param kwargs: the options to change (the parameters of SocketOptions).
+        """
+        if isinstance(options, basestring):
+            options = socket_options.SocketOptions.from_preset(options)
+
+        if options is not None:
+            self.socket_options = options
+
+        for option_name, value in kwargs.items():
+            if not hasattr(self.socket_options, option_name):
+                raise TypeError('Unknown socket option: %r' % option_name)
+            setattr(self.socket_options, option_name, value)
+
+        log.info('Set socket options: %r', self.socket_options)
+
     def _rtmp_handshake(self):
         """
         To begin an RTMP connection we must first request a handshake
         between the client and server.
         """
-        log.info('Beginning Rtmp Handshake with server.')
+        log.info('Beginning Rtmp Handshake with server (%s handshake).' % self.handshake_type)
 
-        # Initialise the handshake chunks we will use.
-        c1 = handshake.HandshakeChunk()
-        s1 = handshake.HandshakeChunk()
-        c2 = handshake.HandshakeChunk()
-        s2 = handshake.HandshakeChunk()
-        log.info('Set up C1, S1, C2, S2 handshake chunk (packets).')
-
-        # Handle sending the C1 chunk to the server.
-        self._rtmp_stream.write_uchar(3)
-        c1.first = 0
-        c1.second = 0
-        c1.payload = miscellaneous.create_random_bytes(1528)
-        c1.encode(self._rtmp_stream)
+        # Initialise the client side of the handshake we will use.
+        client_handshake = handshake.ClientHandshake(self.handshake_type, self.handshake_payload_pool)
+
+        # Handle sending the C0 and C1 chunk to the server.
+        self._rtmp_stream.write_uchar(handshake.RTMP_VERSION)
+        client_handshake.create_c1().encode(self._rtmp_stream)
         self._rtmp_stream.flush()
         log.info('Written C1 handshake chunk into RTMP stream.')
 
-        # Handle reading the S1 chunk we receive from the server.
-        self._rtmp_stream.read_uchar()
+        # Handle reading the S0 and S1 chunk we receive from the server.
+        handshake.verify_s0(self._rtmp_stream.read_uchar())
+        s1 = handshake.HandshakeChunk()
         s1.decode(self._rtmp_stream)
         log.info('Read S1 handshake chunk reply from server in RTMP stream.')
 
         # Handle sending the C2 chunk to the server.
-        c2.first = s1.first
-        c2.second = c2.second
-        c2.payload = s1.payload
-        c2.encode(self._rtmp_stream)
+        client_handshake.create_c2(s1).encode(self._rtmp_stream)
         self._rtmp_stream.flush()
         log.info('Written C2 handshake chunk into RTMP stream.')
 
+        # In the pipelined handshake we can carry on without waiting for S2, it is read before the first packet.
+        if self.pipelined_handshake:
+            self._client_handshake = client_handshake
+            log.info('Pipelined handshake, S2 will be read before the first packet.')
+            return
+
         # Handle reading the S2 chunk received from the server.
-        s2.decode(self._rtmp_stream)
+        self._read_s2(client_handshake)
+
+    def _read_s2(self, client_handshake):
+        """
+        Reads the S2 handshake chunk from the server and checks it is the correct response to C1.
+
+        :param client_handshake: L{handshake.ClientHandshake} the client side of the handshake.
+        """
+        s2 = handshake.HandshakeChunk()
+        try:
+            s2.decode(self._rtmp_stream)
+        except (EOFError, IOError, struct.error) as ex:
+            raise handshake.HandshakeError('The server closed the connection instead of sending S2: %s' % ex)
         log.info('Read S2 handshake chunk reply from server in RTMP stream.')
 
+        if not client_handshake.verify_s2(s2):
+            log.warning('The S2 handshake chunk from the server is not the correct response to C1.')
+
+    def get_bytes_received(self):
+        """
+        Returns the number of bytes received from the server so far, including the handshake.
+
+        NOTE: The bytes are counted as the RtmpReader reads each chunk (see RtmpReader.bytes_read), rather than as
+              they are received on the socket (which reads ahead), so an acknowledgement never covers data which
+              has not been read yet.
+
+        :return: int
+        """
+        if self.rtmp_reader is None:
+            return 0
+        return _SERVER_HANDSHAKE_SIZE + self.rtmp_reader.bytes_read
+
+    def _complete_handshake(self):
+        """ Reads S2 if it is still to be read after a pipelined handshake. """
+        if self._client_handshake is not None:
+            client_handshake, self._client_handshake = self._client_handshake, None
+            self._read_s2(client_handshake)
+
     def _rtmp_base_connect(self):
         """
 
@@ -119,14 +210,24 @@ class BaseConnection:
                 self._socket_object = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 log.info('Created socket object for SOCK_STREAM.')
 
+            self.socket_options.apply(self._socket_object)
+            if self.socket_options.connect_timeout is not None:
+                self._socket_object.settimeout(self.socket_options.connect_timeout)
+
             # TODO: No connect attribute.
             # Connect the socket object to the IP and port provided.
             self._socket_object.connect((self._ip, self._port))
             log.info('Connected socket object to IP ({0}) and PORT ({1}).'.format(self._ip, self._port))
 
+            # The connect timeout is replaced by the read timeout (or no timeout at all).
+            self._socket_object.settimeout(self.socket_options.read_timeout)
+
             # TODO: MAJOR - Data in a file or buffer like store (we will have to explore PyAMF)?
             # Make a socket file to store the data which we will receive from the socket.
-            self._socket_file = self._socket_object.makefile()
+            # The raw reader flushes the replies before waiting for data (see _flush_before_read).
+            self._socket_reader = data_wrapper.SocketRawIO(self._socket_object)
+            self._socket_reader.socket_options = self.socket_options
+            self._socket_file = data_wrapper.make_socket_file(self._socket_object, self._socket_reader)
             self._rtmp_stream = data_wrapper.SocketDataTypeMixInFile(self._socket_file)
             log.info('Created socket fileobject and RTMP stream SocketDataTypeMixInFile.')
 
@@ -141,7 +242,7 @@ class BaseConnection:
 
             return True
         except Exception as ex:
-            print(ex)
+            log.error('Failed to connect RTMP BaseConnection: %s', ex)
             return False
 
     # TODO: _rtmp_stream is None when setting up the reader and writer.
@@ -156,4 +257,46 @@ class BaseConnection:
         self._rtmp_header_handler = rtmp_header.RtmpHeaderHandler(self._rtmp_stream)
 
         self.rtmp_reader = rtmp_reader.RtmpReader(self._rtmp_stream, self._rtmp_header_handler)
-        self.rtmp_writer = rtmp_writer.RtmpWriter(self._rtmp_stream, self._rtmp_header_handler)
+        self.rtmp_writer = rtmp_writer.RtmpWriter(self._rtmp_stream, self._rtmp_header_handler, self._socket_object)
+        self.rtmp_writer.scatter_gather = self.scatter_gather_writes
+        self.rtmp_writer.aggregator = self.media_aggregator
+
+        # The packets written while the writer is corked are flushed before we wait to receive more data.
+        if self._socket_reader is not None:
+            self._socket_reader.before_read = self._flush_before_read
+            self._socket_reader.on_idle = self._on_idle
+
+        self.set_trace(self.trace)
+
+    def _flush_before_read(self):
+        """ Flushes the packets which have been written (while the RtmpWriter is corked) but not yet sent. """
+        if self.rtmp_writer is not None and self.rtmp_writer.pending:
+            self.rtmp_writer.stream_flush()
+
+    def _on_idle(self):
+        """
+        Called before waiting to receive more data from the server (see data_wrapper.SocketRawIO.on_idle).
+
+        :return: float the seconds to wait for the data before this is called again, or None to wait without
+                 calling it again.
+        """
+        return None
+
+    def set_trace(self, trace):
+        """
+        Sets the trace callback which is given the chunks, headers and messages read from and written into
+        the RTMP stream, e.g. trace(types.TRACE_CHUNK_READ, {'chunk_stream_id': 3, ...}).
+
+        NOTE: When the trace callback is None (the default) nothing is traced, so tracing costs nothing
+              until it is needed. miscellaneous.create_log_trace creates a trace callback which logs the events.
+
+        :param trace: callable trace(event, details) or None to stop tracing.
+        """
+        self.trace = trace
+
+        if self._rtmp_header_handler is not None:
+            self._rtmp_header_handler.trace = trace
+        if self.rtmp_reader is not None:
+            self.rtmp_reader.trace = trace
+        if self.rtmp_writer is not None:
+            self.rtmp_writer.trace = trace
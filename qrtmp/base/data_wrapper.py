@@ -1,3 +1,6 @@
+import io
+import select
+
 import pyamf
 import pyamf.util.pure
 
@@ -25,6 +28,20 @@ class SocketDataTypeMixInFile(pyamf.util.pure.DataTypeMixIn):
         """
         return self.fileobject.read(length)
 
+    def readinto(self, buffer):
+        """
+        Reads data from the file-object directly into the buffer given.
+
+        :param buffer: bytearray or memoryview to fill.
+        :return: int the number of bytes read.
+        """
+        if hasattr(self.fileobject, 'readinto'):
+            return self.fileobject.readinto(buffer)
+
+        data = self.fileobject.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
     def write(self, data):
         """
 
@@ -49,6 +66,97 @@ class SocketDataTypeMixInFile(pyamf.util.pure.DataTypeMixIn):
         return False
 
 
+class SocketRawIO(io.RawIOBase):
+    """
+    A raw I/O object for a connected socket, this allows the data we receive to be read straight into a buffer
+    (socket.makefile() does not provide readinto in Python 2.7).
+    """
+
+    def __init__(self, socket_object):
+        """
+
+        :param socket_object: the connected socket object.
+        """
+        io.RawIOBase.__init__(self)
+        self._socket_object = socket_object
+
+        # Called before waiting to receive more data on the socket, e.g. to flush the replies which have been
+        # written while the data received so far was read.
+        self.before_read = None
+
+        # The socket options (see socket_options.SocketOptions), TCP_QUICKACK is set before each receive with them.
+        self.socket_options = None
+
+        # Called as on_idle() before waiting to receive more data on the socket, it returns the number of seconds
+        # to wait for the data before it is called again (None - wait for the data without calling it again).
+        # This lets work be done while the reader is blocked, e.g. sending the packets waiting in the output shaper.
+        self.on_idle = None
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def readinto(self, buffer):
+        """
+
+        :param buffer: bytearray or memoryview to fill.
+        :return: int the number of bytes received.
+        """
+        while True:
+            timeout = None
+            if self.on_idle is not None:
+                timeout = self.on_idle()
+
+            if self.before_read is not None:
+                self.before_read()
+
+            if timeout is None or self._wait_readable(timeout):
+                break
+
+        if self.socket_options is not None and self.socket_options.quick_ack:
+            self.socket_options.set_quick_ack(self._socket_object)
+
+        return self._socket_object.recv_into(buffer)
+
+    def _wait_readable(self, timeout):
+        """
+        :param timeout: float the most seconds to wait for data to be received.
+        :return: bool True if there is data to receive on the socket, False if the time ran out.
+        """
+        return bool(select.select([self._socket_object], [], [], max(timeout, 0.0))[0])
+
+    def can_write(self):
+        """
+        :return: bool True if data can be sent on the socket without waiting for its send buffer to empty.
+        """
+        return bool(select.select([], [self._socket_object], [], 0.0)[1])
+
+    def write(self, data):
+        """
+
+        :param data:
+        :return: int the number of bytes written.
+        """
+        self._socket_object.sendall(data)
+        return len(data)
+
+
+def make_socket_file(socket_object, raw_reader=None):
+    """
+    Returns a buffered file-object to read and write data on the socket with.
+
+    :param socket_object: the connected socket object.
+    :param raw_reader: SocketRawIO object to read the socket with, e.g. to count the bytes received
+                       (default None - a new SocketRawIO object).
+    :return: io.BufferedRWPair object
+    """
+    if raw_reader is None:
+        raw_reader = SocketRawIO(socket_object)
+    return io.BufferedRWPair(raw_reader, SocketRawIO(socket_object))
+
+
 # TODO: If the socket is a file object and FileDataTypeMixIn inherited read/write, we can just alter
 #       that to read data.
 # TODO: Move this to it's own file, we will be retrieving data from this.
@@ -6,10 +6,14 @@ Version 0.3.5
 
 import logging
 import struct
+import time
 
 from qrtmp.base.base_connection import BaseConnection
+from qrtmp.formats import amf_codec
 from qrtmp.formats import types
+from qrtmp.io import shaper
 from qrtmp.io.net_connection import messages
+from qrtmp.io.net_connection import transactions
 
 log = logging.getLogger(__name__)
 
@@ -64,17 +68,66 @@ class NetConnection(BaseConnection):
         self.mac_flash_version = 'MAC 24,0,0,186'
         self.linux_flash_version = 'LNX 11,2,202,635'
 
-        # TODO: Find more about shared objects.
-        # self._shared_objects = []
+        # DONE: Find more about shared objects - the shared objects in use, by their name (see shared_object_use).
+        self._shared_objects = {}
 
-        # TODO: Should transaction id be in RtmpWriter?
-        # Setup a transaction id in order to communicate RTMP messages between
-        # the client and server.
-        # self._transaction_id = None
+        # DONE: Should transaction id be in RtmpWriter? - The RtmpWriter gives out the transaction ids and
+        #       the calls waiting for a reply are kept in the transaction table.
+        self._transactions = transactions.TransactionTable()
+
+        # The number of seconds to wait for the reply to a call (None to wait forever).
+        self.call_timeout = 30.0
 
         # Initialise the NetConnection messages variable.
         self.messages = None
 
+        # DONE: Count the bytes received and acknowledge them - the window acknowledgement size is the number of
+        #       bytes the server sends between our acknowledgements, as set by the server's WINDOW_ACK_SIZE message
+        #       (None until the server sets it, nothing is acknowledged until then).
+        self.window_ack_size = None
+        self._acknowledged_bytes = 0
+
+        # The output window (bandwidth) and its limit type set by the server's SET_PEER_BANDWIDTH messages, along
+        # with the window acknowledgement size we last sent the server.
+        self.peer_bandwidth = None
+        self.peer_bandwidth_limit_type = None
+        self._sent_window_ack_size = None
+
+        # Shape the packets we send to the output window set by the server, the packets are queued and sent in
+        # priority order (control and command messages, then audio, then video). This is off by default, the output
+        # window is usually large enough (e.g. 2.5MB) that it does not need to be kept to.
+        # NOTE: There are two limitations to this:
+        #       - The output window is the number of bytes we may send before the server acknowledges them, not a
+        #         rate. It is shaped as a rate of the output window over output_window_duration seconds, which
+        #         only approximates it (the acknowledgements the server sends are not taken into account), so
+        #         output_window_duration may need to be tuned to the time the server takes to acknowledge the data.
+        #       - The packets left waiting in the queue are only sent by the next call to send or read a packet
+        #         (read_packet sends them while it waits for data). A client which only publishes (and does not
+        #         read) has to keep sending packets or call send_queued, otherwise the queue stalls.
+        self.shape_output = False
+
+        # The output window is the number of bytes the server lets us send before it acknowledges them, the rate
+        # the packets are shaped to is the output window over this number of seconds (about the time it takes
+        # the server to acknowledge the data, so one second is a cautious default).
+        self.output_window_duration = 1.0
+
+        # Return the messages inside aggregate messages one by one, rather than the aggregate message itself.
+        self.split_aggregates = True
+
+        # The messages still to be returned from the aggregate message which is being split.
+        self._aggregate_messages = None
+
+        # Send the replies to the messages read in one go (see RtmpWriter.cork) rather than one write each.
+        self.coalesce_writes = True
+
+        # The most bytes to keep queued to send before video frames are dropped (None - nothing is dropped).
+        # Once this is set the packets are always sent through the send queue, they wait in it (rather than
+        # blocking the sender) while the socket can not be written into.
+        self.send_queue_size = None
+
+        # The handlers of the default RTMP messages, keyed by (data type, User Control event type or None).
+        self._packet_handlers = self._get_default_handlers()
+
         # Initialise working states for the functions in this class.
         self._handle_messages = True
         self._handle_messages_return = False
@@ -269,25 +322,31 @@ class NetConnection(BaseConnection):
         log.info('Generated connection message header: {0}'.format(connection_message.header))
 
         # Create the connection message body.
+        command_object = [
+            {
+                'app': self._app,
+                'flashVer': self.flash_ver,
+                'swfUrl': self._swf_url,
+                'tcUrl': self._tc_url,
+                'fpad': self._fpad,
+                'capabilities': self.capabilities,
+                'audioCodecs': self.audio_codecs,
+                'videoCodecs': self.video_codecs,
+                'videoFunction': self.video_function,
+                'pageUrl': self._page_url,
+                'objectEncoding': self.object_encoding
+            }
+        ]
         connection_message.body = {
             'command_name': 'connect',
-            'transaction_id': self.rtmp_writer.transaction_id + 1,
-            'command_object': [
-                {
-                    'app': self._app,
-                    'flashVer': self.flash_ver,
-                    'swfUrl': self._swf_url,
-                    'tcUrl': self._tc_url,
-                    'fpad': self._fpad,
-                    'capabilities': self.capabilities,
-                    'audioCodecs': self.audio_codecs,
-                    'videoCodecs': self.video_codecs,
-                    'videoFunction': self.video_function,
-                    'pageUrl': self._page_url,
-                    'objectEncoding': self.object_encoding
-                }
-            ],
-            'options': []
+            'transaction_id': self.rtmp_writer.next_transaction_id(),
+            'command_object': command_object,
+            'options': [],
+            # The command object is the same for every connection made with these parameters (the key of its
+            # template), so it is only encoded once.
+            'template': amf_codec.get_command_template('connect', command_object, (
+                self._app, self.flash_ver, self._swf_url, self._tc_url, self._fpad, self.capabilities,
+                self.audio_codecs, self.video_codecs, self.video_function, self._page_url, self.object_encoding))
         }
         log.info('Generated connection message body: {0}'.format(connection_message.body))
 
@@ -376,110 +435,364 @@ class NetConnection(BaseConnection):
         """
         Abstracts the process of decoding the data and then generating an RtmpPacket using the decoded header and body.
 
+        NOTE: Packets which are handled (and not returned) are skipped in a loop, so a long run of control messages
+              (e.g. pings or acknowledgements) does not grow the stack. With coalesce_writes, the replies to them
+              are sent together, just before waiting for more data or once the packet is returned.
+
+        :return received_packet: RtmpPacket object (with the header and body).
+        """
+        # In the pipelined handshake S2 is still to be read before the first packet.
+        if self._client_handshake is not None:
+            self._complete_handshake()
+
+        # Send the packets which are still waiting in the output shaper's queue.
+        if self.rtmp_writer.shaper is not None and len(self.rtmp_writer.shaper) > 0:
+            self.rtmp_writer.send_queued()
+
+        if not self.coalesce_writes:
+            return self._read_packet()
+
+        self.rtmp_writer.cork()
+        try:
+            return self._read_packet()
+        finally:
+            self.rtmp_writer.uncork()
+
+    def _read_packet(self):
+        """
+        Reads packets until there is one to return to the client.
+
         :return received_packet: RtmpPacket object (with the header and body).
         """
-        # TODO: Should _rtmp_stream be accessed directly?
-        if not self._rtmp_stream.at_eof():
-            # Get the decoded header and body from the RTMP stream.
-            decoded_header, decoded_body = self.rtmp_reader.decode_rtmp_stream()
-            # Generate an RtmpPacket with the header and body.
-            received_packet = self.rtmp_reader.generate_packet(decoded_header, decoded_body)
-
-            if received_packet is not None:
-                # Handle default RTMP messages automatically.
-                if self._handle_messages:
-                    handled_state = self.handle_packet(received_packet)
-                    # If the message is handled we can set it's handled attribute.
-                    if handled_state is True:
-                        received_packet.handled = True
-                        # If the client doesn't want to receive the handled packet,
-                        # we can read the next packet.
-                        if not self._handle_messages_return:
-                            return self.read_packet()
-
-                log.info('Received Packet: {0}'.format(received_packet))
-                return received_packet
+        # DONE: Read the next packet in a loop rather than calling read_packet again for every handled packet.
+        while True:
+            # The messages left in an aggregate message are returned before reading from the stream again.
+            if self._aggregate_messages is not None:
+                received_packet = next(self._aggregate_messages, None)
+                if received_packet is None:
+                    self._aggregate_messages = None
+                    continue
             else:
-                log.warning('No packet was read from the stream.')
-                print('No packet was read from stream.')
+                # Fail the calls which have not been replied to in time, this is also done while waiting for data
+                # from the server (see _on_idle).
+                if len(self._transactions) > 0:
+                    self._transactions.expire()
+
+                # TODO: Should _rtmp_stream be accessed directly?
+                if self._rtmp_stream.at_eof():
+                    raise StopIteration
+
+                # Get the decoded header and body from the RTMP stream.
+                decoded_header, decoded_body = self.rtmp_reader.decode_rtmp_stream()
+                # Generate an RtmpPacket with the header and body.
+                received_packet = self.rtmp_reader.generate_packet(decoded_header, decoded_body)
+
+                # Acknowledge the bytes received once a window of them has been received.
+                if self.window_ack_size is not None:
+                    self._acknowledge_bytes_received()
+
+                if received_packet is None:
+                    log.warning('No packet was read from the stream.')
+                    return None
+
+                if self.split_aggregates and received_packet.header.data_type == types.DT_AGGREGATE_MESSAGE:
+                    self._aggregate_messages = iter(received_packet.body['messages'])
+                    continue
+
+            # Handle default RTMP messages automatically.
+            if self._handle_messages and self.handle_packet(received_packet) is True:
+                # If the message is handled we can set it's handled attribute.
+                received_packet.handled = True
+                # If the client doesn't want to receive the handled packet, we can read the next packet.
+                if not self._handle_messages_return:
+                    continue
+
+            log.info('Received Packet: %r', received_packet)
+            return received_packet
+
+    def _acknowledge_bytes_received(self):
+        """
+        Sends the server an ACKNOWLEDGEMENT with the number of bytes received so far, if at least a window
+        (window_ack_size) of bytes have been received since the last acknowledgement.
+        """
+        bytes_received = self.get_bytes_received()
+
+        if bytes_received - self._acknowledged_bytes >= self.window_ack_size:
+            self.messages.send_acknowledgement(bytes_received)
+            self._acknowledged_bytes = bytes_received
+            log.debug('Acknowledged %s byte(s) received.', bytes_received)
+
+    def _set_output_bandwidth(self, bandwidth):
+        """
+        Sets the bandwidth the RtmpWriter's output shaper sends within, the shaper is created the first time.
+
+        :param bandwidth: float the number of bytes per second to send (see output_window_duration).
+        """
+        self._get_output_shaper().set_bandwidth(bandwidth)
+        log.debug('Set the output bandwidth to %s byte(s) per second.', bandwidth)
+
+    def _get_output_shaper(self):
+        """
+        Returns the RtmpWriter's output shaper, creating it (bounded by the send_queue_size) the first time.
+
+        NOTE: The packets are only sent from the shaper's queue while the socket can be written into, so a slow
+              socket fills the queue (and video frames are dropped) rather than blocking the sender. A packet
+              which is larger than the space left in the socket's send buffer may still block while it is sent.
+
+        :return: L{shaper.OutputShaper}
+        """
+        if self.rtmp_writer.shaper is None:
+            self.rtmp_writer.shaper = shaper.OutputShaper(max_queue_size=self.send_queue_size)
+            self.rtmp_writer.queue_blocked = self._output_blocked
+            if self._socket_reader is not None:
+                self.rtmp_writer.can_write = self._socket_reader.can_write
+        return self.rtmp_writer.shaper
+
+    def _set_rtmp_io(self):
+        """
+        Sets up the RtmpReader and RtmpWriter (see BaseConnection._set_rtmp_io), along with the send queue
+        if it is bounded (see send_queue_size).
+        """
+        BaseConnection._set_rtmp_io(self)
+
+        if self.send_queue_size is not None:
+            self._get_output_shaper()
+
+    def flush(self):
+        """
+        Sends the packets which have been written but not yet sent straight away, e.g. while the replies to the
+        messages being read are being sent together (see coalesce_writes).
+        """
+        if self.rtmp_writer is not None:
+            self.rtmp_writer.flush()
+
+    def send_queued(self):
+        """
+        Sends the packets waiting in the send queue which can be sent now, e.g. for a client which only publishes
+        (read_packet sends them while it waits for data).
+
+        :return: float the number of seconds until more of them can be sent, 0.0 if there are none left waiting.
+        """
+        if self.rtmp_writer is None or self.rtmp_writer.shaper is None:
+            return 0.0
+        return self.rtmp_writer.send_queued()
+
+    def get_send_queue_metrics(self):
+        """
+        Returns the length and size of the queue of packets to send, along with the number of video frames
+        (and bytes) which have been dropped from it.
+
+        :return: dict of the metrics, or None if the packets are not being queued.
+        """
+        if self.rtmp_writer is None or self.rtmp_writer.shaper is None:
+            return None
+        return self.rtmp_writer.shaper.get_metrics()
+
+    def _output_blocked(self, wait):
+        """
+        Called when packets are left in the output shaper's queue, the NetConnection does not wait for them to be
+        sent (sleeping would hold up reading from the server and replying to acknowledgements and pings).
+
+        NOTE: The packets left in the queue are sent by the next calls to send a packet or read a packet,
+              read_packet sends them while it is waiting for data from the server (see _on_idle).
+
+        :param wait: float the number of seconds until the next packet can be sent.
+        """
+        log.debug('%s packet(s) are waiting in the send queue, the next can be sent in %.3f second(s).',
+                  len(self.rtmp_writer.shaper), wait)
+
+    def _on_idle(self):
+        """
+        Fails the calls which have not been replied to in time, sends the media messages which have been held in the
+        aggregator for long enough and sends the packets waiting in the output shaper's queue, while read_packet
+        waits for data from the server.
+
+        :return: float the seconds until the next call times out or the next packet can be sent,
+                 or None if there is nothing to wait for.
+        """
+        waits = []
+
+        if self.rtmp_writer is not None and self.rtmp_writer.aggregator is not None:
+            wait = self.rtmp_writer.send_aggregate_due()
+            if wait is not None:
+                waits.append(wait)
+
+        if len(self._transactions) > 0:
+            now = time.time()
+            self._transactions.expire(now)
+
+            deadline = self._transactions.next_deadline()
+            if deadline is not None:
+                waits.append(deadline - now)
+
+        if self.rtmp_writer is not None and self.rtmp_writer.shaper is not None and len(self.rtmp_writer.shaper) > 0:
+            wait = self.rtmp_writer.send_queued()
+            if wait:
+                waits.append(wait)
+
+        if not waits:
+            return None
+        return min(waits)
+
+    def register_handler(self, data_type, handler, event_type=None):
+        """
+        Registers a handler for a type of RTMP message, replacing the default handler (if there is one).
+        A handler is called as handler(received_packet) and returns True if it has handled the packet.
+
+        NOTE: User Control messages are handled by their event type, so the event type must be given along with
+              the DT_USER_CONTROL data type.
+
+        :param data_type: int the data type (DT_*) of the messages to handle.
+        :param handler: callable handler(received_packet) or None to remove the handler.
+        :param event_type: int the User Control event type (UC_*) to handle (default None - not a User Control message).
+        """
+        if handler is None:
+            self._packet_handlers.pop((data_type, event_type), None)
         else:
-            raise StopIteration
+            self._packet_handlers[(data_type, event_type)] = handler
+
+    def _get_default_handlers(self):
+        """
+        :return: dict of the default packet handlers, keyed by (data type, User Control event type or None).
+        """
+        return {
+            (types.DT_USER_CONTROL, types.UC_STREAM_BEGIN): self._handle_stream_begin,
+            (types.DT_USER_CONTROL, types.UC_PING_REQUEST): self._handle_ping_request,
+            (types.DT_USER_CONTROL, types.UC_PING_RESPONSE): self._handle_ping_response,
+            (types.DT_WINDOW_ACKNOWLEDGEMENT_SIZE, None): self._handle_window_ack_size,
+            (types.DT_SET_PEER_BANDWIDTH, None): self._handle_set_peer_bandwidth,
+            (types.DT_SET_CHUNK_SIZE, None): self._handle_set_chunk_size,
+            (types.DT_ABORT, None): self._handle_abort,
+            (types.DT_COMMAND, None): self._handle_command,
+            (types.DT_AMF3_COMMAND, None): self._handle_command,
+            (types.DT_SHARED_OBJECT, None): self._handle_shared_object,
+            (types.DT_AMF3_SHARED_OBJECT, None): self._handle_shared_object
+        }
 
     # TODO: Raise warning if we receive a SET_CHUNK_SIZE and handle_packet has
     #       not been enabled?
     # TODO: Connect handle_packet with io.net_connection.commands
     def handle_packet(self, received_packet):
         """
-        Handles default RTMP packets based on their data-type.
+        Handles default RTMP packets based on their data-type (and event type for User Control messages),
+        using the handler registered for them.
 
         :param received_packet:
         :return True/False: boolean depending on if the packet was handled correctly.
         """
-        log.info('Handling received packet: {0}'.format(received_packet))
+        data_type = received_packet.header.data_type
+        if data_type == types.DT_USER_CONTROL:
+            handler = self._packet_handlers.get((data_type, received_packet.body['event_type']))
+        else:
+            handler = self._packet_handlers.get((data_type, None))
 
-        if received_packet.header.data_type == types.DT_USER_CONTROL and received_packet.body['event_type'] == \
-                types.UC_STREAM_BEGIN:
+        if handler is None:
+            return False
 
-            log.info('Handled STREAM_BEGIN packet: %s' % received_packet.body)
-            return True
+        return handler(received_packet) is True
 
-        elif received_packet.header.data_type == types.DT_WINDOW_ACKNOWLEDGEMENT_SIZE:
-            assert received_packet.body['window_acknowledgement_size'] == 2500000, received_packet.body
+    @staticmethod
+    def _handle_stream_begin(received_packet):
+        log.info('Handled STREAM_BEGIN packet: %r', received_packet.body)
+        return True
 
-            self.messages.send_window_ack_size(received_packet.body)
+    def _handle_window_ack_size(self, received_packet):
+        # The server will expect an acknowledgement every time this many bytes have been received.
+        self.window_ack_size = received_packet.body['window_acknowledgement_size']
 
-            log.info('Handled WINDOW_ACK_SIZE packet with response to server.')
-            return True
+        log.info('Handled WINDOW_ACK_SIZE packet, acknowledging every %s byte(s).', self.window_ack_size)
+        return True
 
-        elif received_packet.header.data_type == types.DT_SET_PEER_BANDWIDTH:
-            assert received_packet.body['window_acknowledgement_size'] == 2500000, received_packet.body
-            assert received_packet.body['limit_type'] == 2, received_packet.body
+    def _handle_set_peer_bandwidth(self, received_packet):
+        window_size = received_packet.body['window_acknowledgement_size']
+        limit_type = received_packet.body['limit_type']
 
-            log.info('Handled SET_PEER_BANDWIDTH packet: %s' % received_packet.body)
-            return True
+        # A dynamic limit is only applied (as a hard limit) if the previous limit was hard.
+        if limit_type == types.DYNAMIC:
+            if self.peer_bandwidth_limit_type == types.HARD:
+                limit_type = types.HARD
+            else:
+                log.info('Ignored dynamic SET_PEER_BANDWIDTH packet: %r', received_packet.body)
+                return True
 
-        elif received_packet.header.data_type == types.DT_SET_CHUNK_SIZE:
-            assert 0 < received_packet.body['chunk_size'] <= 65536, received_packet.body
+        # A soft limit can only make the output window smaller.
+        if limit_type == types.SOFT and self.peer_bandwidth is not None:
+            window_size = min(window_size, self.peer_bandwidth)
 
-            new_chunk_size = received_packet.body['chunk_size']
+        self.peer_bandwidth = window_size
+        self.peer_bandwidth_limit_type = limit_type
 
-            # Set RtmpReader chunk size to the new chunk size received.
-            self.rtmp_reader.chunk_size = new_chunk_size
-            log.debug('Set RtmpReader chunk to size to: {0}'.format(self.rtmp_reader.chunk_size))
+        if self.shape_output:
+            self._set_output_bandwidth(self.peer_bandwidth / float(self.output_window_duration))
 
-            # Set RtmpWriter chunk size to the new chunk size received.
-            self.rtmp_writer.chunk_size = new_chunk_size
-            log.debug('Set RtmpWriter chunk to size to: {0}'.format(self.rtmp_writer.chunk_size))
+        # Tell the server the window acknowledgement size we expect if it is different from the last one we sent.
+        if self.peer_bandwidth != self._sent_window_ack_size:
+            self.messages.send_window_ack_size({'window_acknowledgement_size': self.peer_bandwidth})
+            self._sent_window_ack_size = self.peer_bandwidth
 
-            log.info('Handled SET_CHUNK_SIZE packet with new chunk size received.')
-            return True
+        log.info('Handled SET_PEER_BANDWIDTH packet: %r', received_packet.body)
+        return True
 
-        elif received_packet.header.data_type == types.DT_USER_CONTROL and received_packet.body['event_type'] == \
-                types.UC_PING_REQUEST:
+    def _handle_set_chunk_size(self, received_packet):
+        assert 0 < received_packet.body['chunk_size'] <= 65536, received_packet.body
 
-            self.messages.send_ping_response(received_packet.body)
-            timestamp_unpacked = struct.unpack('>I', received_packet.body['event_data'])
-            timestamp = timestamp_unpacked[0]
-            log.debug('Received ping request timestamp: %s' % str(timestamp))
+        new_chunk_size = received_packet.body['chunk_size']
 
-            log.info('Handled PING_REQUEST packet with response to server.')
-            return True
+        # Set RtmpReader chunk size to the new chunk size received.
+        self.rtmp_reader.chunk_size = new_chunk_size
+        log.debug('Set RtmpReader chunk to size to: %s', self.rtmp_reader.chunk_size)
+
+        # Set RtmpWriter chunk size to the new chunk size received.
+        self.rtmp_writer.chunk_size = new_chunk_size
+        log.debug('Set RtmpWriter chunk to size to: %s', self.rtmp_writer.chunk_size)
+
+        log.info('Handled SET_CHUNK_SIZE packet with new chunk size received.')
+        return True
+
+    def _handle_abort(self, received_packet):
+        # Discard the message which is being reassembled on the chunk stream given.
+        aborted = self.rtmp_reader.abort_message(received_packet.body['chunk_stream_id'])
+        log.debug('Aborted message on chunk stream %s: %s', received_packet.body['chunk_stream_id'], aborted)
 
-        # NOTE: Receiving a PING_RESPONSE User Control RTMP message is unlikely, though some servers may respond with
-        #       with this if we send a PING_REQUEST User Control RTMP message initially.
-        elif received_packet.header.data_type == types.DT_USER_CONTROL and received_packet.body['event_type'] == \
-                types.UC_PING_RESPONSE:
+        log.info('Handled ABORT packet.')
+        return True
 
-            unpacked_tpl = struct.unpack('>I', received_packet.body['event_data'])
-            unpacked_response = unpacked_tpl[0]
-            log.debug('Received ping response timestamp: %s' % str(unpacked_response))
+    def _handle_ping_request(self, received_packet):
+        self.messages.send_ping_response(received_packet.body)
+        log.debug('Received ping request timestamp: %s', struct.unpack('>I', received_packet.body['event_data'])[0])
 
-            log.info('Handled PING_RESPONSE from server.')
+        log.info('Handled PING_REQUEST packet with response to server.')
+        return True
+
+    # NOTE: Receiving a PING_RESPONSE User Control RTMP message is unlikely, though some servers may respond with
+    #       with this if we send a PING_REQUEST User Control RTMP message initially.
+    @staticmethod
+    def _handle_ping_response(received_packet):
+        log.debug('Received ping response timestamp: %s', struct.unpack('>I', received_packet.body['event_data'])[0])
+
+        log.info('Handled PING_RESPONSE from server.')
+        return True
+
+    def _handle_command(self, received_packet):
+        # Match the replies (_result or _error) to the calls waiting for them.
+        if len(self._transactions) > 0 and self._transactions.resolve(received_packet):
+            log.info('Handled reply to transaction %s.', received_packet.peek_command()[1])
             return True
 
-        else:
+        return False
+
+    def _handle_shared_object(self, received_packet):
+        # The changes are given to the shared object the message is for, if we are using it. The body is only
+        # decoded if it is for one of them.
+        if not self._shared_objects:
             return False
 
+        shared_object = self._shared_objects.get(received_packet.peek_shared_object_name())
+        if shared_object is None:
+            return False
+
+        return shared_object.handle_message(received_packet)
+
     # TODO: Remove stream_id and override_csid slowly.
     # TODO: Monitor the response on the same transaction id and get the transaction id logs of messages?
     # TODO: Handle command object as a list or dictionary.
@@ -495,15 +808,26 @@ class NetConnection(BaseConnection):
     #       Is this possible?
     # TODO: Fix issue with the parameters going into the transaction id due the transaction id field in function
     #       stated first.
-    def call(self, procedure_name, parameters=None, transaction_id=None, command_object=None, amf3=False):
+    def call(self, procedure_name, parameters=None, transaction_id=None, command_object=None, amf3=False,
+             callback=None, timeout=None, template_key=None):
         """
         Attempts to call a remote procedure call (RPC) on the RTMP server.
 
+        NOTE: Unless the transaction id is 0 (a call which does not expect a reply), the call is given the next
+              transaction id and waits for the reply in the transaction table. The reply (_result or _error) is
+              matched to the call when it is read by read_packet (with the default messages handled).
+
         :param procedure_name: str
         :param parameters: list
-        :param transaction_id: int
+        :param transaction_id: int (default None - the next transaction id)
         :param command_object: list
         :param amf3: boolean True/False
+        :param callback: callable callback(transaction) to call once the reply has been received or the call failed.
+        :param timeout: float the number of seconds to wait for the reply (default None - the call_timeout).
+        :param template_key: the key which identifies the command object, so a call repeated with it is sent from
+                             a cached template (see amf_codec.get_command_template).
+        :return: L{transactions.Transaction} which is done once the reply has been received or the call failed,
+                 or None if the transaction id was 0.
         """
         # :param stream_id: int
 
@@ -515,9 +839,9 @@ class NetConnection(BaseConnection):
         # remote_call.set_stream_id(stream_id)
         remote_call.set_stream_id(0)
 
-        # TODO: Should the transaction id be customisable here?
+        # DONE: Should the transaction id be customisable here? - Yes, though by default it is the next transaction id.
         if transaction_id is None:
-            transaction_id = self.rtmp_writer.transaction_id
+            transaction_id = self.rtmp_writer.next_transaction_id()
 
         # TODO: Alter the way in which we send the RPC content so that we can separate the
         #       command name, transaction id, the command object and the optional arguments
@@ -544,17 +868,63 @@ class NetConnection(BaseConnection):
             'options': optional_parameters
         }
 
+        # The command name and command object of a repeated call (e.g. 'play') are only encoded the first time,
+        # see amf_codec.get_command_template.
+        if not amf3:
+            remote_call.body['template'] = amf_codec.get_command_template(procedure_name, command_object,
+                                                                          template_key)
+
+        # Wait for the reply to the call, this is added before sending in case the reply is read straight away.
+        transaction = None
+        if transaction_id != 0:
+            transaction = self._create_transaction(transaction_id, procedure_name, timeout)
+            if callback is not None:
+                transaction.add_done_callback(callback)
+
         log.debug('Sending Remote Procedure Call: %s with content:', remote_call.body)
         self.rtmp_writer.send_packet(remote_call)
 
-    # def shared_object_use(self, shared_object):
-    #     """
-    #     Use a shared object and add it to the managed list of shared objects (SOs).
-    #     :param shared_object:
-    #     """
-    #     if shared_object not in self._shared_objects:
-    #         shared_object.use(self.rtmp_reader, self.rtmp_writer)
-    #         self._shared_objects.append(shared_object)
+        return transaction
+
+    def _create_transaction(self, transaction_id, procedure_name, timeout):
+        """
+        Creates the transaction for a call and adds it to the transaction table to wait for the reply.
+
+        :param transaction_id: int
+        :param procedure_name: str
+        :param timeout: float the number of seconds to wait for the reply (None - the call_timeout).
+        :return: L{transactions.Transaction}
+        """
+        if timeout is None:
+            timeout = self.call_timeout
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        transaction = transactions.Transaction(transaction_id, procedure_name, deadline)
+        self._transactions.add(transaction)
+        return transaction
+
+    def shared_object_use(self, shared_object):
+        """
+        Use a shared object and add it to the managed list of shared objects (SOs), the messages for it are
+        handled by read_packet.
+
+        :param shared_object: L{rtmp_writer.FlashSharedObject}
+        """
+        if shared_object.name not in self._shared_objects:
+            self._shared_objects[shared_object.name] = shared_object
+            shared_object.use(self.rtmp_writer)
+
+    def shared_object_release(self, shared_object):
+        """
+        Stop using a shared object and remove it from the managed list of shared objects (SOs).
+
+        :param shared_object: L{rtmp_writer.FlashSharedObject}
+        """
+        if self._shared_objects.pop(shared_object.name, None) is not None:
+            shared_object.release(self.rtmp_writer)
 
     def disconnect(self):
         """ Disconnect from the socket and stops the RTMP connection. """
@@ -564,6 +934,9 @@ class NetConnection(BaseConnection):
         self.active_connection = False
         log.info('Active connection is off.')
 
+        # The calls still waiting for a reply will not get one now.
+        self._transactions.fail_all(EOFError('The RTMP connection has been closed.'))
+
         # Reset the connection variables.
         # self.reset_rtmp_server()
         # self.reset_rtmp_parameters()
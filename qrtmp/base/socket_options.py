@@ -0,0 +1,139 @@
+""" The socket options (TCP tuning) the connection to the RTMP server is made with. """
+
+import logging
+import socket
+
+log = logging.getLogger(__name__)
+
+# The names of the presets which can be given to BaseConnection.set_socket_options.
+PRESET_LOW_LATENCY = 'low_latency'
+PRESET_HIGH_THROUGHPUT = 'high_throughput'
+
+
+class SocketOptions(object):
+    """
+    The options to set on the connection's socket, an option which is None is left to the operating system's default.
+
+    NOTE: The options which are not available on the platform (e.g. TCP_QUICKACK outside of Linux, or the keep-alive
+          timings on some systems) are skipped.
+    """
+
+    def __init__(self, tcp_nodelay=True, receive_buffer_size=None, send_buffer_size=None, keepalive=None,
+                 keepalive_idle=None, keepalive_interval=None, keepalive_count=None, connect_timeout=None,
+                 read_timeout=None, quick_ack=False):
+        """
+        :param tcp_nodelay: bool True to disable Nagle's algorithm, so small messages (e.g. command replies)
+                            are sent straight away (default True).
+        :param receive_buffer_size: int the size of the socket's receive buffer (SO_RCVBUF) in bytes.
+        :param send_buffer_size: int the size of the socket's send buffer (SO_SNDBUF) in bytes.
+        :param keepalive: bool True to turn on TCP keep-alive (SO_KEEPALIVE).
+        :param keepalive_idle: int the seconds the connection is idle before keep-alive probes are sent.
+        :param keepalive_interval: int the seconds between keep-alive probes.
+        :param keepalive_count: int the number of keep-alive probes which go unanswered before the connection is closed.
+        :param connect_timeout: float the seconds to wait for the connection to be made.
+        :param read_timeout: float the seconds to wait for data from the server before a socket.timeout is raised
+                             (the connection can not be read from after the timeout, as part of a chunk may have
+                             been read).
+        :param quick_ack: bool True to acknowledge the data received straight away (TCP_QUICKACK, Linux only),
+                          the option is set again before each receive as the kernel may turn it off.
+        """
+        self.tcp_nodelay = tcp_nodelay
+        self.receive_buffer_size = receive_buffer_size
+        self.send_buffer_size = send_buffer_size
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.quick_ack = quick_ack
+
+    def __repr__(self):
+        return '<SocketOptions %r>' % self.__dict__
+
+    @classmethod
+    def low_latency(cls):
+        """
+        The options for interactive and live connections, every message is sent and acknowledged straight away
+        and the send buffer is kept small so the data does not wait in it.
+
+        :return: L{SocketOptions}
+        """
+        return cls(tcp_nodelay=True, send_buffer_size=64 * 1024, keepalive=True, keepalive_idle=30,
+                   keepalive_interval=10, keepalive_count=3, quick_ack=True)
+
+    @classmethod
+    def high_throughput(cls):
+        """
+        The options for publishing or receiving a lot of data, with large socket buffers.
+
+        :return: L{SocketOptions}
+        """
+        return cls(tcp_nodelay=True, receive_buffer_size=4 * 1024 * 1024, send_buffer_size=4 * 1024 * 1024,
+                   keepalive=True, keepalive_idle=60, keepalive_interval=20, keepalive_count=3)
+
+    @classmethod
+    def from_preset(cls, preset):
+        """
+        :param preset: str PRESET_LOW_LATENCY or PRESET_HIGH_THROUGHPUT.
+        :return: L{SocketOptions}
+        """
+        if preset == PRESET_LOW_LATENCY:
+            return cls.low_latency()
+        elif preset == PRESET_HIGH_THROUGHPUT:
+            return cls.high_throughput()
+        else:
+            raise ValueError('Unknown socket options preset: %r' % preset)
+
+    @staticmethod
+    def _set_option(socket_object, level, option_name, value):
+        """
+        Sets a socket option if the platform has it.
+
+        :param socket_object: the socket.
+        :param level: int the protocol level (e.g. socket.IPPROTO_TCP).
+        :param option_name: str the name of the option in the socket module (e.g. 'TCP_NODELAY').
+        :param value: int the value of the option.
+        """
+        option = getattr(socket, option_name, None)
+        if option is None:
+            log.debug('Socket option %s is not available on this platform.', option_name)
+            return
+
+        try:
+            socket_object.setsockopt(level, option, value)
+        except (socket.error, OSError) as ex:
+            log.warning('Could not set socket option %s to %s: %s', option_name, value, ex)
+
+    def apply(self, socket_object):
+        """
+        Sets the options on the socket, this should be done before it is connected as the buffer sizes have to be
+        set before connecting for the TCP window to be scaled to them.
+
+        NOTE: The timeouts are not set here, as an asyncio transport's socket must stay non-blocking.
+
+        :param socket_object: the socket which is about to be connected.
+        """
+        if self.tcp_nodelay is not None:
+            self._set_option(socket_object, socket.IPPROTO_TCP, 'TCP_NODELAY', int(self.tcp_nodelay))
+
+        if self.receive_buffer_size is not None:
+            self._set_option(socket_object, socket.SOL_SOCKET, 'SO_RCVBUF', self.receive_buffer_size)
+        if self.send_buffer_size is not None:
+            self._set_option(socket_object, socket.SOL_SOCKET, 'SO_SNDBUF', self.send_buffer_size)
+
+        if self.keepalive is not None:
+            self._set_option(socket_object, socket.SOL_SOCKET, 'SO_KEEPALIVE', int(self.keepalive))
+        if self.keepalive:
+            if self.keepalive_idle is not None:
+                self._set_option(socket_object, socket.IPPROTO_TCP, 'TCP_KEEPIDLE', self.keepalive_idle)
+            if self.keepalive_interval is not None:
+                self._set_option(socket_object, socket.IPPROTO_TCP, 'TCP_KEEPINTVL', self.keepalive_interval)
+            if self.keepalive_count is not None:
+                self._set_option(socket_object, socket.IPPROTO_TCP, 'TCP_KEEPCNT', self.keepalive_count)
+
+    def set_quick_ack(self, socket_object):
+        """
+        :param socket_object: the connected socket.
+        """
+        self._set_option(socket_object, socket.IPPROTO_TCP, 'TCP_QUICKACK', 1)
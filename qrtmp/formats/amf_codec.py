@@ -0,0 +1,538 @@
+"""
+The AMF0 codecs the command and data messages are encoded and decoded with.
+
+The bodies of these messages are small and made up of the same few types (numbers, booleans, strings, objects,
+ECMA arrays, null and strict arrays), the fast codec encodes and decodes these directly and leaves any other type
+(e.g. dates, references or typed objects) to PyAMF.
+
+NOTE: The codec used by default can be changed with set_codec, e.g. set_codec(CODEC_PYAMF) to go back to encoding
+      and decoding everything with PyAMF.
+"""
+
+import collections
+import logging
+import struct
+import threading
+
+import pyamf
+import pyamf.amf0
+import pyamf.util
+
+log = logging.getLogger(__name__)
+
+# The names of the codecs which can be given to set_codec.
+CODEC_FAST = 'fast'
+CODEC_PYAMF = 'pyamf'
+CODEC_FLASHMEDIA = 'flashmedia'
+
+# The AMF0 type markers the fast codec handles.
+_NUMBER = '\x00'
+_BOOLEAN = '\x01'
+_STRING = '\x02'
+_OBJECT = '\x03'
+_NULL = '\x05'
+_UNDEFINED = '\x06'
+_ECMA_ARRAY = '\x08'
+_OBJECT_END = '\x09'
+_STRICT_ARRAY = '\x0a'
+_LONG_STRING = '\x0c'
+
+_DOUBLE = struct.Struct('>d')
+_USHORT = struct.Struct('>H')
+_ULONG = struct.Struct('>L')
+
+# The empty key and end marker which end an object or ECMA array.
+_END_OF_OBJECT = '\x00\x00' + _OBJECT_END
+
+# The most command templates to keep (see get_command_template), the least recently used is dropped once there
+# are more.
+MAX_COMMAND_TEMPLATES = 256
+
+
+class _UnsupportedType(Exception):
+    """ Raised by the fast codec for a value it does not handle, so the whole body is left to PyAMF. """
+
+
+def _to_number(value):
+    """
+    Returns a number read from the body as an int if it is a whole number, as PyAMF does
+    (AMF0 has no separate integer type).
+
+    :param value: float the number.
+    :return: int or float
+    """
+    try:
+        integer = int(value)
+    except (OverflowError, ValueError):
+        return value
+
+    if integer == value:
+        return integer
+    return value
+
+
+def encode_name(name):
+    """
+    Encodes a string without its type marker, as the names of shared objects and their attributes are.
+
+    :param name: str or unicode the name.
+    :return: str the encoded name.
+    """
+    if type(name) is unicode:
+        name = name.encode('utf-8')
+    return _USHORT.pack(len(name)) + name
+
+
+def _get_bytes(data, start, end):
+    """
+    :param data: str, bytearray or memoryview (e.g. of a message inside an aggregate message).
+    :return: str the bytes between the positions given.
+    """
+    if isinstance(data, memoryview):
+        return data[start:end].tobytes()
+    return str(data[start:end])
+
+
+def peek_name(data):
+    """
+    Reads the string without its type marker at the start of the data (see encode_name), e.g. the name of the
+    shared object a message is for, without decoding the rest of the data.
+
+    :param data: str, bytearray or memoryview the encoded data.
+    :return: unicode the name, or None if the data is too short to hold it.
+    """
+    if not isinstance(data, (str, bytearray, memoryview)) or len(data) < 2:
+        return None
+
+    end = 2 + _USHORT.unpack(_get_bytes(data, 0, 2))[0]
+    if len(data) < end:
+        return None
+    return _get_bytes(data, 2, end).decode('utf-8')
+
+
+def peek_command(data):
+    """
+    Reads the command name and transaction id at the start of a command message, without decoding the rest of it
+    (e.g. to match a reply to the call waiting for it).
+
+    :param data: str, bytearray or memoryview the encoded command.
+    :return: tuple of the command name and transaction id, or None if the data does not start with them.
+    """
+    if not isinstance(data, (str, bytearray, memoryview)) or len(data) < 3 or _get_bytes(data, 0, 1) != _STRING:
+        return None
+
+    # The command name is a string, followed by the transaction id as a number.
+    name_end = 3 + _USHORT.unpack(_get_bytes(data, 1, 3))[0]
+    transaction_id = _get_bytes(data, name_end, name_end + 9)
+    if len(transaction_id) < 9 or transaction_id[0] != _NUMBER:
+        return None
+    return _get_bytes(data, 3, name_end).decode('utf-8'), _to_number(_DOUBLE.unpack(transaction_id[1:])[0])
+
+
+class PyAmfCodec(object):
+    """ Encodes and decodes AMF0 with PyAMF, which handles every AMF0 type. """
+
+    name = CODEC_PYAMF
+
+    @staticmethod
+    def encode(values):
+        """
+        :param values: list of the values to encode one after the other.
+        :return: str the encoded values.
+        """
+        stream = pyamf.util.BufferedByteStream()
+        encoder = pyamf.amf0.Encoder(stream)
+        for value in values:
+            encoder.writeElement(value)
+        return stream.getvalue()
+
+    @staticmethod
+    def decode(data):
+        """
+        :param data: str the encoded values.
+        :return: list of the values decoded, in the order they were encoded.
+        """
+        stream = pyamf.util.BufferedByteStream(data)
+        decoder = pyamf.amf0.Decoder(stream)
+        values = []
+        while not stream.at_eof():
+            values.append(decoder.readElement())
+        return values
+
+
+class FastAmf0Codec(object):
+    """
+    Encodes and decodes the common AMF0 types directly, the values come out the same as they would from PyAMF
+    (objects are decoded into pyamf.ASObject and ECMA arrays into pyamf.MixedArray).
+
+    NOTE: If a body has a type which is not handled (or can not be decoded), the whole body is encoded or decoded
+          by the fallback codec (PyAMF) instead, references within the body can only be followed by PyAMF.
+    """
+
+    name = CODEC_FAST
+
+    def __init__(self, fallback=None):
+        """
+        :param fallback: the codec to use for the bodies the fast codec does not handle (default PyAmfCodec).
+        """
+        self.fallback = fallback or PyAmfCodec()
+
+    def encode(self, values):
+        """
+        :param values: list of the values to encode one after the other.
+        :return: str the encoded values.
+        """
+        parts = []
+        try:
+            for value in values:
+                self._encode_value(value, parts)
+        except _UnsupportedType as ex:
+            log.debug('Encoding with %s, unsupported value: %r', self.fallback.name, ex.args[0])
+            return self.fallback.encode(values)
+        return ''.join(parts)
+
+    def decode(self, data):
+        """
+        :param data: str the encoded values.
+        :return: list of the values decoded, in the order they were encoded.
+        """
+        values = []
+        offset = 0
+        try:
+            while offset < len(data):
+                value, offset = self._decode_value(data, offset)
+                values.append(value)
+        except (_UnsupportedType, struct.error, IndexError) as ex:
+            log.debug('Decoding with %s: %r', self.fallback.name, ex)
+            return self.fallback.decode(data)
+        return values
+
+    def _encode_value(self, value, parts):
+        """
+        :param value: the value to encode.
+        :param parts: list the encoded parts are appended to.
+        """
+        value_type = type(value)
+
+        if value is None:
+            parts.append(_NULL)
+        elif value_type is bool:
+            parts.append(_BOOLEAN + ('\x01' if value else '\x00'))
+        elif value_type is int or value_type is float or value_type is long:
+            parts.append(_NUMBER + _DOUBLE.pack(value))
+        elif value_type is str or value_type is unicode:
+            self._encode_string(value, parts)
+        elif value_type is dict or value_type is pyamf.ASObject:
+            parts.append(_OBJECT)
+            self._encode_attributes(value, parts)
+        elif value_type is pyamf.MixedArray:
+            # The length is the highest integer key, as PyAMF writes it.
+            indexes = [key for key in value if type(key) is int or type(key) is long]
+            parts.append(_ECMA_ARRAY + _ULONG.pack(max(max(indexes), 0) if indexes else 0))
+            self._encode_attributes(value, parts)
+        elif value_type is list or value_type is tuple:
+            parts.append(_STRICT_ARRAY + _ULONG.pack(len(value)))
+            for item in value:
+                self._encode_value(item, parts)
+        elif value is pyamf.Undefined:
+            parts.append(_UNDEFINED)
+        else:
+            raise _UnsupportedType(value)
+
+    @staticmethod
+    def _encode_string(value, parts):
+        """
+        :param value: str or unicode the string to encode.
+        :param parts: list the encoded parts are appended to.
+        """
+        if type(value) is unicode:
+            value = value.encode('utf-8')
+
+        if len(value) > 0xffff:
+            parts.append(_LONG_STRING + _ULONG.pack(len(value)))
+        else:
+            parts.append(_STRING + _USHORT.pack(len(value)))
+        parts.append(value)
+
+    def _encode_attributes(self, value, parts):
+        """
+        :param value: dict the attributes of an object or ECMA array to encode.
+        :param parts: list the encoded parts are appended to.
+        """
+        for key, attribute in value.iteritems():
+            key_type = type(key)
+            if key_type is int or key_type is long:
+                key = str(key)
+            elif key_type is unicode:
+                key = key.encode('utf-8')
+            elif key_type is not str:
+                raise _UnsupportedType(key)
+
+            if len(key) > 0xffff:
+                raise _UnsupportedType(key)
+
+            parts.append(_USHORT.pack(len(key)))
+            parts.append(key)
+            self._encode_value(attribute, parts)
+
+        parts.append(_END_OF_OBJECT)
+
+    def _decode_value(self, data, offset):
+        """
+        :param data: str the encoded values.
+        :param offset: int the position of the value's type marker.
+        :return: tuple of the value and the position after it.
+        """
+        marker = data[offset]
+        offset += 1
+
+        if marker == _STRING:
+            length = _USHORT.unpack_from(data, offset)[0]
+            offset += 2
+            return self._read_bytes(data, offset, length).decode('utf-8'), offset + length
+        elif marker == _NUMBER:
+            return _to_number(_DOUBLE.unpack_from(data, offset)[0]), offset + 8
+        elif marker == _OBJECT:
+            value = pyamf.ASObject()
+            offset = self._decode_attributes(data, offset, value)
+            return value, offset
+        elif marker == _NULL:
+            return None, offset
+        elif marker == _BOOLEAN:
+            return data[offset] != '\x00', offset + 1
+        elif marker == _ECMA_ARRAY:
+            attributes = {}
+            offset = self._decode_attributes(data, offset + 4, attributes)
+
+            # The keys which are numbers are given as integers, as PyAMF does.
+            value = pyamf.MixedArray()
+            for key, attribute in attributes.iteritems():
+                try:
+                    key = int(key)
+                except ValueError:
+                    pass
+                value[key] = attribute
+            return value, offset
+        elif marker == _STRICT_ARRAY:
+            length = _ULONG.unpack_from(data, offset)[0]
+            offset += 4
+            value = []
+            for _ in xrange(length):
+                item, offset = self._decode_value(data, offset)
+                value.append(item)
+            return value, offset
+        elif marker == _UNDEFINED:
+            return pyamf.Undefined, offset
+        elif marker == _LONG_STRING:
+            length = _ULONG.unpack_from(data, offset)[0]
+            offset += 4
+            return self._read_bytes(data, offset, length).decode('utf-8'), offset + length
+        else:
+            raise _UnsupportedType(marker)
+
+    def _decode_attributes(self, data, offset, value):
+        """
+        :param data: str the encoded values.
+        :param offset: int the position of the first key.
+        :param value: dict the attributes are decoded into.
+        :return: int the position after the end of the object.
+        """
+        while True:
+            length = _USHORT.unpack_from(data, offset)[0]
+            offset += 2
+            key = self._read_bytes(data, offset, length)
+            offset += length
+
+            if data[offset] == _OBJECT_END:
+                return offset + 1
+
+            value[key], offset = self._decode_value(data, offset)
+
+    @staticmethod
+    def _read_bytes(data, offset, length):
+        """
+        :param data: str the encoded values.
+        :param offset: int the position of the bytes.
+        :param length: int the number of bytes to read.
+        :return: str
+        """
+        if offset + length > len(data):
+            raise IndexError('The body ended %s bytes early.' % (offset + length - len(data)))
+        return data[offset:offset + length]
+
+
+class FlashmediaCodec(object):
+    """
+    Encodes and decodes AMF0 with the ScriptDataValue types from the flashmedia package (flv_manager.flashmedia).
+
+    NOTE: The values are not the same as those PyAMF gives, objects and ECMA arrays are decoded into ordered
+          dictionaries, numbers are always floats and undefined is decoded as None.
+    """
+
+    name = CODEC_FLASHMEDIA
+
+    def __init__(self):
+        # Only imported when the codec is used, as flv_manager is not installed along with Qrtmp.
+        from flv_manager.flashmedia import types as flashmedia_types
+        self._types = flashmedia_types
+
+    def encode(self, values):
+        """
+        :param values: list of the values to encode one after the other.
+        :return: str the encoded values.
+        """
+        return ''.join(self._types.AMF0Value.pack(self._to_script_data(value)) for value in values)
+
+    def decode(self, data):
+        """
+        :param data: str the encoded values.
+        :return: list of the values decoded, in the order they were encoded.
+        """
+        values = []
+        offset = 0
+        while offset < len(data):
+            value, offset = self._types.AMF0Value.unpack_from(data, offset)
+            values.append(value)
+        return values
+
+    def _to_script_data(self, value):
+        """
+        Converts the dictionaries in a value into the script data objects flashmedia can pack.
+
+        :param value: the value to encode.
+        :return: the value with each dictionary converted.
+        """
+        if isinstance(value, pyamf.MixedArray):
+            return self._types.ScriptDataECMAArray((key, self._to_script_data(attribute))
+                                                   for key, attribute in value.iteritems())
+        elif isinstance(value, dict) and not isinstance(value, self._types.ScriptDataType):
+            return self._types.ScriptDataObject((key, self._to_script_data(attribute))
+                                                for key, attribute in value.iteritems())
+        elif isinstance(value, (list, tuple)):
+            return [self._to_script_data(item) for item in value]
+        return value
+
+
+def new_codec(name):
+    """
+    :param name: str CODEC_FAST, CODEC_PYAMF or CODEC_FLASHMEDIA.
+    :return: the codec.
+    """
+    if name == CODEC_FAST:
+        return FastAmf0Codec()
+    elif name == CODEC_PYAMF:
+        return PyAmfCodec()
+    elif name == CODEC_FLASHMEDIA:
+        try:
+            return FlashmediaCodec()
+        except ImportError as ex:
+            raise ValueError('The flashmedia codec is not available: %s' % ex)
+    else:
+        raise ValueError('Unknown AMF0 codec: %r' % name)
+
+
+class CommandTemplate(object):
+    """
+    A command (e.g. 'connect' or 'play') of which the command name and command object are encoded once,
+    only the transaction id and the options are encoded each time it is sent.
+    """
+
+    def __init__(self, command_name, command_object=None):
+        """
+        :param command_name: str the name of the command.
+        :param command_object: the command object, a list is encoded as one element after another
+                               (as RtmpPacket.setup does).
+        """
+        self.command_name = command_name
+        self.command_object = command_object
+
+        if type(command_object) is not list:
+            command_object = [command_object]
+
+        codec = get_codec()
+        self._command_name = codec.encode([command_name])
+        self._command_object = codec.encode(command_object)
+
+    def __repr__(self):
+        return '<CommandTemplate %r>' % self.command_name
+
+    def encode(self, transaction_id, options=None):
+        """
+        :param transaction_id: int the transaction id to send the command with.
+        :param options: list of the options (optional arguments) which follow the command object.
+        :return: str the encoded command.
+        """
+        body = self._command_name + _NUMBER + _DOUBLE.pack(transaction_id) + self._command_object
+        if options:
+            body += get_codec().encode(options)
+        return body
+
+
+# The command templates which have been encoded, by their command name and key, the most recently used last.
+# The connections (which may each run in a thread of their own) share them, so they are only changed under the lock.
+_command_templates = collections.OrderedDict()
+_command_templates_lock = threading.Lock()
+
+
+def get_command_template(command_name, command_object=None, key=None):
+    """
+    Returns the template for a command, which is only encoded the first time it is asked for (the templates are
+    shared between all connections).
+
+    NOTE: The command object is not looked at to find the template, so the command name and key given must only
+          ever be used with the same command object. The key should be cheap to hash, e.g. a tuple of the values
+          the command object is made from. A caller which sends the same command itself can instead hold on to
+          a CommandTemplate of its own.
+
+    :param command_name: str the name of the command.
+    :param command_object: the command object, which should not be changed once the template has been made.
+    :param key: the (hashable) key which identifies the command object (default None - no command object).
+    :return: L{CommandTemplate}, or None if there is a command object but no key, in which case the command
+             should be encoded as usual.
+    """
+    if key is None and command_object is not None:
+        return None
+
+    cache_key = command_name, key
+    with _command_templates_lock:
+        template = _command_templates.pop(cache_key, None)
+        if template is not None:
+            _command_templates[cache_key] = template
+            return template
+
+    # The template is encoded outside the lock, if another thread encodes the same one meanwhile either can be kept.
+    template = CommandTemplate(command_name, command_object)
+
+    with _command_templates_lock:
+        if cache_key not in _command_templates and len(_command_templates) >= MAX_COMMAND_TEMPLATES:
+            _command_templates.popitem(last=False)
+        _command_templates[cache_key] = template
+    return template
+
+
+# The codec the command and data messages are encoded and decoded with.
+_codec = FastAmf0Codec()
+
+
+def get_codec():
+    """
+    :return: the codec the command and data messages are encoded and decoded with.
+    """
+    return _codec
+
+
+def set_codec(codec):
+    """
+    Sets the codec the command and data messages are encoded and decoded with,
+    the command templates which were encoded with the previous codec are cleared.
+
+    :param codec: str the name of the codec (see new_codec), or a codec object with encode(values) and decode(data).
+    """
+    global _codec
+
+    if isinstance(codec, basestring):
+        codec = new_codec(codec)
+
+    _codec = codec
+    with _command_templates_lock:
+        _command_templates.clear()
@@ -1,5 +1,48 @@
+import hashlib
+import hmac
+import itertools
+import os
+import struct
 import time
 
+# The first and second fields of a handshake chunk.
+_HANDSHAKE_FIELDS = struct.Struct('>LL')
+
+# The RTMP version sent in C0 and expected back in S0.
+RTMP_VERSION = 3
+
+
+# The handshake types which the client can use.
+HANDSHAKE_SIMPLE = 'simple'
+HANDSHAKE_DIGEST = 'digest'
+
+# The version sent in C1 in the digest handshake (a non-zero version tells the server the digest is present).
+DIGEST_CLIENT_VERSION = 0x0a002d02  # 10.0.45.2
+
+# The keys the digests in the digest handshake are made with.
+_KEY_TAIL = (
+    '\xf0\xee\xc2\x4a\x80\x68\xbe\xe8\x2e\x00\xd0\xd1\x02\x9e\x7e\x57'
+    '\x6e\xec\x5d\x2d\x29\x80\x6f\xab\x93\xb8\xe6\x36\xcf\xeb\x31\xae'
+)
+GENUINE_FP_KEY = 'Genuine Adobe Flash Player 001' + _KEY_TAIL
+GENUINE_FMS_KEY = 'Genuine Adobe Flash Media Server 001' + _KEY_TAIL
+
+# The HMAC-SHA256 objects for each key are only keyed once, they are copied for every digest made with them.
+_CLIENT_DIGEST_HMAC = hmac.new(GENUINE_FP_KEY[:30], digestmod=hashlib.sha256)
+_SERVER_DIGEST_HMAC = hmac.new(GENUINE_FMS_KEY[:36], digestmod=hashlib.sha256)
+_CLIENT_RESPONSE_KEY_HMAC = hmac.new(GENUINE_FP_KEY, digestmod=hashlib.sha256)
+_SERVER_RESPONSE_KEY_HMAC = hmac.new(GENUINE_FMS_KEY, digestmod=hashlib.sha256)
+
+# The length of the digests.
+DIGEST_LENGTH = 32
+
+# The digest offset schemes, the offset is worked out from the four bytes at the start of the scheme's block.
+DIGEST_SCHEMES = (8, 772)
+
+
+class HandshakeError(Exception):
+    """ Raised if the server rejected the RTMP handshake. """
+
 
 class HandshakeChunk(object):
     """
@@ -42,12 +85,8 @@ class HandshakeChunk(object):
 
         :param rtmp_stream:
         """
-        # Write the first and second data into the stream.
-        rtmp_stream.write_ulong(self.first or 0)
-        rtmp_stream.write_ulong(self.second or 0)
-
-        # Write the payload into the stream.
-        rtmp_stream.write(self.payload)
+        # Write the first and second data, followed by the payload into the stream in one go.
+        rtmp_stream.write(_HANDSHAKE_FIELDS.pack(self.first or 0, self.second or 0) + self.payload)
 
     def decode(self, rtmp_stream):
         """
@@ -61,3 +100,227 @@ class HandshakeChunk(object):
 
         # Read the message payload from the stream buffer given the handshake length.
         self.payload = rtmp_stream.read(self.handshake_length - 8)
+
+        if len(self.payload) != self.handshake_length - 8:
+            raise EOFError('The handshake chunk was incomplete.')
+
+
+# The length of the payload in the C1/S1 and C2/S2 handshake chunks.
+PAYLOAD_LENGTH = HandshakeChunk.handshake_length - 8
+
+
+def create_payload(payload_pool=None):
+    """
+    Creates the random payload of the C1 handshake chunk.
+
+    :param payload_pool: L{PayloadPool} to take a precomputed payload from (default None - a new payload is created).
+    :return: str the payload.
+    """
+    if payload_pool is not None:
+        return payload_pool.get()
+    return os.urandom(PAYLOAD_LENGTH)
+
+
+def verify_s0(version):
+    """
+    Checks the RTMP version the server replied with in S0.
+
+    :param version: int the version read from S0.
+    """
+    if version != RTMP_VERSION:
+        raise HandshakeError('The server replied with RTMP version %s in S0 (expected %s).' % (version, RTMP_VERSION))
+
+
+def verify_s2(c1, s2):
+    """
+    Returns whether S2 is the echo of the C1 we sent.
+
+    NOTE: Not every server echoes C1 exactly, so a mismatch is not treated as the handshake being rejected.
+          A rejected handshake is one where the server replies with the wrong version or closes the connection.
+
+    :param c1: L{HandshakeChunk} the C1 chunk we sent.
+    :param s2: L{HandshakeChunk} the S2 chunk the server sent.
+    :return: bool True if S2 echoes C1.
+    """
+    return s2.payload == c1.payload
+
+
+def _hmac_digest(precomputed_hmac, data):
+    """
+    :param precomputed_hmac: hmac object which has already been keyed.
+    :param data: str the data to digest.
+    :return: str the HMAC-SHA256 digest of the data.
+    """
+    data_hmac = precomputed_hmac.copy()
+    data_hmac.update(data)
+    return data_hmac.digest()
+
+
+def get_digest_offset(chunk_data, scheme):
+    """
+    Returns the offset of the digest in a (C1 or S1) handshake chunk, this is worked out from the four bytes
+    at the start of the scheme's block.
+
+    :param chunk_data: str the whole handshake chunk (1536 bytes).
+    :param scheme: int the start of the scheme's block (one of DIGEST_SCHEMES).
+    :return: int the offset of the digest.
+    """
+    offset_bytes = bytearray(chunk_data[scheme:scheme + 4])
+    return (offset_bytes[0] + offset_bytes[1] + offset_bytes[2] + offset_bytes[3]) % 728 + scheme + 4
+
+
+def create_chunk_digest(precomputed_hmac, chunk_data, digest_offset):
+    """
+    Returns the digest of a handshake chunk, made from the whole chunk apart from the digest itself.
+
+    :param precomputed_hmac: hmac object which has already been keyed.
+    :param chunk_data: str the whole handshake chunk (1536 bytes).
+    :param digest_offset: int the offset of the digest in the chunk.
+    :return: str the digest.
+    """
+    return _hmac_digest(precomputed_hmac, chunk_data[:digest_offset] + chunk_data[digest_offset + DIGEST_LENGTH:])
+
+
+def create_response(precomputed_key_hmac, digest, random_data):
+    """
+    Returns the response (C2 or S2) to the digest of the other side's first chunk, this is the random data
+    followed by its digest, made with a key from the digest we are responding to.
+
+    :param precomputed_key_hmac: hmac object which has already been keyed, to make the response key with.
+    :param digest: str the digest we are responding to.
+    :param random_data: str the random data which starts the response (1504 bytes).
+    :return: str the whole response chunk (1536 bytes).
+    """
+    response_key = _hmac_digest(precomputed_key_hmac, digest)
+    return random_data + hmac.new(response_key, random_data, hashlib.sha256).digest()
+
+
+def _join_chunk(chunk):
+    """
+    :param chunk: L{HandshakeChunk}
+    :return: str the whole handshake chunk.
+    """
+    return _HANDSHAKE_FIELDS.pack(chunk.first or 0, chunk.second or 0) + chunk.payload
+
+
+def _split_chunk(chunk_data):
+    """
+    :param chunk_data: str the whole handshake chunk.
+    :return: L{HandshakeChunk}
+    """
+    first, second = _HANDSHAKE_FIELDS.unpack_from(chunk_data)
+    return HandshakeChunk(first=first, second=second, payload=chunk_data[8:])
+
+
+class ClientHandshake(object):
+    """
+    The client side of the RTMP handshake, either the simple handshake (C2 echoes S1) or the digest handshake.
+
+    NOTE: In the digest handshake, C1 carries an HMAC-SHA256 digest which the server checks and S1 carries a digest
+          from the server which we check. If S1 does not have a valid digest the server only supports the simple
+          handshake, so we carry on with the simple handshake.
+    """
+
+    def __init__(self, handshake_type=HANDSHAKE_SIMPLE, payload_pool=None):
+        """
+        :param handshake_type: str HANDSHAKE_SIMPLE or HANDSHAKE_DIGEST (default HANDSHAKE_SIMPLE).
+        :param payload_pool: L{PayloadPool} to take the random payloads from (default None).
+        """
+        if handshake_type not in (HANDSHAKE_SIMPLE, HANDSHAKE_DIGEST):
+            raise ValueError('Unknown handshake type: %r' % handshake_type)
+
+        self.handshake_type = handshake_type
+        self._payload_pool = payload_pool
+
+        self.c1 = None
+        self._c1_digest = None
+
+        # Whether the server replied with the digest handshake.
+        self.server_digest = False
+
+    def create_c1(self):
+        """
+        :return: L{HandshakeChunk} the C1 chunk to send.
+        """
+        payload = create_payload(self._payload_pool)
+
+        if self.handshake_type == HANDSHAKE_SIMPLE:
+            self.c1 = HandshakeChunk(first=0, second=0, payload=payload)
+            return self.c1
+
+        chunk_data = _HANDSHAKE_FIELDS.pack(0, DIGEST_CLIENT_VERSION) + payload
+        digest_offset = get_digest_offset(chunk_data, DIGEST_SCHEMES[0])
+        self._c1_digest = create_chunk_digest(_CLIENT_DIGEST_HMAC, chunk_data, digest_offset)
+
+        self.c1 = _split_chunk(chunk_data[:digest_offset] + self._c1_digest +
+                               chunk_data[digest_offset + DIGEST_LENGTH:])
+        return self.c1
+
+    def create_c2(self, s1):
+        """
+        :param s1: L{HandshakeChunk} the S1 chunk received from the server.
+        :return: L{HandshakeChunk} the C2 chunk to send.
+        """
+        if self.handshake_type == HANDSHAKE_DIGEST:
+            s1_data = _join_chunk(s1)
+
+            # The server may use either of the offset schemes.
+            for scheme in DIGEST_SCHEMES:
+                digest_offset = get_digest_offset(s1_data, scheme)
+                s1_digest = s1_data[digest_offset:digest_offset + DIGEST_LENGTH]
+                if hmac.compare_digest(create_chunk_digest(_SERVER_DIGEST_HMAC, s1_data, digest_offset), s1_digest):
+                    self.server_digest = True
+                    random_data = create_payload(self._payload_pool)[:HandshakeChunk.handshake_length - DIGEST_LENGTH]
+                    return _split_chunk(create_response(_CLIENT_RESPONSE_KEY_HMAC, s1_digest, random_data))
+
+        # The simple handshake echoes S1.
+        return HandshakeChunk(first=s1.first, second=0, payload=s1.payload)
+
+    def verify_s2(self, s2):
+        """
+        Returns whether S2 is the correct response to C1, the digest of the response is checked
+        if the server replied with the digest handshake, otherwise S2 should echo C1.
+
+        :param s2: L{HandshakeChunk} the S2 chunk received from the server.
+        :return: bool True if S2 is the correct response to C1.
+        """
+        if self.server_digest:
+            s2_data = _join_chunk(s2)
+            expected_s2 = create_response(_SERVER_RESPONSE_KEY_HMAC, self._c1_digest, s2_data[:-DIGEST_LENGTH])
+            return hmac.compare_digest(expected_s2[-DIGEST_LENGTH:], s2_data[-DIGEST_LENGTH:])
+
+        return verify_s2(self.c1, s2)
+
+
+class PayloadPool(object):
+    """
+    A pool of precomputed C1 handshake payloads, which are generated in bulk and re-used in turn.
+
+    NOTE: The payload only has to be random enough for the server to echo it back in S2 (for the simple handshake),
+          so when many connections are made at once (e.g. reconnecting after a failover) the same payloads
+          can be re-used rather than being generated again for every connection.
+    """
+
+    def __init__(self, size=64):
+        """
+        Initialise the pool with the number of payloads to precompute.
+
+        :param size: int the number of payloads in the pool (default 64).
+        """
+        self.size = size
+        self._payloads = None
+        self.refresh()
+
+    def refresh(self):
+        """ Generates a new set of payloads for the pool. """
+        random_data = os.urandom(PAYLOAD_LENGTH * self.size)
+        self._payloads = itertools.cycle([random_data[i:i + PAYLOAD_LENGTH]
+                                          for i in xrange(0, len(random_data), PAYLOAD_LENGTH)])
+
+    def get(self):
+        """
+        Returns the next payload in the pool.
+
+        :return: str the payload.
+        """
+        return next(self._payloads)
@@ -18,8 +18,11 @@ GoelBiju (https://github.com/GoelBiju/)
 """
 
 # import logging
+import struct
 import threading
 
+import pyamf.util
+
 from qrtmp.formats import types
 
 # TODO: RECORD HEADER:
@@ -42,6 +45,28 @@ class HeaderError(Exception):
     """ Raised if a header related operation failed. """
 
 
+# Precompiled header structures, the 24-bit fields are packed as a high byte followed by the low two bytes.
+# The basic header with a one, two or three byte chunk stream id.
+_BASIC_HEADER_1 = struct.Struct('>B')
+_BASIC_HEADER_2 = struct.Struct('>BB')
+_BASIC_HEADER_3 = struct.Struct('>BBB')
+
+# Type 2 - the timestamp (delta).
+_TIMESTAMP = struct.Struct('>BH')
+
+# Type 1 and the start of type 0 - the timestamp (delta), body length and data type.
+_TIMESTAMP_LENGTH_TYPE = struct.Struct('>BHBHB')
+
+# The little endian stream id at the end of a type 0 header.
+_STREAM_ID = struct.Struct('<I')
+
+# The extended timestamp which follows the header if the timestamp was 0xffffff.
+_EXTENDED_TIMESTAMP = struct.Struct('>I')
+
+# The number of bytes which follow the basic header for each chunk type.
+_MESSAGE_HEADER_SIZES = (11, 7, 3, 0)
+
+
 # TODO: Handle packet header properties, e.g. the chunk_type and chunk stream id.
 class RtmpHeader(object):
     """
@@ -114,6 +139,34 @@ class RtmpHeader(object):
             id(self))
 
 
+class ChunkStreamState(object):
+    """
+    The latest header information on a chunk stream, which the compressed headers (types 1, 2 and 3)
+    on the chunk stream are based on.
+    """
+    __slots__ = ('timestamp', 'timestamp_delta', 'body_length', 'data_type', 'stream_id', 'extended_timestamp')
+
+    def __init__(self):
+        self.timestamp = -1
+        self.timestamp_delta = 0
+        self.body_length = -1
+        self.data_type = -1
+        self.stream_id = -1
+        self.extended_timestamp = None
+
+    def update(self, header):
+        """
+        Updates the state with the information from the latest header on the chunk stream.
+
+        :param header: L{RtmpHeader}
+        """
+        self.timestamp = header.timestamp
+        self.body_length = header.body_length
+        self.data_type = header.data_type
+        self.stream_id = header.stream_id
+        self.extended_timestamp = header.extended_timestamp
+
+
 # TODO: This should be based on each header we decode. We need to create encoding rules as well.
 # TODO: This does not function to it's full - it just keep on returning 0xc0 due to the same header being re-used.
 # TODO: We need to make this work on a packet basis as well.
@@ -524,102 +577,102 @@ class RtmpHeaderHandler:
         # Setup the RTMP stream we are working with.
         self._rtmp_stream = rtmp_stream
 
-        # Merged chunk stream headers dictionary.
-        self._merged_chunk_streams_header = {}
+        # The state of each chunk stream we write to and read from, keyed by the chunk stream id.
+        self._write_chunk_streams = {}
+        self._read_chunk_streams = {}
+
+        # The trace callback, trace(event, details), given the headers which are encoded and decoded.
+        # Nothing is traced when this is None.
+        self.trace = None
+
+        # The number of bytes the last header decoded (see decode_from_stream) took up in the stream.
+        self.decoded_header_size = 0
+
+    def get_read_state(self, chunk_stream_id):
+        """
+        Returns the state of a chunk stream we are reading from.
 
-    def _merge_headers(self, original_header, next_header):
+        :param chunk_stream_id: int
+        :return: L{ChunkStreamState} or None if no message has been read on the chunk stream yet.
         """
-        Returns the merged header from the original header by comparing the missing parts in the next header
-        and copying over the parts that are necessary.
+        return self._read_chunk_streams.get(chunk_stream_id)
 
-        NOTE: The original header should be an up-to-date version of the current status of headers in the chunk stream.
+    def update_read_state(self, message_header, timestamp_delta):
+        """
+        Updates the state of the chunk stream we are reading from with the header of the message
+        which was started on it.
 
-        :param original_header: L(RtmpHeader)
-        :param next_header: L(RtmpHeader)
+        :param message_header: L{RtmpHeader} the full (merged) header of the message.
+        :param timestamp_delta: int the timestamp delta which was applied to the message.
         """
-        print('Merging headers.')
+        chunk_stream_state = self._read_chunk_streams.get(message_header.chunk_stream_id)
+        if chunk_stream_state is None:
+            chunk_stream_state = self._read_chunk_streams[message_header.chunk_stream_id] = ChunkStreamState()
 
-        # Since the packets are on the same streams, we can copy over missing information.
-        if original_header.chunk_stream_id == next_header.chunk_stream_id:
-            print('On the same chunk stream.')
-            if original_header != next_header:
+        chunk_stream_state.update(message_header)
+        chunk_stream_state.timestamp_delta = timestamp_delta
 
-                if next_header.timestamp == -1:
-                    next_header.timestamp = original_header.timestamp
-                    print('assumed timestamp')
+    @staticmethod
+    def _merge_headers(chunk_stream_state, next_header):
+        """
+        Copies over the parts of the header which were not set from the state of the chunk stream.
 
-                if next_header.body_length == -1:
-                    next_header.body_length = original_header.body_length
-                    print('assumed body_length')
+        NOTE: The chunk stream state should be an up-to-date version of the current status of headers in the
+              chunk stream.
 
-                if next_header.data_type == -1:
-                    next_header.data_type = original_header.data_type
-                    print('assumed data_type')
+        :param chunk_stream_state: L(ChunkStreamState)
+        :param next_header: L(RtmpHeader)
+        """
+        if next_header.timestamp == -1:
+            next_header.timestamp = chunk_stream_state.timestamp
 
-                if next_header.stream_id == -1:
-                    next_header.stream_id = original_header.stream_id
-                    print('assumed stream_id')
+        if next_header.body_length == -1:
+            next_header.body_length = chunk_stream_state.body_length
 
-                print('Merging complete.')
+        if next_header.data_type == -1:
+            next_header.data_type = chunk_stream_state.data_type
 
-                # We can now store the latest header information for that chunk stream to the merged headers dictionary.
-                self._merged_chunk_streams_header[str(original_header.chunk_stream_id)] = next_header
-            else:
-                print('Headers are the same, no need to merge headers.')
-        else:
-            print('The chunk streams were different, we can not merge.')
+        if next_header.stream_id == -1:
+            next_header.stream_id = chunk_stream_state.stream_id
 
     @staticmethod
-    def _get_chunk_type(latest_full_header, header_to_encode):
+    def _get_chunk_type(chunk_stream_state, header_to_encode, timestamp_delta):
         """
-        Returns the number of bytes needed to encode the header based on the differences between the two.
+        Returns the smallest chunk type (as the mask) which can be used to start sending a message, based on the
+        differences between the header and the last header we sent on the chunk stream.
 
-        NOTE: Both headers must be from the same chunk stream in order for this to work.
-              By comparing the size of the header we need to encode into the stream, we can reduce overhead in formats
+        NOTE: By comparing the size of the header we need to encode into the stream, we can reduce overhead in formats
               by only writing the necessary parts of the header.
 
-        :param latest_full_header: the last full header that we received in this chunk stream.
-        @type latest_full_header: L{RtmpHeader}
+        :param chunk_stream_state: the state of the chunk stream the header is sent on.
+        @type chunk_stream_state: L{ChunkStreamState}
         :param header_to_encode: the header we need to encode into the RTMP stream.
         @type header_to_encode: L{RtmpHeader}
+        :param timestamp_delta: int the difference between the header's timestamp and the last timestamp sent.
         """
-        # If the header is not on the same chunk stream then we cannot get a mask.
-        if latest_full_header.chunk_stream_id == header_to_encode.chunk_stream_id:
-            # If the header we just received and the header previous to it is identical,
-            # then it is an RTMP message in chunks.
+        # If the stream id are not the same, then this indicates the use of a Type 0 message.
+        # A message stream is being used on the RTMP stream. The timestamp can only go backwards with a Type 0.
+        if chunk_stream_state.stream_id != header_to_encode.stream_id or timestamp_delta < 0:
+            # Return that size corresponds to a type 0 header.
+            return 0x00
+
+        # If the message type id or the body size changed, then we need a Type 1 header with both of them.
+        if chunk_stream_state.data_type != header_to_encode.data_type \
+                or chunk_stream_state.body_length != header_to_encode.body_length:
+            # Return that size corresponds to a type 1 header.
+            return 0x40  # 64
+
+        # If the timestamp delta is the same as the one used for the last message then send via Type 3,
+        # we do not need to send a type 2 since the timestamp delta is the same.
+        if timestamp_delta == chunk_stream_state.timestamp_delta:
             # Return that size corresponds to a type 3 header.
-            if latest_full_header is header_to_encode:
-                return 0xc0  # 192
-            else:
-                # If the stream id are not the same, then this indicates the use of a Type 0 message.
-                # A message stream is being used on the RTMP stream.
-                if latest_full_header.stream_id != header_to_encode.stream_id:
-                    # Return that size corresponds to a type 0 header.
-                    return 0x00
-
-                # If the previous header and the new headers message type id match and they have the same body size,
-                # then send the chunk as Type 2, this saves space on the stream.
-                # header.body_size, header.timestamp
-                if latest_full_header.data_type == header_to_encode.data_type \
-                        and latest_full_header.body_length == header_to_encode.body_length:
-                    # If the old header's timestamp and the new_header's timestamp match then send via Type 3,
-                    # we do not need to send a type 2 since the timestamp delta is the same.
-                    if latest_full_header.timestamp == header_to_encode.timestamp:
-                        # Return that size corresponds to a type 3 header.
-                        return 0xc0  # 192
-
-                    # If the body size is the same we can send via Type 2.
-                    # Return that size corresponds to a type 2 header.
-                    return 0x80  # 128
-
-                # Return that size corresponds to a type 1 header.
-                return 0x40  # 64
-        else:
-            # raise HeaderError('chunk_stream_id mismatch on diff old=%r, new=%r' %
-            #                   (latest_full_header, header_to_encode))
-            return None
+            return 0xc0  # 192
 
-    def encode_into_stream(self, encode_header):
+        # Only the timestamp delta changed so we can send via Type 2.
+        # Return that size corresponds to a type 2 header.
+        return 0x80  # 128
+
+    def encode_into_stream(self, encode_header, rtmp_stream=None, continuation=False):
         """
         Encodes an RTMP header to C{stream}.
 
@@ -642,200 +695,229 @@ class RtmpHeaderHandler:
         NOTE: We keep on altering the value of the header's format until we recognise
               which header format it truly is.
 
-        NOTE: When we use the previous header from the previous parameter, this is only to be used to
-              to compare messages in which it's body has been split into chunks.
+        NOTE: The header's timestamp is the absolute timestamp of the message, the smallest chunk type is chosen
+              from the last header sent on the chunk stream and the timestamp delta is written
+              for the types 1 and 2 (and implied by type 3).
 
         :param encode_header: The header to encode into the RTMP stream.
         @type encode_header: L{RtmpHeader}
+        :param rtmp_stream: The stream to write the header into (default None - the handler's RTMP stream).
+        :param continuation: bool True if the header is for a chunk which continues the body of the message
+                             (default False - the header starts a new message).
         """
+        if rtmp_stream is None:
+            rtmp_stream = self._rtmp_stream
+
         # Retrieve the channel id from the header's chunk stream id attribute.
         chunk_stream_id = encode_header.chunk_stream_id
 
-        print(self._merged_chunk_streams_header)
-        # TODO: Implement a method of getting the latest full header from this chunk stream id.
-        if str(chunk_stream_id) in self._merged_chunk_streams_header:
-            print('chunk stream information available in merged chunk streams header for chunk stream id',
-                  chunk_stream_id)
-            latest_full_header = self._merged_chunk_streams_header[str(chunk_stream_id)]
-            mask = self._get_chunk_type(latest_full_header, encode_header)
-
-            # In a separate thread, merge the new header with the one we have saved to update the stream information.
-            # threading.Thread(target=self._merge_headers, args=(latest_full_header, encode_header)).start()
-            self._merge_headers(latest_full_header, encode_header)
-        else:
-            # Save the new header at the start of the chunk stream to use the next time we encode a header.
-            self._merged_chunk_streams_header[str(chunk_stream_id)] = encode_header
+        chunk_stream_state = self._write_chunk_streams.get(chunk_stream_id)
 
-            print('chunk stream header information not in merged headers for chunk stream id:', chunk_stream_id)
-            mask = 0
+        if continuation and chunk_stream_state is not None:
+            # The chunks which continue the body of a message only ever have a type 3 header.
+            timestamp_delta = chunk_stream_state.timestamp_delta
+            mask = 0xc0
 
-        print('Encoding mask:', mask)
+        elif chunk_stream_state is not None:
+            # Fill in the parts of the header which were not set from the chunk stream.
+            self._merge_headers(chunk_stream_state, encode_header)
 
-        # TODO: Implement the use of previous headers here.
-        # if previous is None:
-        #     mask = 0
-        # else:
-        #     # TODO: Get mask procedure name.
-        #     # TODO: We could use a continuation field here.
-        #     # TODO: 'read_format' to 'mask' or 'header_mask'.
-        #     mask = get_size_mask(previous, header)
+            if self.trace is not None:
+                self.trace(types.TRACE_HEADER_MERGED, {
+                    'chunk_stream_id': chunk_stream_id,
+                    'header': encode_header
+                })
 
-        # print('Previous header: %r Chunk type: %s chunk stream id: %s' % (previous, mask, chunk_stream_id))
+            timestamp_delta = encode_header.timestamp - chunk_stream_state.timestamp
+            mask = self._get_chunk_type(chunk_stream_state, encode_header, timestamp_delta)
+        else:
+            # Start the state of the chunk stream, to use the next time we encode a header.
+            chunk_stream_state = self._write_chunk_streams[chunk_stream_id] = ChunkStreamState()
+            timestamp_delta = 0
+            mask = 0
+
+        # A type 3 chunk straight after a type 0 chunk uses the absolute timestamp as its delta.
+        if mask == 0x00:
+            timestamp_delta = encode_header.timestamp
 
         # Set the encoding mask as the encode header's chunk type.
         encode_header.chunk_type = mask
 
-        # Write the encoding mask into the RTMP stream.
-        if chunk_stream_id < 64:  # <= 63
-            self._rtmp_stream.write_uchar(mask | chunk_stream_id)
-        elif chunk_stream_id < 320:  # <=319
-            self._rtmp_stream.write_uchar(mask)
-            self._rtmp_stream.write_uchar(chunk_stream_id - 64)
+        # Write the encoded header into the RTMP stream in one go.
+        if mask == 0xc0:
+            rtmp_stream.write(self._pack_continuation_header(chunk_stream_id, chunk_stream_state))
         else:
-            chunk_stream_id -= 64
+            rtmp_stream.write(self._pack_header(mask, chunk_stream_id, encode_header, timestamp_delta))
+            chunk_stream_state.extended_timestamp = encode_header.extended_timestamp
+
+        # Keep the latest header information for the chunk stream.
+        chunk_stream_state.timestamp = encode_header.timestamp
+        chunk_stream_state.timestamp_delta = timestamp_delta
+        chunk_stream_state.body_length = encode_header.body_length
+        chunk_stream_state.data_type = encode_header.data_type
+        chunk_stream_state.stream_id = encode_header.stream_id
+
+        if self.trace is not None:
+            self.trace(types.TRACE_HEADER_ENCODED, {
+                'chunk_stream_id': chunk_stream_id,
+                'chunk_type': mask,
+                'header': encode_header
+            })
 
-            self._rtmp_stream.write_uchar(mask + 1)
-            self._rtmp_stream.write_uchar(chunk_stream_id & 0xff)
-            self._rtmp_stream.write_uchar(chunk_stream_id >> 0x08)
+        # TODO: RECORD HEADER - since this header is in the same chunk stream, we can re-use this header and merge
+        #       with the one we are trying to encode.
 
-        # TODO: We should not be encoding depending on sections, we need to decode based on format - branching.
-        # TODO: We could branch by the encode_header.chunk_type now.
+        # TODO: Verify at encode_header end-point that a True was returned from encoding the header.
+        # log.info('Header encoded:', repr(encoded_header))
+        # print('Header encoded:', repr(encoded_header))
 
-        # This is a Type 3 (0xC0) header, we do not need to write the stream id, message size or
-        # timestamp delta since they are not present in this type of message.
-        if mask == 0xc0:
-            # TODO: Added format information in rtmp_header.encode.
-            # Set header chunk type to Type 3 (0xc0).
-            # encode_header.chunk_type = types.HEADER_TYPE_3_CONTINUATION
+    @staticmethod
+    def _pack_basic_header(mask, chunk_stream_id):
+        """
+        Packs the basic header, the chunk stream id can be written in one, two or three bytes.
 
-            return
+        :param mask: int the chunk type mask (0x00, 0x40, 0x80 or 0xc0).
+        :param chunk_stream_id: int the chunk stream id.
+        :return: str the packed basic header.
+        """
+        if chunk_stream_id < 64:  # <= 63
+            return _BASIC_HEADER_1.pack(mask | chunk_stream_id)
+        elif chunk_stream_id < 320:  # <= 319
+            return _BASIC_HEADER_2.pack(mask, chunk_stream_id - 64)
         else:
+            chunk_stream_id -= 64
+            return _BASIC_HEADER_3.pack(mask | 1, chunk_stream_id & 0xff, chunk_stream_id >> 0x08)
 
-            # This applies to all header which is Type 2 (0x80) or smaller.
-            # Write the timestamp, if it fits, elsewhere state we need an extended timestamp and write it later.
-            if mask == 0x80:
-                # We only need to write the timestamp delta for this type of header.
-
-                # Write the timestamp delta.
-                # NOTE: If the timestamp delta is greater than or equal to the value 16777215,
-                #       then we need to extend the timestamp with another field at the end of the header.
-                if encode_header.timestamp >= 0xffffff:
-                    self._rtmp_stream.write_24bit_uint(0xffffff)
-                else:
-                    # Otherwise write the timestamp delta.
-                    self._rtmp_stream.write_24bit_uint(encode_header.timestamp)
-
-                # Set to state that we sent a timestamp delta,
-                encode_header.timestamp_delta = True
-
-                # TODO: Added chunk type information in rtmp_header.encode.
-                # Set header chunk type to Type 2 (0x80).
-                # encode_header.chunk_type = types.HEADER_TYPE_2_SAME_LENGTH_AND_STREAM
+    def _pack_continuation_header(self, chunk_stream_id, chunk_stream_state):
+        """
+        Packs a type 3 (0xc0) header, we do not need to write the stream id, message size or
+        timestamp delta since they are not present in this type of message.
 
-            # This applies to headers which are Type 1 (0x40) or smaller.
-            # Write message length, followed by the message type id.
-            elif mask == 0x40:
-                # We will need to write the timestamp delta, body length and data type
-                # for this type of header.
+        NOTE: The extended timestamp of the previous header on the chunk stream is repeated after the basic header,
+              the same as what the RtmpReader expects (see the WORKAROUND in RtmpReader.read_chunk).
 
-                # Write the timestamp delta.
-                # NOTE: See above branch for mask type 0x80.
-                if encode_header.timestamp >= 0xffffff:
-                    self._rtmp_stream.write_24bit_uint(0xffffff)
-                else:
-                    # Otherwise write the timestamp delta.
-                    self._rtmp_stream.write_24bit_uint(encode_header.timestamp)
+        :param chunk_stream_id: int the chunk stream id.
+        :param chunk_stream_state: L{ChunkStreamState} the state of the chunk stream.
+        :return: str the packed header.
+        """
+        packed_header = self._pack_basic_header(0xc0, chunk_stream_id)
 
-                # Write the body length.
-                self._rtmp_stream.write_24bit_uint(encode_header.body_length)  # message length
+        if chunk_stream_state.extended_timestamp not in (None, -1):
+            packed_header += _EXTENDED_TIMESTAMP.pack(chunk_stream_state.extended_timestamp)
 
-                # Write the data type.
-                self._rtmp_stream.write_uchar(encode_header.data_type)  # message type id
+        return packed_header
 
-                # Set to state that we are sending a timestamp delta.
-                encode_header.timestamp_delta = True
+    def _pack_header(self, mask, chunk_stream_id, encode_header, timestamp):
+        """
+        Packs a type 0, 1 or 2 header with the precompiled header structures.
 
-                # TODO: Added format information in rtmp_header.encode.
-                # Set header chunk type to Type 1.
-                # encode_header.chunk_type = types.HEADER_TYPE_1_SAME_STREAM
+        NOTE: The timestamp_delta/timestamp_absolute and extended_timestamp attributes of the header are updated
+              to match what was packed.
 
-            # This applies if the chunk type is Type 0 (0x00).
-            # Write the stream id.
-            elif mask == 0x00:
-                # We will need to write an absolute timestamp, body length, data type
-                # and stream id for this type of packet.
+        :param mask: int the chunk type mask (0x00, 0x40 or 0x80).
+        :param chunk_stream_id: int the chunk stream id.
+        :param encode_header: L{RtmpHeader} the header to pack.
+        :param timestamp: int the absolute timestamp (type 0) or timestamp delta (types 1 and 2) to write.
+        :return: str the packed header.
+        """
+        packed_header = self._pack_basic_header(mask, chunk_stream_id)
 
-                # Write the absolute timestamp.
-                # NOTE: See above branch for mask type 0x80.
-                if encode_header.timestamp >= 0xffffff:
-                    self._rtmp_stream.write_24bit_uint(0xffffff)
-                else:
-                    # Otherwise write the timestamp delta.
-                    self._rtmp_stream.write_24bit_uint(encode_header.timestamp)
+        # NOTE: If the timestamp (absolute or delta) is greater than or equal to the value 16777215,
+        #       then we need to extend the timestamp with another field at the end of the header.
+        if timestamp >= 0xffffff:
+            header_timestamp = 0xffffff
+        else:
+            header_timestamp = timestamp
 
-                # Write the body length.
-                self._rtmp_stream.write_24bit_uint(encode_header.body_length)  # message length
+        if mask == 0x80:
+            # We only need to write the timestamp delta for this type of header.
+            packed_header += _TIMESTAMP.pack(header_timestamp >> 16, header_timestamp & 0xffff)
 
-                # Write the data type.
-                self._rtmp_stream.write_uchar(encode_header.data_type)  # message type id
+            # Set to state that we sent a timestamp delta,
+            encode_header.timestamp_delta = True
+        else:
+            # Types 1 and 0 have the timestamp (delta or absolute), body length and data type.
+            body_length = encode_header.body_length
+            packed_header += _TIMESTAMP_LENGTH_TYPE.pack(header_timestamp >> 16, header_timestamp & 0xffff,
+                                                         body_length >> 16, body_length & 0xffff,
+                                                         encode_header.data_type)
 
-                # Write the stream id.
-                self._rtmp_stream.endian = '<'
-                self._rtmp_stream.write_ulong(encode_header.stream_id)
-                self._rtmp_stream.endian = '!'
+            if mask == 0x40:
+                # Set to state that we are sending a timestamp delta.
+                encode_header.timestamp_delta = True
+            else:
+                # Only type 0 has the stream id.
+                packed_header += _STREAM_ID.pack(encode_header.stream_id)
 
                 # Set to state that we are sending an absolute timestamp.
                 encode_header.timestamp_absolute = True
 
-                # TODO: Added chunk stream information in rtmp_header.encode.
-                # Set header chunk type to Type 0.
-                # encode_header.chunk_type = types.HEADER_TYPE_0_FULL
+        # If the timestamp we wrote was too large, write it's true value in the extended timestamp field.
+        if timestamp >= 0xffffff:
+            packed_header += _EXTENDED_TIMESTAMP.pack(timestamp)
 
-            # If the timestamp (absolute or delta) we wrote into the stream was greater than or equal to
-            # the value 16777215, then we need to write it's true value in this extended timestamp field.
-            # This is only applicable to types 0, 1 or 2 (not 3 as it does not feature a timestamp).
-            if encode_header.timestamp >= 0xffffff:
-                # Write the extended timestamp.
-                self._rtmp_stream.write_ulong(encode_header.timestamp)
+            # TODO: Should the extended timestamp be a boolean value?
+            encode_header.extended_timestamp = timestamp
+        else:
+            encode_header.extended_timestamp = None
 
-                # TODO: Should the extended timestamp be a boolean value?
-                encode_header.extended_timestamp = encode_header.timestamp
-            else:
-                encode_header.extended_timestamp = None
+        return packed_header
 
-        # TODO: RECORD HEADER - since this header is in the same chunk stream, we can re-use this header and merge
-        #       with the one we are trying to encode.
+    def encode(self, encode_header, continuation=False):
+        """
+        Encodes an RTMP header in the same way as encode_into_stream, returning the encoded header
+        rather than writing it into the RTMP stream.
 
-        # TODO: Verify at encode_header end-point that a True was returned from encoding the header.
-        # log.info('Header encoded:', repr(encoded_header))
-        # print('Header encoded:', repr(encoded_header))
+        :param encode_header: The header to encode.
+        @type encode_header: L{RtmpHeader}
+        :param continuation: bool True if the header is for a chunk which continues the body of the message.
+        :return: str the encoded header.
+        """
+        header_stream = pyamf.util.BufferedByteStream()
+        self.encode_into_stream(encode_header, header_stream, continuation)
+        return header_stream.getvalue()
+
+    def _read(self, length):
+        """
+        Reads exactly the length of data given from the RTMP stream.
+
+        :param length: int the number of bytes to read.
+        :return: str the data read.
+        """
+        data = self._rtmp_stream.read(length)
+        if len(data) != length:
+            raise IOError('Expected %s header bytes but only read %s.' % (length, len(data)))
+        return data
 
     def decode_from_stream(self):
         """
         Reads a header from the incoming stream.
 
         NOTE: A header can be of varying lengths and the properties that
-              gets updated depend on its length.
+              gets updated depend on its length. The chunk type in the basic header tells us the length of the rest
+              of the header, so it is read and unpacked in one go with the precompiled header structures.
 
         :return decoded_header: The read header from the RTMP stream.
         @rtype: L{RtmpHeader}
         """
         # Read chunk type and chunk stream id.
-        chunk_stream_id = self._rtmp_stream.read_uchar()
+        chunk_stream_id = ord(self._read(1))
         chunk_type = chunk_stream_id >> 6
+        header_size = 1
 
         # Set the chunk stream mask.
         chunk_stream_id &= 0x3f
 
-        # log.debug('Header type (format): %s Read chunk_stream_id: %s' % (header_type, chunk_stream_id))
-
         # We need one more byte.
         if chunk_stream_id is 0:
-            chunk_stream_id = self._rtmp_stream.read_uchar() + 64
+            chunk_stream_id = ord(self._read(1)) + 64
+            header_size += 1
 
         # We need two more bytes.
-        if chunk_stream_id is 1:
-            chunk_stream_id = self._rtmp_stream.read_uchar() + 64 + (self._rtmp_stream.read_uchar() << 8)
+        elif chunk_stream_id is 1:
+            low_byte, high_byte = _BASIC_HEADER_2.unpack(self._read(2))
+            chunk_stream_id = low_byte + 64 + (high_byte << 8)
+            header_size += 2
 
         # Initialise a header object and set it up with the chunk stream id.
         decoded_header = RtmpHeader(chunk_stream_id)
@@ -843,79 +925,68 @@ class RtmpHeaderHandler:
         # Apply the decoded header chunk type to the header object.
         decoded_header.chunk_type = chunk_type
 
-        # TODO: We should not be decoding depending on sections, we need to decode based on chunk stream id - branching.
-
-        if decoded_header.chunk_type == types.HEADER_TYPE_3_CONTINUATION:
-            #  TODO: Return the previously recorded headers, otherwise the read loop in
-            #        RtmpReader will continue looping as we do not know the message body size to expect.
-
-            # No header data present, it is a continuation of the same data from the preceding chunks.
+        # No header data present, it is a continuation of the same data from the preceding chunks.
+        if chunk_type == types.HEADER_TYPE_3_CONTINUATION:
+            self.decoded_header_size = header_size
+            if self.trace is not None:
+                self._trace_decoded_header(decoded_header)
             return decoded_header
-        else:
-
-            if decoded_header.chunk_type == types.HEADER_TYPE_2_SAME_LENGTH_AND_STREAM:
-                # Only the timestamp delta is present in this.
 
-                # Read the timestamp delta.
-                decoded_header.timestamp = self._rtmp_stream.read_24bit_uint()
+        message_header = self._read(_MESSAGE_HEADER_SIZES[chunk_type])
+        header_size += _MESSAGE_HEADER_SIZES[chunk_type]
 
-                # Set to state that the timestamp received was a delta.
-                decoded_header.timestamp_delta = True
-
-                # TODO: Make sure we get the previous headers body length.
-
-                # TODO: Make sure we get the previous headers stream id.
-
-            elif decoded_header.chunk_type == types.HEADER_TYPE_1_SAME_STREAM:
-                # Has all the fields except for the stream Id, which remains the same,
-                # when the first type 0 header was sent.
-
-                # Read the timestamp delta.
-                decoded_header.timestamp = self._rtmp_stream.read_24bit_uint()
-
-                # Read the body length.
-                decoded_header.body_length = self._rtmp_stream.read_24bit_uint()
-
-                # Read the data type (message types).
-                decoded_header.data_type = self._rtmp_stream.read_uchar()
+        if chunk_type == types.HEADER_TYPE_2_SAME_LENGTH_AND_STREAM:
+            # Only the timestamp delta is present in this.
+            timestamp_high, timestamp_low = _TIMESTAMP.unpack(message_header)
 
-                # TODO: Make sure we get the previous headers stream id.
+            # Set to state that the timestamp received was a delta.
+            decoded_header.timestamp_delta = True
+        else:
+            # Type 1 has all the fields except for the stream id, which remains the same
+            # from when the first type 0 header was sent. Type 0 has all the fields present in its header.
+            timestamp_high, timestamp_low, length_high, length_low, decoded_header.data_type = \
+                _TIMESTAMP_LENGTH_TYPE.unpack_from(message_header)
+            decoded_header.body_length = (length_high << 16) | length_low
 
+            if chunk_type == types.HEADER_TYPE_1_SAME_STREAM:
                 # Set to state that the timestamp received was a delta.
                 decoded_header.timestamp_delta = True
-
-            elif decoded_header.chunk_type == types.HEADER_TYPE_0_FULL:
-                # This has all the fields present in its header.
-
-                # Read the absolute timestamp.
-                decoded_header.timestamp = self._rtmp_stream.read_24bit_uint()
-
-                # Read the body length.
-                decoded_header.body_length = self._rtmp_stream.read_24bit_uint()
-
-                # Read the data type (message types).
-                decoded_header.data_type = self._rtmp_stream.read_uchar()
-
+            else:
                 # Read the little endian stream id.
-                self._rtmp_stream.endian = '<'
-                decoded_header.stream_id = self._rtmp_stream.read_ulong()
-                self._rtmp_stream.endian = '!'
+                decoded_header.stream_id = _STREAM_ID.unpack_from(message_header, 7)[0]
 
                 # Set to state that the timestamp received was an absolute.
                 decoded_header.timestamp_absolute = True
 
-            # If the timestamp (absolute or delta) we read was greater than or equal to
-            # the value 16777215, we can read the extended timestamp field to get the full timestamp.
-            if decoded_header.timestamp == 0xffffff:
-                # TODO: Should the extended timestamp be a boolean value?
-                decoded_header.extended_timestamp = self._rtmp_stream.read_ulong()
-            else:
-                decoded_header.extended_timestamp = None
+        decoded_header.timestamp = (timestamp_high << 16) | timestamp_low
+
+        # If the timestamp (absolute or delta) we read was greater than or equal to
+        # the value 16777215, we can read the extended timestamp field to get the full timestamp.
+        if decoded_header.timestamp == 0xffffff:
+            # TODO: Should the extended timestamp be a boolean value?
+            decoded_header.extended_timestamp = _EXTENDED_TIMESTAMP.unpack(self._read(4))[0]
+            header_size += 4
+        else:
+            decoded_header.extended_timestamp = None
+
+        self.decoded_header_size = header_size
+        if self.trace is not None:
+            self._trace_decoded_header(decoded_header)
 
-        # log.info('Decoded header:', decoded_header)
-        # print('Decoded header:', repr(header))
         return decoded_header
 
+    def _trace_decoded_header(self, decoded_header):
+        """
+        Gives the decoded header to the trace callback.
+
+        :param decoded_header: L{RtmpHeader}
+        """
+        self.trace(types.TRACE_HEADER_DECODED, {
+            'chunk_stream_id': decoded_header.chunk_stream_id,
+            'chunk_type': decoded_header.chunk_type,
+            'header': decoded_header
+        })
+
 
 # Old version:
 # Make sure we check the channel is in the recorded_headers dictionary and the correct attributes are present.
@@ -4,6 +4,7 @@ import pyamf
 import pyamf.amf0
 import pyamf.amf3
 
+import qrtmp.formats.amf_codec as amf_codec
 import qrtmp.formats.rtmp_header as rtmp_header
 import qrtmp.formats.types as types
 
@@ -41,6 +42,7 @@ class RtmpPacket(object):
         self.header = rtmp_header.RtmpHeader(-1)
         self.body_buffer = None
         self.body = None
+        self._body_is_amf = False
 
         # Handle the packet header.
         if set_header is not None:
@@ -65,7 +67,6 @@ class RtmpPacket(object):
         # DONE: AMF body format attributes (.body_if_amf) if the message received was a command (RPC).
         # Allow the recognition as whether the encoded/decoded was/is AMF (plainly or from a Shared Object).
         # This can only be used once the packet has been initialised.
-        self.body_is_amf = False
         # self.body_is_so = False
 
         # Incoming/outgoing packet descriptor to see if the packet came in from the server or if it is one we are
@@ -76,6 +77,82 @@ class RtmpPacket(object):
         # Handled descriptor to see if the packet was handled by default (otherwise it was not).
         self.handled = False
 
+    # Lazy body decoding:
+    @property
+    def body(self):
+        """
+        The body of the packet, if the body was deferred (see defer_body) it is decoded on the first access
+        and the decoded body is kept from then on.
+
+        :return body: dict the body of the rtmp packet.
+        """
+        if self._body_decoder is not None:
+            self._decode_body()
+        return self._body
+
+    @body.setter
+    def body(self, new_body):
+        """
+        Sets the body of the packet, replacing any body which has not been decoded yet.
+
+        :param new_body: dict the body of the rtmp packet.
+        """
+        self._body_decoder = None
+        self._undecoded_body = None
+        self._body = new_body
+
+    @property
+    def body_is_amf(self):
+        """
+        Whether the body of the packet is AMF formatted, this is only known once the body has been decoded.
+
+        :return: bool True if the body is AMF formatted.
+        """
+        if self._body_decoder is not None:
+            self._decode_body()
+        return self._body_is_amf
+
+    @body_is_amf.setter
+    def body_is_amf(self, is_amf):
+        self._body_is_amf = is_amf
+
+    def defer_body(self, body_decoder, undecoded_body):
+        """
+        Defers decoding the body of the packet until the body (or one of the body convenience methods)
+        is first used, this saves decoding the body of packets which are never looked at.
+
+        :param body_decoder: callable body_decoder(packet, undecoded_body) which sets the body of the packet.
+        :param undecoded_body: bytearray the message body as it was received.
+        """
+        self._body = None
+        self._body_decoder = body_decoder
+        self._undecoded_body = undecoded_body
+
+    def _decode_body(self):
+        """ Decodes the body which was deferred with defer_body. """
+        body_decoder = self._body_decoder
+        undecoded_body = self._undecoded_body
+
+        # Clear the deferred body before decoding, the decoder assigns the body it decoded into the packet.
+        # If the decoder fails, the deferred body is put back so it is not lost (e.g. to be decoded another way).
+        self._body_decoder = None
+        self._undecoded_body = None
+        try:
+            body_decoder(self, undecoded_body)
+        except Exception:
+            self._body = None
+            self._body_decoder = body_decoder
+            self._undecoded_body = undecoded_body
+            raise
+
+    def is_body_decoded(self):
+        """
+        Returns whether the body of the packet has been decoded (or was never deferred).
+
+        :return: bool True if there is no body waiting to be decoded.
+        """
+        return self._body_decoder is None
+
     # DONE: A 'get_type' method should also be added.
     # DONE: Abstract all the essential header variables that we can set e.g. data (message) type, body, timestamp.
     # Packet attribute convenience methods:
@@ -189,6 +266,34 @@ class RtmpPacket(object):
         else:
             return None
 
+    def peek_command(self):
+        """
+        Returns the command name and transaction id of a COMMAND message, if the body has not been decoded yet they
+        are read from the start of it without decoding the rest (see amf_codec.peek_command).
+
+        :return: tuple of the command name and transaction id (None if they are not present).
+        """
+        if self._body_decoder is not None and self.header.data_type == types.DT_COMMAND:
+            command = amf_codec.peek_command(self._undecoded_body)
+            if command is not None:
+                return command[0], int(command[1])
+
+        return self.get_command_name(), self.get_transaction_id()
+
+    def peek_shared_object_name(self):
+        """
+        Returns the name of the shared object a SHARED_OBJECT message is for, if the body has not been decoded yet
+        it is read from the start of it without decoding the rest.
+
+        :return: str the shared object name.
+        """
+        if self._body_decoder is not None and self.header.data_type == types.DT_SHARED_OBJECT:
+            obj_name = amf_codec.peek_name(self._undecoded_body)
+            if obj_name is not None:
+                return obj_name
+
+        return self.body['obj_name']
+
     def get_command_object(self):
         """
         Returns the command object received from the server if the message was a COMMAND
@@ -245,6 +350,41 @@ class RtmpPacket(object):
 
     # DONE: 'setup_packet' -> '.setup()' which will give the packet ready to be sent but also allow the user
     #       to view the packet which has been set up.
+    @staticmethod
+    def write_shared_object_event(event, body_stream):
+        """
+        Writes a shared object event into the body of a shared object message, the event type and the size of
+        the event data are followed by the data.
+
+        :param event: dict of the event type (SO_*) and the data of the event.
+        :param body_stream: PyAMF BufferedByteStream object
+        """
+        event_type = event['type']
+        if event_type in (types.SO_USE, types.SO_RELEASE, types.SO_CLEAR, types.SO_USE_SUCCESS):
+            assert event['data'] == '', event['data']
+            event_data = ''
+
+        elif event_type == types.SO_CHANGE or event_type == types.SO_REQUEST_CHANGE:
+            # The name and value of each attribute which has changed.
+            codec = amf_codec.get_codec()
+            event_data = ''.join(amf_codec.encode_name(attrib_name) + codec.encode([attrib_value])
+                                 for attrib_name, attrib_value in event['data'].iteritems())
+
+        elif event_type == types.SO_SEND_MESSAGE:
+            # The name of the handler followed by its arguments.
+            event_data = amf_codec.get_codec().encode(list(event['data']))
+
+        elif event_type in (types.SO_REMOVE, types.SO_REQUEST_REMOVE, types.SO_SUCCESS):
+            # The name of the attribute.
+            event_data = amf_codec.encode_name(event['data'])
+
+        else:
+            assert False, event
+
+        body_stream.write_uchar(event_type)
+        body_stream.write_ulong(len(event_data))
+        body_stream.write(event_data)
+
     # def setup_packet(self, write_packet):
     def setup(self):
         """
@@ -341,9 +481,13 @@ class RtmpPacket(object):
             # TODO: Connect to NetStream stream id attribute?
             self.header.stream_id = 1
 
-            # Set up the body buffer content.
+            # Set up the body buffer content, the data is a memoryview if it came from a received packet.
+            audio_data = self.body['audio_data']
+            if isinstance(audio_data, memoryview):
+                audio_data = audio_data.tobytes()
+
             temp_buffer.write_uchar(self.body['control'])
-            temp_buffer.write(self.body['audio_data'])
+            temp_buffer.write(audio_data)
 
         elif self.header.data_type == types.DT_VIDEO_MESSAGE:
 
@@ -355,9 +499,20 @@ class RtmpPacket(object):
             # TODO: Connect to NetStream stream id attribute?
             self.header.stream_id = 1
 
-            # Set up the body buffer content.
+            # Set up the body buffer content, the data is a memoryview if it came from a received packet.
+            video_data = self.body['video_data']
+            if isinstance(video_data, memoryview):
+                video_data = video_data.tobytes()
+
             temp_buffer.write_uchar(self.body['control'])
-            temp_buffer.write(self.body['video_data'])
+            temp_buffer.write(video_data)
+
+        elif self.header.data_type == types.DT_AGGREGATE_MESSAGE:
+            # The body is made up of the audio and video messages as FLV tags (see aggregator.MediaAggregator),
+            # the stream id is the one the messages were sent on.
+            self.header.chunk_stream_id = types.RTMP_CUSTOM_VIDEO_CHUNK_STREAM
+
+            temp_buffer.write(self.body['aggregate_data'])
 
         elif self.header.data_type == types.DT_AMF3_COMMAND:
             # NOTE: RtmpHeader.ChunkType.TYPE_0_FULL, ChunkStreamInfo.RTMP_COMMAND_CHANNEL,
@@ -382,47 +537,33 @@ class RtmpPacket(object):
             # The body we encoded was AMF formatted.
             self.body_is_amf = True
 
-        # TODO: Work out how all this data should be iterated and written into the buffer.
-        # elif self.header.data_type == types.DT_DATA_MESSAGE:
-        #     # NOTE: RtmpHeader.ChunkType.TYPE_0_FULL, ChunkStreamInfo.RTMP_COMMAND_CHANNEL,
-        #     #       RtmpHeader.MessageType.DATA_AMF0
-        #
-        #     # Set up the basic header information.
-        #     self.header.chunk_stream_id = types.RTMP_CONNECTION_CHUNK_STREAM
-        #
-        #     encoder = pyamf.amf0.Encoder(temp_buffer)
-        #     # Set up the body content.
-        #     encoder.writeElement(self.body['onMetaData'])
-        #     """
-        #     ('Packet:', {'data_content': [
-        #         {'videoframerate': 24, 'moovposition': 8671904, 'avclevel': 30, 'avcprofile': 66,
-        #          'audiosamplerate': 12000, 'audiocodecid': u'mp4a', 'framerate': 24, 'height': 160, 'width': 240,
-        #          'displayWidth': 240, 'audiochannels': 2, 'frameHeight': 160, 'frameWidth': 240, 'duration': 596.48,
-        #          'displayHeight': 160, 'aacaot': 2, 'videocodecid': u'avc1', 'trackinfo': [
-        #             {'length': 14315, 'language': u'eng', 'timescale': 24,
-        #              'sampledescription': [{'sampletype': u'avc1'}]},
-        #             {'length': 7157760, 'language': u'eng', 'timescale': 12000,
-        #              'sampledescription': [{'sampletype': u'mp4a'}]}]}], 'data_name': u'onMetaData'})
-        #     """
-        #     encoder.writeMixedArray(self.body['metadata'])
-
-        # TODO: How do we include shared objects?
-        # elif write_packet.header.data_type == types.DT_SHARED_OBJECT:
-        #
-        #     # Set up the basic header information.
-        #     self.header.chunk_stream_id = types.RTMP_CONNECTION_CHUNK_STREAM
-        #
-        #     # Set up the body content.
-        #     encoder = pyamf.amf0.Encoder(temp_buffer)
-        #     encoder.serialiseString(self.body['obj_name'])
-        #     temp_buffer.write_ulong(self.body['curr_version'])
-        #     temp_buffer.write(self.body['flags'])
-        #
-        #     for event in self.body['events']:
-        #         self.write_shared_object_event(event, temp_buffer)
-        #
-        #     # The body we encoded was a Shared Object.
-        #     self.body_is_so = True
+        # DONE: The data name is followed by the data content, in the same form the data messages are read.
+        elif self.header.data_type == types.DT_DATA_MESSAGE:
+            # NOTE: RtmpHeader.ChunkType.TYPE_0_FULL, ChunkStreamInfo.RTMP_COMMAND_CHANNEL,
+            #       RtmpHeader.MessageType.DATA_AMF0
+
+            # Set up the basic header information.
+            self.header.chunk_stream_id = types.RTMP_CONNECTION_CHUNK_STREAM
+
+            # Set up the body content, e.g. 'onMetaData' followed by the metadata (a pyamf.MixedArray).
+            temp_buffer.write(amf_codec.get_codec().encode([self.body['data_name']] + list(self.body['data_content'])))
+
+            # The body we encoded was AMF formatted.
+            self.body_is_amf = True
+
+        # DONE: Shared objects are sent with their name, the version of the data we have, the flags and the events.
+        elif self.header.data_type == types.DT_SHARED_OBJECT:
+
+            # Set up the basic header information.
+            self.header.chunk_stream_id = types.RTMP_CONNECTION_CHUNK_STREAM
+
+            # Set up the body content.
+            temp_buffer.write(amf_codec.encode_name(self.body['obj_name']))
+            temp_buffer.write_ulong(self.body['curr_version'])
+            temp_buffer.write(self.body['flags'])
+
+            for event in self.body['events']:
+                self.write_shared_object_event(event, temp_buffer)
 
         # TODO: Is it possible to remove the list, so we can freely add various data structures to the command_object
         #       or options fields without having to place it inside a list all the time
@@ -434,29 +575,31 @@ class RtmpPacket(object):
             # Set up the basic header information.
             self.header.chunk_stream_id = types.RTMP_CONNECTION_CHUNK_STREAM
 
-            # Set up the body content.
-            encoder = pyamf.amf0.Encoder(temp_buffer)
-            # for command in write_packet.body['command']:
-            #     encoder.writeElement(command)
+            options = self.body['options']
+            if type(options) is not list:
+                options = []
 
-            # Write the command name and transaction id, followed by an iteration over the
-            # command object to write the AMF elements.
-            encoder.writeElement(self.body['command_name'])
-            encoder.writeElement(self.body['transaction_id'])
-            # TODO: Iteration over the command object would be an issue here (in the event of the connection packet,
-            #       maybe we should handle all formats and assume the command object is going to be used anyhow).
-            command_object = self.body['command_object']
-            if type(command_object) is list:
-                for command_info in command_object:
-                    encoder.writeElement(command_info)
-            else:
-                # TODO: Allow types which are not iterable to be written on it's own into the stream.
-                encoder.writeElement(command_object)
+            # If the command was made from a template (see amf_codec.CommandTemplate), only the transaction id
+            # and the options are left to encode.
+            template = self.body.get('template')
+            if template is not None:
+                temp_buffer.write(template.encode(self.body['transaction_id'], options))
 
-            options = self.body['options']
-            if type(options) is list:
-                for parameter in options:
-                    encoder.writeElement(parameter)
+            else:
+                # Set up the body content, the command name and transaction id, followed by an iteration over the
+                # command object and the options, are encoded with the AMF0 codec (see amf_codec).
+                values = [self.body['command_name'], self.body['transaction_id']]
+                # TODO: Iteration over the command object would be an issue here (in the event of the connection
+                #       packet, maybe we should handle all formats and assume the command object is going to be used).
+                command_object = self.body['command_object']
+                if type(command_object) is list:
+                    values.extend(command_object)
+                else:
+                    # DONE: Types which are not iterable are written on their own into the stream.
+                    values.append(command_object)
+                values.extend(options)
+
+                temp_buffer.write(amf_codec.get_codec().encode(values))
 
             # DONE: Converted stream information handling into types and to RtmpPacket.
 
@@ -241,13 +241,15 @@ UC_BUFFER_READY = 0x20  # 32
 
 # === Default acknowledgement limit types ===
 
-# INFO:
+# INFO: The limit types of a SET_PEER_BANDWIDTH message, which say how the new output window (bandwidth) is applied.
+
+# INFO: The output window is set to the window size received.
 HARD = 0
 
-# INFO:
+# INFO: The output window is set to the window size received or the current window, whichever is smaller.
 SOFT = 1
 
-# INFO:
+# INFO: Treated as a HARD limit if the previous limit was HARD, otherwise the message is ignored.
 DYNAMIC = 2
 
 
@@ -282,10 +284,30 @@ SO_REMOVE = 0x9  # 9
 
 # Shared Object attribute deletion flag
 SO_REQUEST_MOVE = 0x0A  # 10
+SO_REQUEST_REMOVE = SO_REQUEST_MOVE
 
 # Initial SO data flag
 SO_USE_SUCCESS = 0x0B  # 11
 
+# === Video frame types ===
+
+# INFO: The frame type is the upper 4 bits of the first (control) byte of a video message.
+
+# A keyframe, the frames after it can be decoded without any of the frames before it.
+VF_KEYFRAME = 0x1  # 1
+
+# An inter frame, which can only be decoded along with the frames before it (back to the last keyframe).
+VF_INTER_FRAME = 0x2  # 2
+
+# A disposable inter frame (H.263 only), no other frames depend on it.
+VF_DISPOSABLE_INTER_FRAME = 0x3  # 3
+
+# A generated keyframe (reserved for server use only).
+VF_GENERATED_KEYFRAME = 0x4  # 4
+
+# A video info/command frame.
+VF_COMMAND_FRAME = 0x5  # 5
+
 # TODO: Rename these appropriately.
 # === Header types ===
 
@@ -331,3 +353,14 @@ RTMP_CUSTOM_AUDIO_CHUNK_STREAM = 0x06  # 0x04
 #       This can vary at times and is not the same chunk stream for audio messages, though the video messages
 #       stream id should be the same as the audio messages stream id.
 RTMP_CUSTOM_VIDEO_CHUNK_STREAM = 0x07  # 0x06
+
+# === Trace events ===
+
+# INFO: The events given to the trace callback (if one is set), along with a dictionary of details about the event.
+#       See BaseConnection.set_trace.
+TRACE_HEADER_DECODED = 'header_decoded'  # chunk_stream_id, chunk_type, header
+TRACE_HEADER_ENCODED = 'header_encoded'  # chunk_stream_id, chunk_type (mask), header
+TRACE_HEADER_MERGED = 'header_merged'  # chunk_stream_id, header
+TRACE_CHUNK_READ = 'chunk_read'  # chunk_stream_id, chunk_type, length, received_length, body_length
+TRACE_MESSAGE_READ = 'message_read'  # chunk_stream_id, header
+TRACE_PACKET_SENT = 'packet_sent'  # chunk_stream_id, header, body_length, chunk_size
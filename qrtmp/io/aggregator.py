@@ -0,0 +1,168 @@
+"""
+Packing of the audio and video messages we send into aggregate messages, so a run of media messages is sent as
+one RTMP message (with one set of chunk headers) instead of one message each.
+"""
+
+import struct
+import time
+
+from qrtmp.formats import rtmp_packet
+from qrtmp.formats import types
+from qrtmp.io import shaper
+
+# The FLV tag header each message is written with inside the aggregate message, in the same layout as the
+# flv_manager writes its tags: the data type, the body length (3 bytes), the timestamp (3 bytes) and
+# the upper 8 bits of the timestamp, followed by the stream id (3 bytes, always 0).
+_TAG_HEADER = struct.Struct('>BBHBHB')
+_TAG_STREAM_ID = '\x00\x00\x00'
+_TAG_HEADER_SIZE = 11
+
+# The back pointer (the size of the tag) which follows each tag.
+_BACK_POINTER = struct.Struct('>I')
+
+
+def pack_tag(data_type, timestamp, body):
+    """
+    Packs a message into an FLV tag, along with the back pointer which follows it.
+
+    :param data_type: int the data type (DT_*) of the message.
+    :param timestamp: int the timestamp of the message.
+    :param body: str the body of the message.
+    :return: str
+    """
+    length = len(body)
+    return _TAG_HEADER.pack(data_type, (length >> 16) & 0xff, length & 0xffff, (timestamp >> 16) & 0xff,
+                            timestamp & 0xffff, (timestamp >> 24) & 0xff) + _TAG_STREAM_ID + body + \
+        _BACK_POINTER.pack(_TAG_HEADER_SIZE + length)
+
+
+class MediaAggregator(object):
+    """
+    Collects the consecutive audio and video messages for a stream, to be sent together in an aggregate message
+    once the size or duration of the messages collected reaches the limit, or a message for another stream
+    (or any other type of message) is sent.
+
+    NOTE: The messages collected are held back until then, or until they have been held for the max_duration
+          (see RtmpWriter.send_aggregate_due). RtmpWriter.flush() sends them straight away (e.g. at the end of a file).
+
+    NOTE: The aggregate message body records whether it holds audio and the frame types of the video inside it,
+          the output shaper sends it with the priority of the most important message inside it and only drops it
+          if it holds nothing but inter frames (see shaper.get_packet_priority).
+    """
+
+    def __init__(self, max_size=64 * 1024, max_duration=500, clock=time.time):
+        """
+        :param max_size: int the most bytes of messages (as FLV tags) to put in one aggregate message.
+        :param max_duration: int the most milliseconds between the first and last message in one aggregate message,
+                             and the most milliseconds to hold a message back for.
+        :param clock: callable returning the current time in seconds (default time.time).
+        """
+        self.max_size = max_size
+        self.max_duration = max_duration
+        self._clock = clock
+
+        # The messages collected so far (as FLV tags), their size, the first and last timestamp and the stream id.
+        self._tags = []
+        self._packets = []
+        self._size = 0
+        self._first_timestamp = None
+        self._last_timestamp = None
+        self._stream_id = None
+
+        # What the messages collected hold, along with the time the first of them was collected.
+        self._has_audio = False
+        self._frame_types = set()
+        self._started = None
+
+    def __len__(self):
+        return len(self._packets)
+
+    @staticmethod
+    def can_aggregate(packet):
+        """
+        :param packet: RtmpPacket object
+        :return: bool True if the packet is an audio or video message which can be put in an aggregate message.
+        """
+        return packet.header.data_type == types.DT_AUDIO_MESSAGE or packet.header.data_type == types.DT_VIDEO_MESSAGE
+
+    def add(self, packet):
+        """
+        Collects an audio or video message.
+
+        :param packet: RtmpPacket the message (which has been set up).
+        :return: list of the RtmpPacket objects which are ready to be sent.
+        """
+        timestamp = packet.header.timestamp
+        tag = pack_tag(packet.header.data_type, timestamp, packet.body_buffer)
+
+        ready = []
+        if self._packets and (packet.header.stream_id != self._stream_id or
+                              self._size + len(tag) > self.max_size or
+                              timestamp - self._first_timestamp > self.max_duration or
+                              timestamp < self._last_timestamp):
+            ready.append(self.take())
+
+        if not self._packets:
+            self._first_timestamp = timestamp
+            self._stream_id = packet.header.stream_id
+            self._started = self._clock()
+
+        if packet.header.data_type == types.DT_AUDIO_MESSAGE:
+            self._has_audio = True
+        else:
+            self._frame_types.add(shaper.get_frame_type(packet))
+
+        self._tags.append(tag)
+        self._packets.append(packet)
+        self._size += len(tag)
+        self._last_timestamp = timestamp
+
+        if self._size >= self.max_size:
+            ready.append(self.take())
+
+        return ready
+
+    def get_wait(self):
+        """
+        :return: float the seconds until the messages collected have been held for the max_duration (0.0 if they
+                 should be sent now), or None if no messages have been collected.
+        """
+        if not self._packets:
+            return None
+        return max(self._started + self.max_duration / 1000.0 - self._clock(), 0.0)
+
+    def take(self):
+        """
+        Returns the messages collected so far as one message to send, an aggregate message (or the message itself
+        if only one was collected).
+
+        :return: RtmpPacket or None if no messages have been collected.
+        """
+        if not self._packets:
+            return None
+
+        if len(self._packets) == 1:
+            packet = self._packets[0]
+        else:
+            packet = rtmp_packet.RtmpPacket()
+            packet.set_type(types.DT_AGGREGATE_MESSAGE)
+            packet.set_timestamp(self._first_timestamp)
+            packet.set_stream_id(self._stream_id)
+            packet.body = {
+                'aggregate_data': ''.join(self._tags),
+                'has_audio': self._has_audio,
+                'frame_types': frozenset(self._frame_types)
+            }
+            packet.setup()
+
+        self._tags = []
+        self._packets = []
+        self._size = 0
+        self._first_timestamp = None
+        self._last_timestamp = None
+        self._stream_id = None
+        self._has_audio = False
+        self._frame_types = set()
+        self._started = None
+
+        return packet
@@ -4,6 +4,7 @@ import logging
 import struct
 import time
 
+from qrtmp.formats import amf_codec
 from qrtmp.formats import types
 
 log = logging.getLogger(__name__)
@@ -114,6 +115,23 @@ class NetConnectionMessages:
         self._rtmp_writer.send_packet(ping_response)
 
     # Standard default messages:
+    def send_acknowledgement(self, sequence_number):
+        """
+        Send an ACKNOWLEDGEMENT message.
+
+        :param sequence_number: int the number of bytes received so far.
+        """
+        acknowledgement = self._rtmp_writer.new_packet()
+
+        acknowledgement.set_type(types.DT_ACKNOWLEDGEMENT)
+        acknowledgement.body = {
+            # The sequence number wraps around once it no longer fits in 4 bytes.
+            'sequence_number': sequence_number & 0xFFFFFFFF
+        }
+
+        log.debug('Sending ACKNOWLEDGEMENT to server: %r', acknowledgement)
+        self._rtmp_writer.send_packet(acknowledgement)
+
     # TODO: Convert to RtmpPacket.
     def send_window_ack_size(self, amf_data):
         """
@@ -139,19 +157,22 @@ class NetConnectionMessages:
         Send a 'createStream' request on the RTMP connection channel.
 
         :param command_object: dict (default None) any command information to be sent.
+        :return: int the transaction id the request was sent with.
         """
         create_stream = self._rtmp_writer.new_packet()
 
         create_stream.set_type(types.DT_COMMAND)
         create_stream.body = {
             'command_name': 'createStream',
-            'transaction_id': self._rtmp_writer.transaction_id + 2,
+            'transaction_id': self._rtmp_writer.next_transaction_id(),
             'command_object': command_object,
-            'options': []
+            'options': [],
+            'template': amf_codec.get_command_template('createStream', command_object)
         }
 
         log.debug('Sending createStream to server:', create_stream)
         self._rtmp_writer.send_packet(create_stream)
+        return create_stream.body['transaction_id']
 
     def send_close_stream(self, close_stream_id, command_object=None):
         """
@@ -167,7 +188,7 @@ class NetConnectionMessages:
         close_stream.set_stream_id(close_stream_id)
         close_stream.body = {
             'command_name': 'closeStream',
-            'transaction_id': self._rtmp_writer.transaction_id,
+            'transaction_id': 0,
             'command_object': command_object,
             'options': []
         }
@@ -0,0 +1,231 @@
+""" Tracking of the remote procedure calls made on the NetConnection, matching each reply to the call it answers. """
+
+import heapq
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# The command names of the replies to a remote procedure call.
+RESULT = '_result'
+ERROR = '_error'
+
+
+class TransactionTimeout(Exception):
+    """ Raised if no reply to a remote procedure call was received in time. """
+
+
+class TransactionError(Exception):
+    """ Raised if the server replied to a remote procedure call with an _error. """
+
+    def __init__(self, reply):
+        """
+        :param reply: RtmpPacket the _error reply from the server.
+        """
+        Exception.__init__(self, 'The server replied with an error: %r' % (reply.get_response(),))
+        self.reply = reply
+
+
+class Transaction(object):
+    """
+    A remote procedure call which is waiting for the server to reply, the reply can be checked for
+    with done() and result() or given to a callback once it has been received.
+    """
+    __slots__ = ('transaction_id', 'procedure_name', 'deadline', '_callbacks', '_done', '_reply', '_error')
+
+    def __init__(self, transaction_id, procedure_name, deadline=None):
+        """
+        :param transaction_id: int the transaction id the call was sent with.
+        :param procedure_name: str the name of the remote procedure.
+        :param deadline: float the time (time.time()) by which the reply must be received (default None - no deadline).
+        """
+        self.transaction_id = transaction_id
+        self.procedure_name = procedure_name
+        self.deadline = deadline
+
+        self._callbacks = []
+        self._done = False
+        self._reply = None
+        self._error = None
+
+    def add_done_callback(self, callback):
+        """
+        Adds a callback to call with the transaction once the reply has been received (or the call failed),
+        it is called straight away if the transaction is already done.
+
+        :param callback: callable callback(transaction).
+        """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def done(self):
+        """
+        :return: bool True if the reply has been received or the call failed.
+        """
+        return self._done
+
+    def result(self):
+        """
+        Returns the reply from the server.
+
+        :return: RtmpPacket the _result reply, or None if the transaction is not done yet.
+        """
+        if self._error is not None:
+            raise self._error
+        return self._reply
+
+    def exception(self):
+        """
+        :return: the exception the call failed with, or None.
+        """
+        return self._error
+
+    def set_reply(self, reply):
+        """
+        Completes the transaction with the reply from the server, an _error reply fails the transaction.
+
+        :param reply: RtmpPacket the _result or _error reply.
+        """
+        if reply.peek_command()[0] == ERROR:
+            self.set_exception(TransactionError(reply))
+        else:
+            self._reply = reply
+            self._complete()
+
+    def set_exception(self, exception):
+        """
+        :param exception: the exception the call failed with.
+        """
+        self._error = exception
+        self._complete()
+
+    def _complete(self):
+        """ Marks the transaction as done and calls the callbacks. """
+        self._done = True
+
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as ex:
+                log.error('Transaction %s callback failed: %s' % (self.transaction_id, ex))
+
+    def __repr__(self):
+        return '<Transaction %s %s done=%s>' % (self.transaction_id, self.procedure_name, self._done)
+
+
+class TransactionTable(object):
+    """ The remote procedure calls which are waiting for a reply, keyed by their transaction id. """
+
+    def __init__(self):
+        self._pending = {}
+
+        # The deadlines of the transactions, as (deadline, transaction id), the soonest deadline first.
+        self._deadlines = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, transaction):
+        """
+        :param transaction: L{Transaction} the call which was sent.
+        """
+        self._pending[transaction.transaction_id] = transaction
+        if transaction.deadline is not None:
+            heapq.heappush(self._deadlines, (transaction.deadline, transaction.transaction_id))
+
+    def get(self, transaction_id):
+        """
+        :param transaction_id: int
+        :return: L{Transaction} or None if there is no call waiting with the transaction id.
+        """
+        return self._pending.get(transaction_id)
+
+    def resolve(self, received_packet):
+        """
+        Completes the transaction the packet replies to, if it is a reply (_result or _error) to a pending call.
+
+        NOTE: Only the command name and transaction id are read from the packet (see RtmpPacket.peek_command),
+              so the body of a packet which is not a reply is left to be decoded when it is used.
+
+        :param received_packet: RtmpPacket a command message received from the server.
+        :return: bool True if the packet was the reply to a pending call.
+        """
+        command_name, transaction_id = received_packet.peek_command()
+        if command_name not in (RESULT, ERROR):
+            return False
+
+        transaction = self._pending.pop(transaction_id, None)
+        if transaction is None:
+            return False
+
+        transaction.set_reply(received_packet)
+        return True
+
+    def cancel(self, transaction_id, exception):
+        """
+        Fails the pending call with the transaction id given.
+
+        :param transaction_id: int
+        :param exception: the exception to fail the call with.
+        :return: bool True if there was a pending call with the transaction id.
+        """
+        transaction = self._pending.pop(transaction_id, None)
+        if transaction is None:
+            return False
+
+        transaction.set_exception(exception)
+        return True
+
+    def next_deadline(self):
+        """
+        :return: float the soonest deadline of the pending calls, or None if none of them have a deadline.
+        """
+        while self._deadlines:
+            deadline, transaction_id = self._deadlines[0]
+
+            # Skip the calls which have been answered already.
+            transaction = self._pending.get(transaction_id)
+            if transaction is not None and transaction.deadline == deadline:
+                return deadline
+            heapq.heappop(self._deadlines)
+
+        return None
+
+    def expire(self, now=None):
+        """
+        Fails the pending calls whose deadline has passed with a L{TransactionTimeout}.
+
+        :param now: float the current time (default None - time.time()).
+        :return: list of the L{Transaction} objects which timed out.
+        """
+        if now is None:
+            now = time.time()
+
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, transaction_id = heapq.heappop(self._deadlines)
+
+            # The call may have been answered already, or the transaction id may have been re-used.
+            transaction = self._pending.get(transaction_id)
+            if transaction is not None and transaction.deadline == deadline:
+                del self._pending[transaction_id]
+                transaction.set_exception(TransactionTimeout('No reply to %s (transaction %s) was received in time.' %
+                                                             (transaction.procedure_name, transaction_id)))
+                expired.append(transaction)
+
+        return expired
+
+    def fail_all(self, exception):
+        """
+        Fails every pending call, e.g. once the connection has been closed.
+
+        :param exception: the exception to fail the calls with.
+        """
+        pending, self._pending = self._pending, {}
+        self._deadlines = []
+
+        for transaction in pending.values():
+            transaction.set_exception(exception)
@@ -11,16 +11,47 @@ RTMP Specification V1.0: http://wwwimages.adobe.com/content/dam/Adobe/en/devnet/
 # TODO: Information regarding background and authors.
 
 import logging
+import struct
 
 import pyamf
 import pyamf.amf0
 import pyamf.amf3
 
+from qrtmp.formats import amf_codec
+from qrtmp.formats import rtmp_header
 from qrtmp.formats import rtmp_packet
 from qrtmp.formats import types
 
 log = logging.getLogger(__name__)
 
+# The header of each sub-message in an aggregate message (the same layout as an FLV tag header): the data type,
+# the body length (3 bytes), the timestamp (3 bytes), the upper 8 bits of the timestamp and the stream id (3 bytes).
+_AGGREGATE_HEADER = struct.Struct('>BHBHBBHB')
+_AGGREGATE_HEADER_SIZE = 11
+
+# The size of the back pointer (the size of the previous sub-message) which follows each sub-message.
+_AGGREGATE_BACK_POINTER_SIZE = 4
+
+
+class AggregateMessages(object):
+    """
+    The messages inside an aggregate message, they are split out of it (see RtmpReader.iter_aggregate) every time
+    they are iterated over, so they can be iterated over more than once.
+    """
+
+    def __init__(self, rtmp_reader, aggregate_header, aggregate_body):
+        """
+        :param rtmp_reader: RtmpReader the reader which read the aggregate message.
+        :param aggregate_header: RtmpHeader the header of the aggregate message.
+        :param aggregate_body: bytearray the body of the aggregate message.
+        """
+        self._rtmp_reader = rtmp_reader
+        self._aggregate_header = aggregate_header
+        self._aggregate_body = aggregate_body
+
+    def __iter__(self):
+        return self._rtmp_reader.iter_aggregate(self._aggregate_header, self._aggregate_body)
+
 
 class RtmpReader:
     """ This class reads RTMP messages from a stream. """
@@ -41,8 +72,40 @@ class RtmpReader:
         # Set default read chunk size.
         self.chunk_size = 128
 
-        # Initialise the previous header which we can refer to, in order to decode the next header.
-        self._previous_header = None
+        # The number of bytes of the chunks read so far (headers included), each chunk is counted once it has
+        # been read whole, so this only ever covers the data which has been consumed.
+        self.bytes_read = 0
+
+        # The messages which are still being reassembled on each chunk stream, every entry holds the message
+        # header, the body (allocated to the full body length) and the number of bytes received so far.
+        # An entry is removed as soon as its message is complete.
+        self._partial_messages = {}
+
+        # The trace callback, trace(event, details), given the chunks and messages which are read.
+        # Nothing is traced when this is None.
+        self.trace = None
+
+        # Chunk payloads are read straight into the message body if the stream supports it.
+        self._stream_readinto = getattr(rtmp_stream, 'readinto', None)
+
+        # The decoders for the body of each message data type, the media decoders are looked up
+        # just as quickly as the control message decoders.
+        self._decoders = {
+            types.DT_SET_CHUNK_SIZE: self._decode_set_chunk_size,
+            types.DT_ABORT: self._decode_abort,
+            types.DT_ACKNOWLEDGEMENT: self._decode_acknowledgement,
+            types.DT_USER_CONTROL: self._decode_user_control,
+            types.DT_WINDOW_ACKNOWLEDGEMENT_SIZE: self._decode_window_acknowledgement_size,
+            types.DT_SET_PEER_BANDWIDTH: self._decode_set_peer_bandwidth,
+            types.DT_AUDIO_MESSAGE: self._decode_audio,
+            types.DT_VIDEO_MESSAGE: self._decode_video,
+            types.DT_AMF3_SHARED_OBJECT: self._decode_amf3_shared_object,
+            types.DT_AMF3_COMMAND: self._decode_amf3_command,
+            types.DT_DATA_MESSAGE: self._decode_data,
+            types.DT_SHARED_OBJECT: self._decode_shared_object,
+            types.DT_COMMAND: self._decode_command,
+            types.DT_AGGREGATE_MESSAGE: self._decode_aggregate
+        }
 
     def __iter__(self):
         """
@@ -51,72 +114,181 @@ class RtmpReader:
         """
         return self
 
-    # TODO: Not properly decoding headers may result in the loop decoding here until a restart.
-    # TODO: Read packet and the actual decoding of the packet should be in two different sections.
-    def decode_rtmp_stream(self):
+    def _merge_chunk_header(self, chunk_header):
         """
-        Decodes the header and body from the RTMP stream.
+        Returns the full message header for a chunk header which starts a new message, filling in the fields
+        that the chunk type leaves out from the latest header on the same chunk stream.
 
-        :return decoded_header, decoded_body:
+        NOTE: The timestamp of the merged header is always the absolute timestamp of the message, the deltas
+              sent in type 1, 2 and 3 chunks are added onto the timestamp of the previous message.
+
+        :param chunk_header: L{RtmpHeader} the header decoded from the RTMP stream.
+        :return: tuple of the merged L{RtmpHeader} and the timestamp delta that was applied.
         """
-        # TODO: Simplify (if we can) the header decode and read process.
-        # The message may span a number of chunks (each one with its own header).
-        # message_body = []
-        msg_body_len = 0
+        chunk_stream_id = chunk_header.chunk_stream_id
+
+        # The latest message header on the chunk stream is what the compressed chunk types (1, 2 and 3)
+        # inherit their missing fields from.
+        chunk_stream_state = self._rtmp_header_handler.get_read_state(chunk_stream_id)
+
+        # Use the extended timestamp if the timestamp field could not hold the full value.
+        timestamp = chunk_header.timestamp
+        if chunk_header.extended_timestamp is not None and chunk_header.extended_timestamp != -1:
+            timestamp = chunk_header.extended_timestamp
+
+        if chunk_header.chunk_type == types.HEADER_TYPE_0_FULL:
+            merged_header = rtmp_header.RtmpHeader(chunk_stream_id, timestamp, chunk_header.body_length,
+                                                   chunk_header.data_type, chunk_header.stream_id)
+            # A type 3 chunk straight after a type 0 chunk uses the absolute timestamp as its delta.
+            timestamp_delta = timestamp
+        else:
+            if chunk_stream_state is None:
+                raise rtmp_header.HeaderError('Chunk type %s received on chunk stream %s without a previous header.'
+                                              % (chunk_header.chunk_type, chunk_stream_id))
 
-        # decoded_header = rtmp_header.decode(self._rtmp_stream)
-        decoded_header = self._rtmp_header_handler.decode_from_stream()
-        decoded_body = pyamf.util.BufferedByteStream()
+            # A type 3 chunk which starts a new message re-uses the timestamp delta of the previous message.
+            if chunk_header.chunk_type == types.HEADER_TYPE_3_CONTINUATION:
+                timestamp_delta = chunk_stream_state.timestamp_delta
+            else:
+                timestamp_delta = timestamp
 
-        log.debug('read_packet() header %s' % decoded_header)
-        print('Decoded header: %s' % decoded_header)
+            merged_header = rtmp_header.RtmpHeader(chunk_stream_id, chunk_stream_state.timestamp + timestamp_delta,
+                                                   chunk_stream_state.body_length, chunk_stream_state.data_type,
+                                                   chunk_stream_state.stream_id)
 
-        # TODO: Work out how the 'previous_header' really functions.
-        # if decoded_header.data_type == -1:
-        #     decoded_header = self.previous_header
+            # Type 1 headers also carry the body length and the data type of the new message.
+            if chunk_header.chunk_type == types.HEADER_TYPE_1_SAME_STREAM:
+                merged_header.body_length = chunk_header.body_length
+                merged_header.data_type = chunk_header.data_type
 
-        # TODO: Temporary fix to the body length being -1 due to a CONTINUATION header type 3 being received.
-        if (decoded_header.data_type is -1) or (decoded_header.body_length is -1):
-            decoded_header = self._previous_header
-        self._previous_header = decoded_header
+        merged_header.chunk_type = chunk_header.chunk_type
+        merged_header.extended_timestamp = chunk_header.extended_timestamp
+        merged_header.timestamp_absolute = True
 
-        # Loop and read the content of the message until we exceed or equal the expected message body size.
-        while True:
-            # TODO: Rename 'read_bytes'.
-            # The read bytes will allow us to see the length of data we need to read from the stream.
-            # We keep on passing in the body length of the full message and the
-            read_bytes = min(decoded_header.body_length - msg_body_len, self.chunk_size)
-
-            # Compare the message body length with the bytes read.
-            # message_body.append(self.stream.read(read_bytes))
-            # TODO: Removed the use of the list, we can use the append function in pyamf BufferedByteStream.
-            decoded_body.append(self._rtmp_stream.read(read_bytes))
-
-            msg_body_len += read_bytes
-            if msg_body_len >= decoded_header.body_length:
-                break
+        return merged_header, timestamp_delta
 
-            # Decode the next header from the RTMP stream.
-            # next_header = rtmp_header.decode(self._rtmp_stream)
-            next_header = self._rtmp_header_handler.decode_from_stream()
+    def read_chunk(self):
+        """
+        Reads a single chunk from the RTMP stream and adds its payload to the message which is in flight on its
+        chunk stream. Messages on different chunk streams may be interleaved with one another, so a partial body is
+        kept for each chunk stream until the message is complete.
+
+        NOTE: The state of the reader is only updated once the whole chunk has been read, so if reading from the
+              stream fails part way through the chunk, the stream can be rewound and the chunk read again later.
+
+        :return: tuple of the decoded header and the decoded body (a bytearray) if this chunk completed
+                 a message, otherwise None.
+        """
+        chunk_header = self._rtmp_header_handler.decode_from_stream()
+        chunk_stream_id = chunk_header.chunk_stream_id
+        chunk_size = self._rtmp_header_handler.decoded_header_size
+
+        partial_message = self._partial_messages.get(chunk_stream_id)
+
+        if chunk_header.chunk_type == types.HEADER_TYPE_3_CONTINUATION:
+            chunk_stream_state = self._rtmp_header_handler.get_read_state(chunk_stream_id)
 
-            # TODO: Evaluate the need for this; is this consistent with all RTMP implementations?
             # WORKAROUND: Even though the RTMP specification states that the extended timestamp
             #             field DOES NOT follow type 3 chunks, it seems that Flash player 10.1.85.3
             #             and Flash Media Server 3.0.2.217 send and expect this field here.
-            if decoded_header.timestamp >= 0x00ffffff:
-                self._rtmp_stream.read_ulong()
+            if chunk_stream_state is not None and chunk_stream_state.extended_timestamp not in (None, -1):
+                chunk_header.extended_timestamp = self._rtmp_stream.read_ulong()
+                chunk_size += 4
+
+        if chunk_header.chunk_type != types.HEADER_TYPE_3_CONTINUATION or partial_message is None:
+            if partial_message is not None:
+                log.warning('Discarding incomplete message on chunk stream %s: %r' %
+                            (chunk_stream_id, partial_message[0]))
+
+            message_header, timestamp_delta = self._merge_chunk_header(chunk_header)
+            message_body = bytearray(message_header.body_length)
+            received_length = 0
+        else:
+            message_header, message_body, received_length = partial_message
+            timestamp_delta = None
+
+        # Read the payload of this chunk, which is at most the size of one chunk, into its place in the body.
+        read_bytes = min(message_header.body_length - received_length, self.chunk_size)
+        self._read_into(memoryview(message_body)[received_length:received_length + read_bytes])
+        received_length += read_bytes
+
+        if self.trace is not None:
+            self.trace(types.TRACE_CHUNK_READ, {
+                'chunk_stream_id': chunk_stream_id,
+                'chunk_type': chunk_header.chunk_type,
+                'length': read_bytes,
+                'received_length': received_length,
+                'body_length': message_header.body_length
+            })
+
+        # The whole chunk has been read, we can now commit the changes to the chunk stream's state.
+        self.bytes_read += chunk_size + read_bytes
+        if timestamp_delta is not None:
+            self._rtmp_header_handler.update_read_state(message_header, timestamp_delta)
+
+        if received_length < message_header.body_length:
+            self._partial_messages[chunk_stream_id] = (message_header, message_body, received_length)
+            return None
+
+        # The message is complete, we only need to keep the partial messages which are still in flight.
+        self._partial_messages.pop(chunk_stream_id, None)
+        return message_header, message_body
+
+    def _read_into(self, body_view):
+        """
+        Fills the given part of a message body with data from the RTMP stream.
 
-            # TODO: Assertion tests to see if the next header we get is generated with the constant -1 (default) values.
-            assert next_header.timestamp == -1, (decoded_header, next_header)
-            assert next_header.body_length == -1, (decoded_header, next_header)
-            assert next_header.data_type == -1, (decoded_header, next_header)
-            assert next_header.stream_id == -1, (decoded_header, next_header)
+        :param body_view: memoryview of the part of the message body to fill.
+        """
+        read_bytes = len(body_view)
+
+        if self._stream_readinto is None:
+            chunk_payload = self._rtmp_stream.read(read_bytes)
+            if len(chunk_payload) != read_bytes:
+                raise IOError('Tried to read %d byte(s) of chunk payload from the stream' % read_bytes)
+            body_view[:] = chunk_payload
+            return
+
+        # The stream may return less than we asked for, so keep reading until the view has been filled.
+        filled = 0
+        while filled < read_bytes:
+            received = self._stream_readinto(body_view[filled:])
+            if not received:
+                raise IOError('Tried to read %d byte(s) of chunk payload from the stream' % read_bytes)
+            filled += received
+
+    def abort_message(self, chunk_stream_id):
+        """
+        Discards the partially received message on the given chunk stream, this is the action we should
+        take after receiving an ABORT message.
 
-        # Make sure the body length we read is equal to the expected body length from the RTMP header.
-        assert decoded_header.body_length == msg_body_len, (decoded_header, msg_body_len)
+        :param chunk_stream_id: int the chunk stream id of the message to discard.
+        :return: boolean True if there was a message in flight on the chunk stream, otherwise False.
+        """
+        return self._partial_messages.pop(chunk_stream_id, None) is not None
 
-        # decoded_body = pyamf.util.BufferedByteStream(''.join(message_body))
+    # TODO: Read packet and the actual decoding of the packet should be in two different sections.
+    def decode_rtmp_stream(self):
+        """
+        Decodes the header and body of the next complete message from the RTMP stream.
+
+        NOTE: Chunks from other chunk streams may arrive in between the chunks of a message, these are
+              reassembled separately and the first message to be completed is returned.
+
+        :return decoded_header, decoded_body:
+        """
+        while True:
+            complete_message = self.read_chunk()
+            if complete_message is not None:
+                break
+
+        decoded_header, decoded_body = complete_message
+
+        if self.trace is not None:
+            self.trace(types.TRACE_MESSAGE_READ, {
+                'chunk_stream_id': decoded_header.chunk_stream_id,
+                'header': decoded_header
+            })
 
         return decoded_header, decoded_body
 
@@ -140,7 +312,7 @@ class RtmpReader:
             assert so_body_size == 0, so_body_size
             event['data'] = ''
 
-        elif event['type'] == types.SO_CHANGE:
+        elif event['type'] == types.SO_CHANGE or event['type'] == types.SO_REQUEST_CHANGE:
             start_pos = body_stream.tell()
             changes = {}
             while body_stream.tell() < start_pos + so_body_size:
@@ -165,9 +337,16 @@ class RtmpReader:
             assert so_body_size == 0, so_body_size
             event['data'] = ''
 
-        elif event['type'] == types.SO_REMOVE:
+        elif event['type'] in (types.SO_REMOVE, types.SO_REQUEST_REMOVE, types.SO_SUCCESS):
+            # The name of the attribute which was (or is to be) removed, or of which the change was accepted.
             event['data'] = decoder.readString()
 
+        elif event['type'] == types.SO_STATUS:
+            event['data'] = {
+                'code': decoder.readString(),
+                'level': decoder.readString()
+            }
+
         elif event['type'] == types.SO_USE_SUCCESS:
             assert so_body_size == 0, so_body_size
             event['data'] = ''
@@ -177,217 +356,267 @@ class RtmpReader:
 
         return event
 
-    # TODO: Statistics element to each packet in the generation process, the number of the packet and the time in which
-    #       it was received by the client.
-    def generate_packet(self, decoded_header, decoded_body):
-        """
-        Generate an RtmpPacket based on the header and body we decoded from the RTMP stream.
-        :param decoded_header:
-        :param decoded_body:
-        :return: The generated RtmpPacket or None if the packet could not be generated.
+    def register_decoder(self, data_type, decoder):
         """
-        # TODO: Include in the ret, distinctly, the header and the body.
-        # Decode the message based on the data-type present in the header.
-        # Initialise an RTMP packet instance, to store the information we received,
-        # by providing the header.
-        received_packet = rtmp_packet.RtmpPacket(decoded_header)
-
-        # Given the header message type id (data_type), let us decode the message body appropriately.
-        # TODO: Re-organise these branches to match that of the RtmpWriters.
-        if received_packet.header.data_type == types.DT_SET_CHUNK_SIZE:
-
-            received_packet.body = {
-                'chunk_size': decoded_body.read_ulong()
-            }
-
-        elif received_packet.header.data_type == types.DT_ABORT:
-
-            received_packet.body = {
-                'chunk_stream_id': decoded_body.read_ulong()
-            }
-
-        elif received_packet.header.data_type == types.DT_ACKNOWLEDGEMENT:
-
-            # TODO: Make sure we can parse this acknowledgment packet.
-            #       The header has a format of 3 and typically it arrives on chunk stream id 2.
-            #       The body consists of a 'Sequence number' - 7+ (59 bytes) in length.
-
-            received_packet.body = {
-                'sequence_number': decoded_body.read_ulong()
-            }
-
-        elif received_packet.header.data_type == types.DT_USER_CONTROL:
-
-            received_packet.body = {
-                'event_type': decoded_body.read_ushort(),
-                'event_data': decoded_body.read()
-            }
-
-        elif received_packet.header.data_type == types.DT_WINDOW_ACKNOWLEDGEMENT_SIZE:
-
-            received_packet.body = {
-                'window_acknowledgement_size': decoded_body.read_ulong()
-            }
-
-        elif received_packet.header.data_type == types.DT_SET_PEER_BANDWIDTH:
-
-            received_packet.body = {
-                'window_acknowledgement_size': decoded_body.read_ulong(),
-                'limit_type': decoded_body.read_uchar()
-            }
-
-        elif received_packet.header.data_type == types.DT_AUDIO_MESSAGE:
-
-            received_packet.body = {
-                'control': None,
-                'audio_data': None
-            }
+        Registers the decoder to use for the body of messages with the given data type, this replaces any decoder
+        which was already registered for the data type.
 
-            # TODO: Handle in the event that there is no RTMP body in the message.
-            if len(decoded_body) is not 0:
-                received_packet.body['control'] = decoded_body.read_uchar()
-                received_packet.body['audio_data'] = decoded_body.read()
+        NOTE: The decoder is called with the RtmpPacket (which already has the decoded header) and the message body
+              as a bytearray, it should set the body of the packet.
 
-        elif received_packet.header.data_type == types.DT_VIDEO_MESSAGE:
-
-            received_packet.body = {
-                'control': None,
-                'video_data': None
-            }
-
-            # TODO: Handle in the event that there is no RTMP body in the message.
-            if len(decoded_body) is not 0:
-                received_packet.body['control'] = decoded_body.read_uchar()
-                received_packet.body['video_data'] = decoded_body.read()
-
-        elif received_packet.header.data_type == types.DT_AMF3_SHARED_OBJECT:
-
-            decoder = pyamf.amf3.Decoder(decoded_body)
-            obj_name = decoder.readString()
-            curr_version = decoded_body.read_ulong()
-            flags = decoded_body.read(8)
-
-            # A shared object message may contain a number of events.
-            events = []
-            while not decoded_body.at_eof():
-                so_event = self.read_shared_object_event(decoded_body, decoder)
-                events.append(so_event)
-
-            received_packet.body = {
-                'obj_name': obj_name,
-                'curr_version': curr_version,
-                'flags': flags,
-                'events': events
-            }
-
-            # The body we decoded was a Shared Object.
-            received_packet.body_is_so = True
+        :param data_type: int the message data type id.
+        :param decoder: callable decoder(received_packet, decoded_body).
+        """
+        self._decoders[data_type] = decoder
 
-        # TODO: Implement similarly to AMF3_COMMAND.
-        elif received_packet.header.data_type == types.DT_AMF3_COMMAND:
+    @staticmethod
+    def _get_body_stream(decoded_body):
+        """
+        Returns the message body as a byte stream which the body can be decoded from.
 
-            decoder = pyamf.amf3.Decoder(decoded_body)
-            # commands = []
-            received_packet.body = {
-                'command_name': decoder.readElement(),
-                'transaction_id': decoder.readElement(),
-                'response': []
-            }
+        :param decoded_body: bytearray, memoryview (e.g. of a message inside an aggregate message) or
+                             PyAMF BufferedByteStream
+        :return: PyAMF BufferedByteStream
+        """
+        if isinstance(decoded_body, bytearray):
+            return pyamf.util.BufferedByteStream(str(decoded_body))
+        elif isinstance(decoded_body, memoryview):
+            return pyamf.util.BufferedByteStream(decoded_body.tobytes())
+        return decoded_body
 
-            # TODO: Test to see if we are able to use readElement when handling multiple objects.
-            # We can keep on trying to decode an element in the byte content,
-            # until the position of the indicator is at the end of the stream of data.
-            # commands.append()
+    @staticmethod
+    def _get_body_bytes(decoded_body):
+        """
+        Returns the message body as a string, for the AMF0 codec to decode.
 
-            # TODO: How should we handle the command object in this case? We can assume it will be a null type,
-            #       however, there maybe exceptions where may get iterable content? Can we check what read as an
-            #       element?
-            # command_message['command_object'] = None
-            while not decoded_body.at_eof():
-                # commands.append(decoder.readElement())
-                # command_message['response'].append(decoder.readElement())
-                received_packet.body['response'].append(decoder.readElement())
+        :param decoded_body: bytearray, memoryview or PyAMF BufferedByteStream
+        :return: str
+        """
+        if isinstance(decoded_body, bytearray):
+            return str(decoded_body)
+        elif isinstance(decoded_body, memoryview):
+            return decoded_body.tobytes()
+        return decoded_body.read()
+
+    def _decode_set_chunk_size(self, received_packet, decoded_body):
+        received_packet.body = {
+            'chunk_size': self._get_body_stream(decoded_body).read_ulong()
+        }
+
+    def _decode_abort(self, received_packet, decoded_body):
+        received_packet.body = {
+            'chunk_stream_id': self._get_body_stream(decoded_body).read_ulong()
+        }
+
+    def _decode_acknowledgement(self, received_packet, decoded_body):
+        # TODO: Make sure we can parse this acknowledgment packet.
+        #       The header has a format of 3 and typically it arrives on chunk stream id 2.
+        #       The body consists of a 'Sequence number' - 7+ (59 bytes) in length.
+        received_packet.body = {
+            'sequence_number': self._get_body_stream(decoded_body).read_ulong()
+        }
+
+    def _decode_user_control(self, received_packet, decoded_body):
+        body_stream = self._get_body_stream(decoded_body)
+        received_packet.body = {
+            'event_type': body_stream.read_ushort(),
+            'event_data': body_stream.read()
+        }
+
+    def _decode_window_acknowledgement_size(self, received_packet, decoded_body):
+        received_packet.body = {
+            'window_acknowledgement_size': self._get_body_stream(decoded_body).read_ulong()
+        }
+
+    def _decode_set_peer_bandwidth(self, received_packet, decoded_body):
+        body_stream = self._get_body_stream(decoded_body)
+        received_packet.body = {
+            'window_acknowledgement_size': body_stream.read_ulong(),
+            'limit_type': body_stream.read_uchar()
+        }
 
-            # received_packet.body = {
-            #     'command': commands
-            # }
+    @staticmethod
+    def _decode_audio(received_packet, decoded_body):
+        received_packet.body = {
+            'control': None,
+            'audio_data': None
+        }
+
+        # TODO: Handle in the event that there is no RTMP body in the message.
+        if len(decoded_body) is not 0:
+            # The body may be a memoryview (of a message inside an aggregate message), which gives us a str.
+            control = decoded_body[0]
+            received_packet.body['control'] = control if isinstance(control, int) else ord(control)
+            received_packet.body['audio_data'] = memoryview(decoded_body)[1:]
 
-            # received_packet.body = command_message
+    @staticmethod
+    def _decode_video(received_packet, decoded_body):
+        received_packet.body = {
+            'control': None,
+            'video_data': None
+        }
+
+        # TODO: Handle in the event that there is no RTMP body in the message.
+        if len(decoded_body) is not 0:
+            # The body may be a memoryview (of a message inside an aggregate message), which gives us a str.
+            control = decoded_body[0]
+            received_packet.body['control'] = control if isinstance(control, int) else ord(control)
+            received_packet.body['video_data'] = memoryview(decoded_body)[1:]
+
+    def _decode_amf3_shared_object(self, received_packet, decoded_body):
+        self._decode_shared_object_body(received_packet, self._get_body_stream(decoded_body), pyamf.amf3)
+
+        # The body we decoded was a Shared Object.
+        received_packet.body_is_so = True
+
+    def _decode_shared_object(self, received_packet, decoded_body):
+        self._decode_shared_object_body(received_packet, self._get_body_stream(decoded_body), pyamf.amf0)
+
+    def _decode_shared_object_body(self, received_packet, body_stream, amf_module):
+        decoder = amf_module.Decoder(body_stream)
+        obj_name = decoder.readString()
+        curr_version = body_stream.read_ulong()
+        flags = body_stream.read(8)
+
+        # A shared object message may contain a number of events.
+        events = []
+        while not body_stream.at_eof():
+            so_event = self.read_shared_object_event(body_stream, decoder)
+            events.append(so_event)
+
+        received_packet.body = {
+            'obj_name': obj_name,
+            'curr_version': curr_version,
+            'flags': flags,
+            'events': events
+        }
+
+    def _decode_amf3_command(self, received_packet, decoded_body):
+        body_stream = self._get_body_stream(decoded_body)
+        decoder = pyamf.amf3.Decoder(body_stream)
+        received_packet.body = {
+            'command_name': decoder.readElement(),
+            'transaction_id': decoder.readElement(),
+            'response': []
+        }
+
+        # TODO: How should we handle the command object in this case? We can assume it will be a null type,
+        #       however, there maybe exceptions where may get iterable content? Can we check what read as an
+        #       element?
+        # We can keep on trying to decode an element in the byte content,
+        # until the position of the indicator is at the end of the stream of data.
+        while not body_stream.at_eof():
+            received_packet.body['response'].append(decoder.readElement())
+
+        # The body we decoded was AMF formatted.
+        received_packet.body_is_amf = True
+
+    def _decode_data(self, received_packet, decoded_body):
+        values = amf_codec.get_codec().decode(self._get_body_bytes(decoded_body))
+        received_packet.body = {
+            'data_name': values[0],
+            'data_content': values[1:]
+        }
+
+    # TODO: Options and iteration is an issue.
+    # TODO: Will reading the command_object without iteration be an issue?
+    def _decode_command(self, received_packet, decoded_body):
+        # The elements in the body are decoded with the AMF0 codec (see amf_codec), until the end of the body.
+        values = amf_codec.get_codec().decode(self._get_body_bytes(decoded_body))
+        command_message = {
+            'command_name': values[0],
+            'transaction_id': values[1],
+            # TODO: Would we ever need to iterate here over the command_object, or is it only one object?
+            'command_object': values[2],
+            'response': values[3:]
+        }
+
+        received_packet.body = command_message
+
+        # The body we decoded was AMF formatted.
+        received_packet.body_is_amf = True
+
+    def _decode_aggregate(self, received_packet, decoded_body):
+        received_packet.body = {
+            'messages': AggregateMessages(self, received_packet.header, decoded_body)
+        }
+
+    def iter_aggregate(self, aggregate_header, aggregate_body):
+        """
+        Splits an aggregate message into the messages inside it (usually audio, video and data messages),
+        one at a time as they are iterated over.
 
-            # The body we decoded was AMF formatted.
-            received_packet.body_is_amf = True
+        NOTE: The body of each message is a memoryview of the aggregate message body, so nothing is copied.
+              The timestamps of the messages are rebased onto the timestamp of the aggregate message, i.e. the first
+              message has the aggregate message's timestamp and the rest keep their offset from it. The messages
+              have the stream id of the aggregate message.
 
-        elif received_packet.header.data_type == types.DT_DATA_MESSAGE:
+        :param aggregate_header: RtmpHeader the header of the aggregate message.
+        :param aggregate_body: bytearray the body of the aggregate message.
+        :return: generator of the RtmpPacket objects of the messages inside the aggregate message.
+        """
+        body_view = memoryview(aggregate_body)
+        body_length = len(aggregate_body)
 
-            decoder = pyamf.amf0.Decoder(decoded_body)
-            received_packet.body = {
-                'data_name': decoder.readElement(),
-                'data_content': []
-            }
+        position = 0
+        first_timestamp = None
 
-            while not decoded_body.at_eof():
-                received_packet.body['data_content'].append(decoder.readElement())
+        while position + _AGGREGATE_HEADER_SIZE <= body_length:
+            data_type, length_high, length_low, timestamp_high, timestamp_low, timestamp_upper, _, _ = \
+                _AGGREGATE_HEADER.unpack_from(aggregate_body, position)
+            message_length = (length_high << 8) | length_low
+            message_timestamp = (timestamp_upper << 24) | (timestamp_high << 8) | timestamp_low
 
-        elif received_packet.header.data_type == types.DT_SHARED_OBJECT:
+            message_start = position + _AGGREGATE_HEADER_SIZE
+            message_end = message_start + message_length
+            if message_end > body_length:
+                log.warning('Aggregate message is truncated, %s byte(s) of a %s byte message are missing.',
+                            message_end - body_length, message_length)
+                return
 
-            decoder = pyamf.amf0.Decoder(decoded_body)
-            obj_name = decoder.readString()
-            curr_version = decoded_body.read_ulong()
-            flags = decoded_body.read(8)
+            if first_timestamp is None:
+                first_timestamp = message_timestamp
 
-            # A shared object message may contain a number of events.
-            events = []
-            while not decoded_body.at_eof():
-                so_event = self.read_shared_object_event(decoded_body, decoder)
-                events.append(so_event)
+            message_header = rtmp_header.RtmpHeader(aggregate_header.chunk_stream_id,
+                                                    timestamp=(aggregate_header.timestamp + message_timestamp -
+                                                               first_timestamp) & 0xFFFFFFFF,
+                                                    body_length=message_length, data_type=data_type,
+                                                    stream_id=aggregate_header.stream_id)
 
-            received_packet.body = {
-                'obj_name': obj_name,
-                'curr_version': curr_version,
-                'flags': flags,
-                'events': events
-            }
+            yield self.generate_packet(message_header, body_view[message_start:message_end])
 
-        # TODO: Options and iteration is an issue.
-        # TODO: Will reading the command_object without iteration be an issue?
-        elif received_packet.header.data_type == types.DT_COMMAND:
-
-            decoder = pyamf.amf0.Decoder(decoded_body)
-            # commands = []
-            command_message = {
-                'command_name': decoder.readElement(),
-                'transaction_id': decoder.readElement(),
-                # TODO: Would we ever need to iterate here over the command_object, or is it only one object?
-                'command_object': decoder.readElement(),
-                'response': []
-            }
+            position = message_end + _AGGREGATE_BACK_POINTER_SIZE
 
-            # TODO: Test to see if we are able to use readElement when handling multiple objects.
-            # We can keep on trying to decode an element in the byte content,
-            # until the position of the indicator is at the end of the stream of data.
-            # commands.append()
+    # TODO: Statistics element to each packet in the generation process, the number of the packet and the time in which
+    #       it was received by the client.
+    def generate_packet(self, decoded_header, decoded_body):
+        """
+        Generate an RtmpPacket based on the header and body we decoded from the RTMP stream.
 
-            while not decoded_body.at_eof():
-                # commands.append(decoder.readElement())
-                command_message['response'].append(decoder.readElement())
+        NOTE: The body is decoded by the decoder registered for the data type in the header (see register_decoder),
+              apart from audio and video the body is only decoded when the packet body is first used.
+              The audio and video data in the packet body is a memoryview of the decoded body, use tobytes() on it
+              if a copy of the data is needed once the packet is no longer in use.
 
-            # received_packet.body = {
-            #     'command': commands
-            # }
+        :param decoded_header:
+        :param decoded_body: bytearray (or a memoryview of one)
+        :return: The generated RtmpPacket or None if the packet could not be generated.
+        """
+        # Initialise an RTMP packet instance, to store the information we received, by providing the header.
+        received_packet = rtmp_packet.RtmpPacket(decoded_header)
 
-            received_packet.body = command_message
+        # Given the header message type id (data_type), let us decode the message body appropriately.
+        decoder = self._decoders.get(decoded_header.data_type)
 
-            # The body we decoded was AMF formatted.
-            received_packet.body_is_amf = True
+        # TODO: An assertion here to none causes the whole script on the output application to stop.
+        #       We need to display this another way.
+        assert decoder is not None, received_packet
 
+        # Audio and video are cheap to decode (they are only split into the control byte and data) and are
+        # almost always used, every other message is decoded once the body is used.
+        if decoded_header.data_type == types.DT_AUDIO_MESSAGE or decoded_header.data_type == types.DT_VIDEO_MESSAGE:
+            decoder(received_packet, decoded_body)
         else:
-            # TODO: An assertion here to none causes the whole script on the output application to stop.
-            #       We need to display this another way.
-            assert None, received_packet
-
-        # Store the decoded body we received as the body buffer in the packet.
-        # received_packet.body_buffer = decoded_body.read()
+            received_packet.defer_body(decoder, decoded_body)
 
-        log.debug('Generated RtmpPacket: %r' % repr(received_packet))
-        # print('[Read] %s' % repr(received_packet))
         return received_packet
@@ -1,45 +1,171 @@
 """ RTMP Writer """
 
+import logging
+import os
+
 import pyamf
 import pyamf.amf0
 import pyamf.amf3
 
 from qrtmp.formats import rtmp_packet
 from qrtmp.formats import types
+from qrtmp.io import aggregator
+from qrtmp.io import shaper
+
+log = logging.getLogger(__name__)
+
+# The most buffers we can give to a single sendmsg call.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# The number of seconds to wait before trying to send the packets in the shaper's queue again, while the socket
+# can not be written into (see RtmpWriter.can_write).
+WRITE_RETRY_WAIT = 0.01
 
 
 class RtmpWriter:
     """ This class writes RTMP messages into a stream. """
 
-    def __init__(self, rtmp_stream, rtmp_header_handler):
+    def __init__(self, rtmp_stream, rtmp_header_handler, socket_object=None):
         """
         Initialize the RTMP writer and set it to write into the specified stream.
         Set up a default RtmpPacket to use along with it's PyAMF Buffered Byte Stream body.
 
         :param rtmp_stream:
         :param rtmp_header_handler:
+        :param socket_object: the socket underneath the RTMP stream, if there is one (default None).
         """
         # Initialise the RTMP stream.
         self._rtmp_stream = rtmp_stream
 
+        # The socket is only used to send messages with sendmsg in the scatter/gather mode.
+        self._socket_object = socket_object
+
+        # In the scatter/gather mode every message is sent in a single write, made up of the encoded chunk
+        # headers and views of the body, instead of writing each chunk into the stream one by one.
+        self.scatter_gather = False
+
         # Default write chunk size at the beginning of the RTMP stream.
         self.chunk_size = 128
 
         self.transaction_id = 0
 
+        # The trace callback, trace(event, details), given the packets which are sent.
+        # Nothing is traced when this is None.
+        self.trace = None
+
         # Set up the RTMP header handler.
         self._rtmp_header_handler = rtmp_header_handler
 
+        # The output shaper (see shaper.OutputShaper) which the packets are queued in and sent through
+        # in priority order, no faster than the output window allows. Packets are sent straight away when this is None.
+        self.shaper = None
+
+        # Called as queue_blocked(wait) if packets are left in the shaper's queue, where wait is the number of
+        # seconds before send_queued() should be called to send more of them.
+        self.queue_blocked = None
+
+        # While the writer is paused (e.g. the transport's buffer is full) the packets are left in the shaper's queue,
+        # send_queued() should be called once it can be written into again.
+        self.paused = False
+
+        # Called as can_write() before a packet in the shaper's queue is sent, the packets are left in the queue
+        # while it returns False (e.g. the socket's send buffer is full), rather than blocking until they are sent.
+        self.can_write = None
+
+        # The media aggregator (see aggregator.MediaAggregator) which packs consecutive audio and video messages
+        # into aggregate messages before they are sent. Every message is sent on its own when this is None.
+        self.aggregator = None
+
+        # Called as aggregate_held(wait) if messages are left waiting in the aggregator, where wait is the number of
+        # seconds before send_aggregate_due() should be called to send them (if no other message has sent them).
+        self.aggregate_held = None
+
+        # While the writer is corked (see cork) the packets are written into the stream without flushing it,
+        # so they are sent together once it is flushed.
+        self._cork_depth = 0
+
+        # True if packets have been written into the stream since it was last flushed.
+        self.pending = False
+
         self._write_packet = None
         self._send_packet = None
 
-        # TODO: Absolute timestamp and timestamp delta calculation.
+        # DONE: Absolute timestamp and timestamp delta calculation - the header handler works out the timestamp
+        #       delta and the smallest chunk type from the last header sent on the chunk stream.
         # TODO: Make use of the chunk streams we are using to put RTMP rules into effect.
         #       I.e. At start of chunk stream we send a full header chunk type.
 
+    def next_transaction_id(self):
+        """
+        Returns the next transaction id to send a command with, the transaction id is incremented for every
+        command which expects a reply so that the reply can be matched to it.
+
+        :return: int the transaction id.
+        """
+        self.transaction_id += 1
+        return self.transaction_id
+
     def stream_flush(self):
         """ Flush the underlying stream. """
         self._rtmp_stream.flush()
+        self.pending = False
+
+    def flush(self):
+        """
+        Sends everything written into the stream so far, even while the writer is corked
+        (e.g. for a message which should not wait for the rest of the batch), along with the audio and video
+        messages waiting in the aggregator.
+        """
+        self.flush_aggregate()
+        self.stream_flush()
+
+    def flush_aggregate(self):
+        """ Sends the audio and video messages waiting in the aggregator (if there is one). """
+        if self.aggregator is not None and len(self.aggregator) > 0:
+            self._queue_packet(self.aggregator.take())
+
+    def send_aggregate_due(self):
+        """
+        Sends the audio and video messages waiting in the aggregator once they have been held for its max_duration,
+        so they are not held back while no further message is sent.
+
+        :return: float the number of seconds until the messages waiting should be sent, or None if there are none
+                 waiting (any more).
+        """
+        if self.aggregator is None:
+            return None
+
+        wait = self.aggregator.get_wait()
+        if wait == 0.0:
+            self.flush_aggregate()
+            return None
+        return wait
+
+    def cork(self):
+        """
+        Corks the writer, the packets sent until it is uncorked are written into the stream without flushing it,
+        so a batch of them (e.g. the replies to a burst of control messages) are sent in as few writes as possible.
+
+        NOTE: Corking can be nested, the stream is only flushed once the writer has been uncorked as many times.
+        """
+        self._cork_depth += 1
+
+    def uncork(self):
+        """ Uncorks the writer, flushing the packets which were written while it was corked. """
+        self._cork_depth -= 1
+
+        if self._cork_depth == 0 and self.pending:
+            self.stream_flush()
+
+    def _packet_written(self):
+        """ Flushes the stream after a packet has been written into it, unless the writer is corked. """
+        if self._cork_depth:
+            self.pending = True
+        else:
+            self.stream_flush()
 
     @staticmethod
     def new_packet():
@@ -332,35 +458,12 @@ class RtmpWriter:
     @staticmethod
     def write_shared_object_event(event, body_stream):
         """
+        Writes a shared object event into the body of a shared object message (see RtmpPacket.setup).
 
         :param event: dict
         :param body_stream: PyAMF BufferedByteStream object
         """
-        inner_stream = pyamf.util.BufferedByteStream()
-        encoder = pyamf.amf0.Encoder(inner_stream)
-
-        event_type = event['type']
-        if event_type == types.SO_USE:
-            assert event['data'] == '', event['data']
-
-        elif event_type == types.SO_CHANGE:
-            for attrib_name in event['data']:
-                attrib_value = event['data'][attrib_name]
-                encoder.serialiseString(attrib_name)
-                encoder.writeElement(attrib_value)
-
-        elif event['type'] == types.SO_CLEAR:
-            assert event['data'] == '', event['data']
-
-        elif event['type'] == types.SO_USE_SUCCESS:
-            assert event['data'] == '', event['data']
-
-        else:
-            assert False, event
-
-        body_stream.write_uchar(event_type)
-        body_stream.write_ulong(len(inner_stream))
-        body_stream.write(inner_stream.getvalue())
+        rtmp_packet.RtmpPacket.write_shared_object_event(event, body_stream)
 
     # DONE: Allow creation of the RtmpPacket elsewhere and just provide the packet in to send appropriately.
 
@@ -374,22 +477,85 @@ class RtmpWriter:
         Takes care to prepend the necessary headers and split the message into
         appropriately sized chunks.
 
+        NOTE: If there is an output shaper, the packet is queued and sent once the output window allows it,
+              control and command messages are sent before audio and audio before video. Video frames may be
+              dropped if the shaper's queue is full.
+
+        NOTE: If there is a media aggregator, audio and video messages are held back to be sent together in an
+              aggregate message, any other message sends the ones waiting before it. Messages held back for the
+              aggregator's max_duration are sent by send_aggregate_due.
+
         :param packet: RtmpPacket object
         """
-        # print('sending packet')
+        if self.aggregator is not None:
+            if packet.body_buffer is None:
+                packet.setup()
+
+            if self.aggregator.can_aggregate(packet):
+                for ready_packet in self.aggregator.add(packet):
+                    self._queue_packet(ready_packet)
+
+                if self.aggregate_held is not None and len(self.aggregator) > 0:
+                    self.aggregate_held(self.aggregator.get_wait())
+                return
+
+            self.flush_aggregate()
+
+        self._queue_packet(packet)
+
+    def _queue_packet(self, packet):
+        """
+        Sends the packet straight away, or queues it in the output shaper if there is one.
+
+        :param packet: RtmpPacket object
+        """
+        if self.shaper is None:
+            self._send_now(packet)
+            return
 
-        # If the packet was not set up, then make sure we have the body buffer ready to write.
         if packet.body_buffer is None:
-            # print('body buffer was none')
             packet.setup()
 
-            # print('we set up the packet')
+        if not self.shaper.push(packet, shaper.get_wire_size(packet, self.chunk_size)):
+            log.debug('Dropped video frame, the send queue is full: %r', packet)
 
-            # DONE: stream.flush() is called automatically after the packet has been sent.
-            # Flush file-object.
-            self.stream_flush()
+        wait = self.send_queued()
+        if wait and self.queue_blocked is not None:
+            self.queue_blocked(wait)
+
+    def send_queued(self):
+        """
+        Sends the packets waiting in the output shaper's queue, as many of them as the output window allows.
+
+        :return: float the number of seconds to wait before the next packet can be sent, 0.0 if the queue is empty
+                 (or the writer is paused).
+        """
+        while len(self.shaper) > 0 and not self.paused:
+            if self.can_write is not None and not self.can_write():
+                return WRITE_RETRY_WAIT
 
-            # print('flushed stream')
+            if self.shaper.bucket is not None:
+                wait = self.shaper.bucket.consume(self.shaper.peek_size())
+                if wait:
+                    return wait
+
+            self._send_now(self.shaper.pop())
+
+        return 0.0
+
+    def _send_now(self, packet):
+        """
+        Encodes the packet into the stream straight away.
+
+        :param packet: RtmpPacket object
+        """
+        # print('sending packet')
+
+        # If the packet was not set up, then make sure we have the body buffer ready to write.
+        # DONE: stream.flush() is called automatically after the packet has been sent, setting up the packet
+        #       does not write into the stream so there is nothing to flush before it.
+        if packet.body_buffer is None:
+            packet.setup()
 
         # TODO: Sort whether to use the stream id or not, we will only use it at the beginning of a new chunk stream.
         # if send_packet.header.chunk_stream_id not in self.chunk_channels:
@@ -407,6 +573,19 @@ class RtmpWriter:
         #     Set the current timestamp as the timestamp in the header for the RtmpPacket.
         #     send_packet.header.timestamp = self.timestamp
 
+        if self.trace is not None:
+            self.trace(types.TRACE_PACKET_SENT, {
+                'chunk_stream_id': packet.header.chunk_stream_id,
+                'header': packet.header,
+                'body_length': len(packet.body_buffer),
+                'chunk_size': self.chunk_size
+            })
+
+        if self.scatter_gather:
+            use_sendmsg = self._can_sendmsg()
+            self._send_buffers(self._get_chunk_buffers(packet, use_sendmsg), use_sendmsg)
+            return
+
         # Encode the initial header before the main RTMP message.
         # rtmp_header.encode(self._rtmp_stream, packet.header)
         self._rtmp_header_handler.encode_into_stream(packet.header)
@@ -431,7 +610,7 @@ class RtmpWriter:
                 # We provide the previous packet we encoded to provide context into what we are sending.
                 # TODO: The rtmp_stream is None when entering here.
                 # rtmp_header.encode(self._rtmp_stream, packet.header, packet.header)
-                self._rtmp_header_handler.encode_into_stream(packet.header)
+                self._rtmp_header_handler.encode_into_stream(packet.header, continuation=True)
 
         # print('all chunks written')
 
@@ -441,116 +620,308 @@ class RtmpWriter:
         # print('[Written] %s' % repr(send_packet.header))
 
         # TODO: If we do not flush the stream after sending one packet, we might not get the reply after a while.
-        self.stream_flush()
+        self._packet_written()
+
+    def _can_sendmsg(self):
+        """
+        :return: bool True if the messages can be sent straight into the socket with sendmsg, which is only
+                 available from Python 3.3 (on Python 2.7 the chunks are joined and written into the stream).
+        """
+        return not self._cork_depth and self._socket_object is not None and hasattr(self._socket_object, 'sendmsg')
+
+    def _get_chunk_buffers(self, packet, views=True):
+        """
+        Returns the buffers which make up the chunks of the packet, in the order they are sent.
+
+        NOTE: Every chunk after the first has the same (type 3) header, so it is only encoded once.
+
+        :param packet: RtmpPacket object (which has been set up).
+        :param views: bool True for the body of each chunk to be a memoryview of the packet's body buffer,
+                      False for it to be a slice of it (to be joined, which memoryviews can not be in Python 2.7).
+        :return: list of the encoded headers and chunk bodies.
+        """
+        chunk_buffers = [self._rtmp_header_handler.encode(packet.header)]
+
+        body_view = memoryview(packet.body_buffer) if views else packet.body_buffer
+        continuation_header = None
+
+        for i in range(0, packet.header.body_length, self.chunk_size):
+            if i != 0:
+                if continuation_header is None:
+                    continuation_header = self._rtmp_header_handler.encode(packet.header, continuation=True)
+                chunk_buffers.append(continuation_header)
+            chunk_buffers.append(body_view[i:i + self.chunk_size])
+
+        return chunk_buffers
+
+    def _send_buffers(self, buffers, use_sendmsg):
+        """
+        Sends the buffers in as few writes as possible, with a single sendmsg call if the socket supports it,
+        otherwise (or while the writer is corked) by writing the joined buffers into the stream once.
+
+        NOTE: socket.sendmsg does not exist in Python 2.7, so there the message is always joined and written into
+              the stream, which still replaces a write per chunk with one write per message.
+
+        :param buffers: list of str objects, or memoryview objects if sendmsg is used.
+        :param use_sendmsg: bool True to send the buffers with sendmsg (see _can_sendmsg).
+        """
+        if use_sendmsg:
+            # Anything which is already in the stream's buffer must be sent first.
+            self.stream_flush()
+
+            while buffers:
+                sent = self._socket_object.sendmsg(buffers[:IOV_MAX])
+
+                # Drop the buffers which were sent completely and the part of the buffer which was sent partially.
+                sent_buffers = 0
+                while sent_buffers < len(buffers) and sent >= len(buffers[sent_buffers]):
+                    sent -= len(buffers[sent_buffers])
+                    sent_buffers += 1
+                buffers = buffers[sent_buffers:]
+
+                if sent:
+                    buffers[0] = memoryview(buffers[0])[sent:]
+        else:
+            self._rtmp_stream.write(b''.join(buffers))
+            self._packet_written()
 
 
 class FlashSharedObject:
-    """ This class represents a Flash Remote Shared Object. """
+    """
+    This class represents a Flash Remote Shared Object.
+
+    NOTE: The changes made by the server are applied in one pass over each message, the listeners are given one
+          change set per message (see on_sync) rather than a call for every attribute. The changes we make are kept
+          until send_changes is called, only the attributes which have changed are sent.
+    """
 
-    def __init__(self, name):
+    def __init__(self, name, persistent=False):
         """
         Initialize a new Flash Remote SO with a given name and empty data.
 
         NOTE: The data regarding the shared object is located inside the self.data dictionary.
+
+        :param name: str the name of the shared object.
+        :param persistent: bool True if the shared object is kept by the server after the last client releases it.
         """
         self.name = name
+        self.persistent = persistent
         self.data = {}
         self.use_success = False
 
-    # TODO: Convert to RtmpPacket.
+        # The version of the data, every change the server makes increments the version.
+        self.version = 0
+
+        # The attributes we have changed (and removed) which are still to be sent to the server.
+        self._changes = {}
+        self._removed = set()
+
+    def _new_message(self, writer, events):
+        """
+        :param writer: RtmpWriter object
+        :param events: list of the events to send.
+        :return: RtmpPacket the shared object message.
+        """
+        so_message = writer.new_packet()
+        so_message.set_type(types.DT_SHARED_OBJECT)
+        so_message.set_stream_id(0)
+
+        # The first 4 bytes of the flags are 2 for a persistent shared object, the rest are reserved.
+        so_message.body = {
+            'obj_name': self.name,
+            'curr_version': self.version,
+            'flags': '\x00\x00\x00\x02\x00\x00\x00\x00' if self.persistent else '\x00' * 8,
+            'events': events
+        }
+        return so_message
+
+    # DONE: Convert to RtmpPacket.
     def use(self, writer):
         """
         Initialize usage of the SO by contacting the Flash Media Server.
         Any remote changes to the SO should be now propagated to the client.
 
-        :param writer:
+        :param writer: RtmpWriter object
         """
         self.use_success = False
+        writer.send_packet(self._new_message(writer, [{'type': types.SO_USE, 'data': ''}]))
 
-        # msg = {
-        #     'data_type': types.DT_SHARED_OBJECT,
-        #     'curr_version': 0,
-        #     'flags': '\x00\x00\x00\x00\x00\x00\x00\x00',
-        #     'events': [
-        #         {
-        #             'data': '',
-        #             'type': types.SO_USE
-        #         }
-        #     ],
-        #     'obj_name': self.name
-        # }
-
-        so_use = writer.new_packet()
-        so_use.header.data_type = types.DT_SHARED_OBJECT
-
-        so_use.body = {
-            'curr_version': 0,
-            'flags': '\x00\x00\x00\x00\x00\x00\x00\x00',
-            'events': [
-                {
-                  'data': '',
-                  'type': types.SO_USE
-                }
-            ],
-            'obj_name': self.name
-        }
+    def release(self, writer):
+        """
+        Stop using the SO, the server no longer sends us the changes made to it.
+
+        :param writer: RtmpWriter object
+        """
+        self.use_success = False
+        writer.send_packet(self._new_message(writer, [{'type': types.SO_RELEASE, 'data': ''}]))
+
+    def set(self, key, value):
+        """
+        Changes an attribute of the SO, the change is sent with the other changes by send_changes.
+
+        :param key: str the name of the attribute.
+        :param value: the new value of the attribute.
+        """
+        if key in self.data and self.data[key] == value and type(self.data[key]) is type(value):
+            return
 
-        # writer.write(msg)
-        # writer.flush()
+        self.data[key] = value
+        self._changes[key] = value
+        self._removed.discard(key)
 
-        writer.setup_packet(so_use)
+    def remove(self, key):
+        """
+        Removes an attribute of the SO, the removal is sent with the other changes by send_changes.
+
+        :param key: str the name of the attribute.
+        """
+        if key not in self.data:
+            return
+
+        del self.data[key]
+        self._changes.pop(key, None)
+        self._removed.add(key)
+
+    def has_changes(self):
+        """
+        :return: bool True if there are changes which have not been sent.
+        """
+        return bool(self._changes or self._removed)
+
+    def send_changes(self, writer):
+        """
+        Sends the attributes which have changed (or been removed) since the changes were last sent,
+        all of them in a single message.
+
+        :param writer: RtmpWriter object
+        :return: bool True if there were changes to send.
+        """
+        events = []
+        if self._changes:
+            events.append({'type': types.SO_REQUEST_CHANGE, 'data': self._changes})
+        for key in self._removed:
+            events.append({'type': types.SO_REQUEST_REMOVE, 'data': key})
+
+        if not events:
+            return False
+
+        self._changes = {}
+        self._removed = set()
+
+        writer.send_packet(self._new_message(writer, events))
+        return True
+
+    def send_message(self, writer, handler_name, *arguments):
+        """
+        Sends a message to every client using the SO, which calls the handler given with the arguments.
+
+        :param writer: RtmpWriter object
+        :param handler_name: str the name of the handler.
+        :param arguments: the arguments to call the handler with.
+        """
+        writer.send_packet(self._new_message(writer, [{'type': types.SO_SEND_MESSAGE,
+                                                        'data': [handler_name] + list(arguments)}]))
 
     def handle_message(self, message):
         """
         Handle an incoming RTMP message. Check if it is of any relevance for the
         specific SO and process it, otherwise ignore it.
 
-        :param message:
+        :param message: RtmpPacket object
+        :return: bool True if the message was for the SO.
         """
-        if message['data_type'] == types.DT_SHARED_OBJECT and message['obj_name'] == self.name:
-            events = message['events']
-
-            if not self.use_success:
-                assert events[0]['type'] == types.SO_USE_SUCCESS, events[0]
-                assert events[1]['type'] == types.SO_CLEAR, events[1]
-                events = events[2:]
-                self.use_success = True
-
-            self.handle_events(events)
-            return True
-        else:
+        if message.header.data_type not in (types.DT_SHARED_OBJECT, types.DT_AMF3_SHARED_OBJECT) or \
+                message.body['obj_name'] != self.name:
             return False
 
+        self.version = message.body['curr_version']
+        self.handle_events(message.body['events'])
+        return True
+
     def handle_events(self, events):
         """
-        Handle SO events that target the specific SO.
+        Handle SO events that target the specific SO, the changes are applied together and given to on_sync
+        as one change set.
+
+        NOTE: A change (or removal) made by the server replaces any change we have made to the attribute which has
+              not been sent.
 
-        :param events:
+        :param events: list of the events in the message.
         """
+        changed = {}
+        deleted = set()
+        cleared = False
+
         for event in events:
             event_type = event['type']
             if event_type == types.SO_CHANGE:
-                for key in event['data']:
-                    self.data[key] = event['data'][key]
-                    self.on_change(key)
+                changes = event['data']
+                self.data.update(changes)
+                changed.update(changes)
+                for key in changes:
+                    deleted.discard(key)
+                    self._changes.pop(key, None)
+                    self._removed.discard(key)
 
             elif event_type == types.SO_REMOVE:
                 key = event['data']
-                assert key in self.data, (key, self.data.keys())
-                del self.data[key]
-                self.on_delete(key)
+                self.data.pop(key, None)
+                changed.pop(key, None)
+                deleted.add(key)
+                self._changes.pop(key, None)
+                self._removed.discard(key)
+
+            elif event_type == types.SO_CLEAR:
+                self.data.clear()
+                changed.clear()
+                deleted.clear()
+                cleared = True
+
+            elif event_type == types.SO_USE_SUCCESS:
+                self.use_success = True
+
+            elif event_type == types.SO_SUCCESS:
+                log.debug('The change to %r in shared object %r was accepted.', event['data'], self.name)
+
+            elif event_type == types.SO_STATUS:
+                log.warning('Shared object %r status: %r', self.name, event['data'])
 
             elif event_type == types.SO_SEND_MESSAGE:
                 self.on_message(event['data'])
+
             else:
-                assert False, event
+                log.warning('Unhandled shared object event: %r', event)
+
+        if changed or deleted or cleared:
+            self.on_sync({
+                'changed': changed,
+                'deleted': list(deleted),
+                'cleared': cleared
+            })
+
+    def on_sync(self, changes):
+        """
+        Handle the changes made to the specific shared object by a message.
+
+        NOTE: By default on_change and on_delete are called for each attribute, so the listeners written for them
+              keep working.
+
+        :param changes: dict of the attributes which changed (with their new values), the names of the attributes
+                        which were deleted and whether the data was cleared first.
+        """
+        for key in changes['changed']:
+            self.on_change(key)
+        for key in changes['deleted']:
+            self.on_delete(key)
 
     @staticmethod
     def on_change(key):
         """
         Handle change events for the specific shared object.
 
-        :param key:
+        NOTE: Deprecated, override on_sync to be given all the changes made by a message at once.
+
+        :param key: str the name of the attribute which changed.
         """
         pass
 
@@ -559,15 +930,16 @@ class FlashSharedObject:
         """
         Handle delete events for the specific shared object.
 
-        :param key:
+        NOTE: Deprecated, override on_sync to be given all the changes made by a message at once.
+
+        :param key: str the name of the attribute which was deleted.
         """
         pass
 
-    @staticmethod
-    def on_message(data):
+    def on_message(self, data):
         """
         Handle message events for the specific shared object.
 
-        :param data:
+        :param data: list of the handler name followed by its arguments.
         """
         pass
@@ -0,0 +1,364 @@
+"""
+Outbound bandwidth shaping, the packets we send are queued in priority order and only sent as fast as the
+output window (bandwidth) the server set with SET_PEER_BANDWIDTH allows.
+"""
+
+import heapq
+import time
+
+from qrtmp.formats import types
+
+# The priorities of the packets waiting to be sent, the lowest is sent first.
+PRIORITY_CONTROL = 0
+PRIORITY_AUDIO = 1
+PRIORITY_VIDEO = 2
+
+# The size of the largest (type 0) chunk header, used to work out how many bytes a packet takes up on the wire.
+MAX_CHUNK_HEADER_SIZE = 12
+
+
+def get_priority(data_type):
+    """
+    Returns the priority to send a packet with, control and command messages are sent before audio and
+    audio is sent before video.
+
+    :param data_type: int the data type (DT_*) of the packet.
+    :return: int PRIORITY_CONTROL, PRIORITY_AUDIO or PRIORITY_VIDEO.
+    """
+    if data_type == types.DT_VIDEO_MESSAGE:
+        return PRIORITY_VIDEO
+    elif data_type == types.DT_AUDIO_MESSAGE:
+        return PRIORITY_AUDIO
+    else:
+        return PRIORITY_CONTROL
+
+
+def get_video_contents(packet):
+    """
+    Returns what a video or aggregate message holds, an aggregate message which was not made by the
+    aggregator.MediaAggregator is taken to hold audio (so it is never dropped).
+
+    :param packet: RtmpPacket the video or aggregate message (which has been set up).
+    :return: tuple of the frame types (VF_*) of the video inside it and whether it holds audio.
+    """
+    if packet.header.data_type == types.DT_AGGREGATE_MESSAGE:
+        return packet.body.get('frame_types', frozenset()), packet.body.get('has_audio', True)
+    return (get_frame_type(packet),), False
+
+
+def get_packet_priority(packet):
+    """
+    Returns the priority to send a packet with (see get_priority), an aggregate message is sent with the priority
+    of the most important message inside it.
+
+    :param packet: RtmpPacket object (which has been set up).
+    :return: int PRIORITY_CONTROL, PRIORITY_AUDIO or PRIORITY_VIDEO.
+    """
+    if packet.header.data_type == types.DT_AGGREGATE_MESSAGE:
+        return PRIORITY_AUDIO if get_video_contents(packet)[1] else PRIORITY_VIDEO
+    return get_priority(packet.header.data_type)
+
+
+def get_wire_size(packet, chunk_size):
+    """
+    Returns (an upper bound of) the number of bytes the packet takes up on the wire.
+
+    :param packet: RtmpPacket object (which has been set up).
+    :param chunk_size: int the chunk size the packet is sent with.
+    :return: int
+    """
+    body_length = packet.header.body_length
+    # Every chunk after the first has a single byte (type 3) header.
+    return MAX_CHUNK_HEADER_SIZE + body_length + max(body_length - 1, 0) // chunk_size
+
+
+class TokenBucket(object):
+    """
+    A token bucket which fills up at the rate given (in bytes per second), up to the burst size.
+    Sending takes tokens out of the bucket and has to wait once the bucket is empty.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time):
+        """
+        :param rate: int the number of bytes which may be sent per second.
+        :param burst: int the most bytes which may be sent at once (default None - the same as the rate).
+        :param clock: callable returning the current time in seconds (default time.time).
+        """
+        self._clock = clock
+
+        self.rate = None
+        self.burst = None
+        self._tokens = None
+        self.set_rate(rate, burst)
+
+        # The bucket starts full.
+        self._tokens = self.burst
+        self._updated = clock()
+
+    def set_rate(self, rate, burst=None):
+        """
+        :param rate: int the number of bytes which may be sent per second.
+        :param burst: int the most bytes which may be sent at once (default None - the same as the rate).
+        """
+        if rate <= 0:
+            raise ValueError('The rate must be greater than 0: %r' % rate)
+
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+
+        if self._tokens is not None:
+            self._tokens = min(self._tokens, self.burst)
+
+    def _fill(self):
+        """ Adds the tokens which have built up since the bucket was last filled. """
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def consume(self, size):
+        """
+        Takes the tokens to send the number of bytes given out of the bucket, if there are enough of them.
+
+        NOTE: A packet larger than the burst size is sent once the bucket is full, leaving the bucket in debt.
+
+        :param size: int the number of bytes to send.
+        :return: float 0.0 if the bytes can be sent now, otherwise the number of seconds to wait before trying again.
+        """
+        self._fill()
+
+        needed = min(size, self.burst)
+        if self._tokens >= needed:
+            self._tokens -= size
+            return 0.0
+
+        return (needed - self._tokens) / self.rate
+
+
+def get_frame_type(packet):
+    """
+    Returns the frame type (VF_*) of a video packet, from the first byte of its body.
+
+    :param packet: RtmpPacket the video packet (which has been set up).
+    :return: int the frame type, or None if the packet has no body.
+    """
+    if not packet.body_buffer:
+        return None
+    return ord(packet.body_buffer[0]) >> 4
+
+
+class OutputShaper(object):
+    """
+    The packets waiting to be sent in priority order, along with the token bucket they are sent through.
+
+    NOTE: The queue can be bounded by its size in bytes, once it is full video frames are dropped rather than
+          letting the latency build up. The disposable inter frames waiting in the queue are dropped first to make
+          space for an inter frame, a disposable inter frame is dropped on its own as nothing depends on it.
+          After an inter frame has been dropped, the rest of the frames on its stream are dropped until the next
+          keyframe (they can not be decoded without it). A keyframe is never
+          dropped, instead the frames waiting in the queue before it on its stream are dropped as it replaces them.
+          Control, command and audio messages are never dropped. An aggregate message is dropped as an inter frame
+          would be, unless it holds audio, a keyframe or a command frame.
+    """
+
+    def __init__(self, bandwidth=None, max_queue_size=None, clock=time.time):
+        """
+        :param bandwidth: int the output window (bytes per second) to send within (default None - no limit).
+        :param max_queue_size: int the most bytes to queue before dropping video frames (default None - no limit).
+        :param clock: callable returning the current time in seconds (default time.time).
+        """
+        self._clock = clock
+
+        # The token bucket the packets are sent through, there is no limit to the sending rate when this is None.
+        self.bucket = None
+        if bandwidth is not None:
+            self.bucket = TokenBucket(bandwidth, clock=clock)
+
+        self.max_queue_size = max_queue_size
+
+        # The packets waiting to be sent, as (priority, order, packet, size) - packets with the same priority
+        # are sent in the order they were queued.
+        self._queue = []
+        self._order = 0
+
+        # The number of bytes waiting in the queue.
+        self.queue_size = 0
+
+        # The stream ids which are dropping their video frames until their next keyframe.
+        self._waiting_keyframe = set()
+
+        # The number of video frames (and the bytes of them) which have been dropped.
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def set_bandwidth(self, bandwidth):
+        """
+        :param bandwidth: int the output window (bytes per second) to send within, None for no limit.
+        """
+        if bandwidth is None:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(bandwidth, clock=self._clock)
+        else:
+            self.bucket.set_rate(bandwidth)
+
+    def get_metrics(self):
+        """
+        :return: dict of the queue length and size along with the number of frames and bytes dropped.
+        """
+        return {
+            'queue_length': len(self._queue),
+            'queue_size': self.queue_size,
+            'max_queue_size': self.max_queue_size,
+            'dropped_frames': self.dropped_frames,
+            'dropped_bytes': self.dropped_bytes
+        }
+
+    def push(self, packet, size):
+        """
+        Queues a packet to send, unless it is a video frame which is dropped to keep within the size of the queue.
+
+        :param packet: RtmpPacket the packet to queue (which has been set up).
+        :param size: int the number of bytes the packet takes up on the wire.
+        :return: bool True if the packet was queued, False if it was dropped.
+        """
+        data_type = packet.header.data_type
+        if (data_type == types.DT_VIDEO_MESSAGE or data_type == types.DT_AGGREGATE_MESSAGE) and \
+                self.max_queue_size is not None:
+            if not self._accept_video(packet, size):
+                self.dropped_frames += 1
+                self.dropped_bytes += size
+                return False
+
+        heapq.heappush(self._queue, (get_packet_priority(packet), self._order, packet, size))
+        self._order += 1
+        self.queue_size += size
+        return True
+
+    def _accept_video(self, packet, size):
+        """
+        Applies the drop policy to a video frame (or an aggregate message).
+
+        :param packet: RtmpPacket the video or aggregate packet.
+        :param size: int the number of bytes the packet takes up on the wire.
+        :return: bool True if the frame should be queued, False if it should be dropped.
+        """
+        stream_id = packet.header.stream_id
+        frame_types, has_audio = get_video_contents(packet)
+
+        if types.VF_KEYFRAME in frame_types or types.VF_GENERATED_KEYFRAME in frame_types:
+            # The stream can be decoded again from this keyframe onwards.
+            self._waiting_keyframe.discard(stream_id)
+            if self.queue_size + size > self.max_queue_size:
+                self._drop_queued_frames(stream_id)
+            return True
+
+        if has_audio or types.VF_COMMAND_FRAME in frame_types:
+            return True
+
+        if stream_id in self._waiting_keyframe:
+            return False
+
+        if self.queue_size + size <= self.max_queue_size:
+            return True
+
+        # Nothing depends on a disposable inter frame, so the frames after it can still be decoded without it.
+        if self._is_disposable(packet):
+            return False
+
+        if self._drop_disposable_frames(self.queue_size + size - self.max_queue_size):
+            return True
+
+        self._waiting_keyframe.add(stream_id)
+        return False
+
+    def _drop_disposable_frames(self, needed):
+        """
+        Drops the disposable inter frames waiting in the queue (the oldest first) to make space for another frame.
+
+        :param needed: int the number of bytes to make space for.
+        :return: bool True if enough space was made, otherwise nothing is dropped.
+        """
+        disposable = [entry for entry in sorted(self._queue, key=lambda entry: entry[1])
+                      if self._is_disposable(entry[2])]
+        if sum(entry[3] for entry in disposable) < needed:
+            return False
+
+        dropped = set()
+        for entry in disposable:
+            if needed <= 0:
+                break
+            dropped.add(entry[1])
+            needed -= entry[3]
+            self.dropped_frames += 1
+            self.dropped_bytes += entry[3]
+            self.queue_size -= entry[3]
+
+        self._queue = [entry for entry in self._queue if entry[1] not in dropped]
+        heapq.heapify(self._queue)
+        return True
+
+    @staticmethod
+    def _is_disposable(packet):
+        """
+        :param packet: RtmpPacket a video or aggregate packet.
+        :return: bool True if the packet only holds disposable inter frames.
+        """
+        frame_types, has_audio = get_video_contents(packet)
+        return not has_audio and bool(frame_types) and set(frame_types) == {types.VF_DISPOSABLE_INTER_FRAME}
+
+    def _drop_queued_frames(self, stream_id):
+        """
+        Drops the video frames waiting in the queue on the stream given, as a new keyframe replaces them.
+
+        :param stream_id: int the stream id of the frames.
+        """
+        queue = []
+        for entry in self._queue:
+            packet = entry[2]
+            if packet.header.stream_id == stream_id and self._is_replaced(packet):
+                self.dropped_frames += 1
+                self.dropped_bytes += entry[3]
+                self.queue_size -= entry[3]
+            else:
+                queue.append(entry)
+
+        heapq.heapify(queue)
+        self._queue = queue
+
+    @staticmethod
+    def _is_replaced(packet):
+        """
+        :param packet: RtmpPacket a packet waiting in the queue.
+        :return: bool True if the packet is video (or an aggregate message of video) which a new keyframe replaces.
+        """
+        data_type = packet.header.data_type
+        if data_type != types.DT_VIDEO_MESSAGE and data_type != types.DT_AGGREGATE_MESSAGE:
+            return False
+
+        frame_types, has_audio = get_video_contents(packet)
+        return not has_audio and types.VF_COMMAND_FRAME not in frame_types
+
+    def peek(self):
+        """
+        :return: RtmpPacket the next packet to send, or None if the queue is empty.
+        """
+        if self._queue:
+            return self._queue[0][2]
+        return None
+
+    def peek_size(self):
+        """
+        :return: int the number of bytes the next packet to send takes up on the wire.
+        """
+        return self._queue[0][3]
+
+    def pop(self):
+        """
+        :return: RtmpPacket the next packet to send (which is removed from the queue).
+        """
+        entry = heapq.heappop(self._queue)
+        self.queue_size -= entry[3]
+        return entry[2]
@@ -1,15 +1,30 @@
 #
 
-import random
+import logging
+import os
 
 
 def create_random_bytes(length):
     """
     Creates random bytes for the handshake.
+
+    NOTE: The handshake payload is now created with handshake.create_payload.
+
     :param length:
     """
-    ran_bytes = ''
-    i, j = 0, 0xff
-    for x in xrange(0, length):
-        ran_bytes += chr(random.randint(i, j))
-    return ran_bytes
+    return os.urandom(length)
+
+
+def create_log_trace(logger, level=logging.DEBUG):
+    """
+    Creates a trace callback (see BaseConnection.set_trace) which logs each trace event.
+
+    :param logger: logging.Logger to log the trace events with.
+    :param level: int the logging level to log the trace events at (default logging.DEBUG).
+    :return: callable trace(event, details)
+    """
+    def log_trace(event, details):
+        if logger.isEnabledFor(level):
+            logger.log(level, '%s %r', event, details)
+
+    return log_trace
@@ -1,10 +1,16 @@
 """ The setup script to install Qrtmp as a package in your Python distribution. """
 
-from distutils.core import setup
+try:
+    from setuptools import setup
+except ImportError:
+    from distutils.core import setup
 
 setup(name='Qrtmp',
       version='0.2.0',
       description='Qrtmp - Quick/Simple RTMP Implementation.',
       author='Goel Biju',
-      packages=['qrtmp']
+      packages=['qrtmp'],
+      install_requires=['PyAMF'],
+      # The asyncio NetConnection needs trollius on Python 2.7, install with: pip install Qrtmp[async]
+      extras_require={'async': ['trollius']}
       )
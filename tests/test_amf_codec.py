@@ -0,0 +1,114 @@
+""" Test that the fast AMF0 codec encodes and decodes the same as PyAMF, and the command templates encoded with it. """
+
+import datetime
+import threading
+
+import pyamf
+import pyamf.util
+
+import qrtmp.formats.amf_codec as amf_codec
+import qrtmp.formats.rtmp_header as rtmp_header
+import qrtmp.io.rtmp_writer as rtmp_writer
+from qrtmp.base.net_connection import NetConnection
+
+
+def test_fast_codec_matches_pyamf():
+    fast_codec = amf_codec.FastAmf0Codec()
+    pyamf_codec = amf_codec.PyAmfCodec()
+
+    values = [u'_result', 1, None, {'level': 'status', 'code': u'NetConnection.Connect.Success', 'fmsVer': 3.5,
+                                    'capabilities': [31, True, pyamf.Undefined]},
+              pyamf.MixedArray(duration=12.5, width=320), 'x' * 0x10000]
+    encoded = fast_codec.encode(values)
+    decoded = fast_codec.decode(encoded)
+
+    assert len(encoded) == len(pyamf_codec.encode(values))
+    assert decoded == pyamf_codec.decode(encoded)
+    assert [type(value) for value in decoded] == [type(value) for value in pyamf_codec.decode(encoded)]
+    assert type(decoded[3]) is pyamf.ASObject and type(decoded[4]) is pyamf.MixedArray
+
+
+def test_fast_codec_falls_back_to_pyamf():
+    fast_codec = amf_codec.FastAmf0Codec()
+    values = [u'onDate', datetime.datetime(2017, 1, 1)]
+
+    assert fast_codec.encode(values) == amf_codec.PyAmfCodec().encode(values)
+    assert fast_codec.decode(fast_codec.encode(values)) == values
+
+
+def test_command_template():
+    command_object = {'app': 'live', 'fpad': False, 'capabilities': 239, 'objectEncoding': 0}
+    template = amf_codec.get_command_template('connect', [command_object], ('live', 239))
+
+    assert template.encode(7, [u'extra']) == \
+        amf_codec.PyAmfCodec().encode(['connect', 7, command_object, u'extra'])
+    assert amf_codec.get_command_template('connect', [dict(command_object)], ('live', 239)) is template
+    assert amf_codec.get_command_template('connect', [dict(command_object, app='vod')], ('vod', 239)) is not template
+    # A command object can only be cached with a key.
+    assert amf_codec.get_command_template('connect', [command_object]) is None
+
+
+class CountingCodec(amf_codec.FastAmf0Codec):
+    """ Keeps the values encoded with the codec. """
+
+    def __init__(self):
+        amf_codec.FastAmf0Codec.__init__(self)
+        self.encoded = []
+
+    def encode(self, values):
+        self.encoded.append(values)
+        return amf_codec.FastAmf0Codec.encode(self, values)
+
+
+def test_repeated_call_reuses_the_template():
+    net_connection = NetConnection()
+    rtmp_stream = pyamf.util.BufferedByteStream()
+    net_connection.rtmp_writer = rtmp_writer.RtmpWriter(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+
+    codec = CountingCodec()
+    amf_codec.set_codec(codec)
+    try:
+        net_connection.call('play', [u'first'], transaction_id=0)
+        net_connection.call('play', [u'second'], transaction_id=0)
+    finally:
+        amf_codec.set_codec(amf_codec.CODEC_FAST)
+
+    # The command name and command object are only encoded for the first call, after that only the options are.
+    assert codec.encoded == [['play'], [None], [u'first'], [u'second']]
+    assert rtmp_stream.getvalue().endswith(amf_codec.PyAmfCodec().encode(['play', 0, None, u'second']))
+
+
+def test_least_recently_used_template_is_dropped(monkeypatch):
+    monkeypatch.setattr(amf_codec, 'MAX_COMMAND_TEMPLATES', 2)
+    amf_codec.set_codec(amf_codec.CODEC_FAST)
+
+    first = amf_codec.get_command_template('first')
+    second = amf_codec.get_command_template('second')
+    assert amf_codec.get_command_template('first') is first
+
+    amf_codec.get_command_template('third')
+    assert amf_codec.get_command_template('first') is first
+    assert amf_codec.get_command_template('second') is not second
+
+
+def test_templates_are_shared_between_threads(monkeypatch):
+    monkeypatch.setattr(amf_codec, 'MAX_COMMAND_TEMPLATES', 4)
+    amf_codec.set_codec(amf_codec.CODEC_FAST)
+    errors = []
+
+    def get_templates(thread_number):
+        try:
+            for number in range(2000):
+                command_name = 'command%d' % ((number + thread_number) % 8)
+                assert amf_codec.get_command_template(command_name).command_name == command_name
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=get_templates, args=(thread_number,)) for thread_number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(amf_codec._command_templates) <= 4
@@ -0,0 +1,113 @@
+""" Test the AsyncNetConnection with the data from the server arriving split across many data_received calls. """
+
+import pytest
+
+import pyamf.util
+
+import qrtmp.formats.rtmp_header as rtmp_header
+import qrtmp.formats.types as types
+import qrtmp.io.rtmp_writer as rtmp_writer
+
+# The asyncio NetConnection needs asyncio (or trollius on Python 2.7).
+async_net_connection = pytest.importorskip('qrtmp.base.async_net_connection')
+asyncio = async_net_connection.asyncio
+
+
+class Transport(object):
+    """ A transport which keeps the data written into it. """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.protocol = None
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    @staticmethod
+    def get_extra_info(name, default=None):
+        return default
+
+    def close(self):
+        self.loop.call_soon(self.protocol.connection_lost, None)
+
+    abort = close
+
+
+def run(loop, future):
+    return loop.run_until_complete(asyncio.wait_for(future, 1, loop=loop))
+
+
+def feed(protocol, data, size=7):
+    # Every chunk (and the handshake) is split over several calls.
+    for position in xrange(0, len(data), size):
+        protocol.data_received(data[position:position + size])
+
+
+def server_command(command_name, transaction_id, options):
+    rtmp_stream = pyamf.util.BufferedByteStream()
+    writer = rtmp_writer.RtmpWriter(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+    packet = writer.new_packet()
+    packet.set_type(types.DT_COMMAND)
+    packet.set_stream_id(0)
+    packet.body = {'command_name': command_name, 'transaction_id': transaction_id, 'command_object': None,
+                   'options': options}
+    writer.send_packet(packet)
+    return rtmp_stream.getvalue()
+
+
+def create_connection():
+    loop = asyncio.new_event_loop()
+    transport = Transport(loop)
+
+    def create_transport(protocol_factory, host, port):
+        transport.protocol = protocol_factory()
+        transport.protocol.connection_made(transport)
+        transport_future = asyncio.Future(loop=loop)
+        transport_future.set_result((transport, transport.protocol))
+        return transport_future
+
+    loop.create_connection = create_transport
+
+    net_connection = async_net_connection.AsyncNetConnection(loop)
+    net_connection.set_rtmp_server('127.0.0.1')
+    net_connection.set_rtmp_parameters('live')
+    connect_future = net_connection.rtmp_connect()
+
+    # Run the loop once, for C0 and C1 to be written into the transport.
+    run(loop, asyncio.sleep(0, loop=loop))
+    c1 = b''.join(transport.written)[1:1537]
+
+    # S0 and S1, followed by S2 (the echo of C1).
+    feed(transport.protocol, '\x03' + '\x00' * 1536 + c1)
+    assert run(loop, connect_future) is True
+    return loop, transport, net_connection
+
+
+def test_read_packet_with_split_chunks():
+    loop, transport, net_connection = create_connection()
+    packet_future = net_connection.read_packet()
+
+    # The body is larger than the chunk size, so it arrives as several chunks.
+    feed(transport.protocol, server_command('onStatus', 0, [{'code': 'NetStream.Play.Start', 'details': 'x' * 300}]))
+
+    received_packet = run(loop, packet_future)
+    assert received_packet.get_command_name() == 'onStatus'
+    assert received_packet.get_response()[0]['details'] == 'x' * 300
+    loop.close()
+
+
+def test_call_and_disconnect():
+    loop, transport, net_connection = create_connection()
+
+    reply_future = net_connection.call('getInfo', [u'first'])
+    transaction_id = net_connection.rtmp_writer.transaction_id
+    feed(transport.protocol, server_command('_result', transaction_id, [u'info']), size=3)
+
+    reply = run(loop, reply_future)
+    assert reply.get_transaction_id() == transaction_id and reply.get_response() == [u'info']
+
+    run(loop, net_connection.disconnect())
+    with pytest.raises(EOFError):
+        run(loop, net_connection.read_packet())
+    loop.close()
@@ -0,0 +1,198 @@
+""" Test the reassembly of RTMP messages whose chunks are interleaved across several chunk streams. """
+
+import struct
+
+import pyamf.amf0
+import pyamf.util
+import pytest
+
+import qrtmp.formats.amf_codec as amf_codec
+import qrtmp.formats.rtmp_header as rtmp_header
+import qrtmp.formats.types as types
+import qrtmp.io.rtmp_reader as rtmp_reader
+
+
+def full_header(chunk_stream_id, timestamp, body_length, data_type, stream_id):
+    # A type 0 header: basic header, timestamp, body length, data type and the little endian stream id.
+    return struct.pack('>B', chunk_stream_id) + struct.pack('>I', timestamp)[1:] + \
+        struct.pack('>I', body_length)[1:] + struct.pack('>B', data_type) + struct.pack('<I', stream_id)
+
+
+def continuation_header(chunk_stream_id):
+    return struct.pack('>B', 0xc0 | chunk_stream_id)
+
+
+def create_reader(data):
+    rtmp_stream = pyamf.util.BufferedByteStream(data)
+    return rtmp_reader.RtmpReader(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+
+
+def test_interleaved_chunk_streams():
+    video_body = 'v' * 200
+    audio_body = 'a' * 150
+
+    data = full_header(7, 40, len(video_body), types.DT_VIDEO_MESSAGE, 1) + video_body[:128] + \
+        full_header(6, 40, len(audio_body), types.DT_AUDIO_MESSAGE, 1) + audio_body[:128] + \
+        continuation_header(7) + video_body[128:] + \
+        continuation_header(6) + audio_body[128:]
+
+    reader = create_reader(data)
+
+    video_header, decoded_video = reader.decode_rtmp_stream()
+    assert video_header.chunk_stream_id == 7
+    assert video_header.data_type == types.DT_VIDEO_MESSAGE
+    assert decoded_video == bytearray(video_body)
+
+    audio_header, decoded_audio = reader.decode_rtmp_stream()
+    assert audio_header.chunk_stream_id == 6
+    assert audio_header.data_type == types.DT_AUDIO_MESSAGE
+    assert decoded_audio == bytearray(audio_body)
+
+    # Nothing should be left in flight once both messages are complete.
+    assert reader._partial_messages == {}
+
+
+def test_compressed_headers_inherit_fields():
+    # A type 2 header (timestamp delta only) followed by a type 3 header starting a new message.
+    data = full_header(6, 1000, 4, types.DT_AUDIO_MESSAGE, 1) + 'aaaa' + \
+        struct.pack('>B', 0x80 | 6) + struct.pack('>I', 23)[1:] + 'bbbb' + \
+        continuation_header(6) + 'cccc'
+
+    reader = create_reader(data)
+
+    timestamps = []
+    for expected_body in ('aaaa', 'bbbb', 'cccc'):
+        decoded_header, decoded_body = reader.decode_rtmp_stream()
+        assert decoded_body == bytearray(expected_body)
+        assert decoded_header.stream_id == 1
+        assert decoded_header.body_length == 4
+        timestamps.append(decoded_header.timestamp)
+
+    assert timestamps == [1000, 1023, 1046]
+
+
+def test_abort_message():
+    data = full_header(3, 0, 200, types.DT_COMMAND, 0) + 'x' * 128
+    reader = create_reader(data)
+
+    assert reader.read_chunk() is None
+    assert reader.abort_message(3) is True
+    assert reader.abort_message(3) is False
+
+
+def test_media_data_is_a_view_of_the_body():
+    data = full_header(7, 0, 5, types.DT_VIDEO_MESSAGE, 1) + '\x17abcd'
+    reader = create_reader(data)
+
+    decoded_header, decoded_body = reader.decode_rtmp_stream()
+    received_packet = reader.generate_packet(decoded_header, decoded_body)
+
+    assert received_packet.body['control'] == 0x17
+    assert isinstance(received_packet.body['video_data'], memoryview)
+    assert received_packet.body['video_data'].tobytes() == 'abcd'
+
+
+def test_registered_decoder_replaces_builtin():
+    data = full_header(3, 0, 3, types.DT_DATA_MESSAGE, 1) + 'xyz'
+    reader = create_reader(data)
+
+    def decode_raw(received_packet, decoded_body):
+        received_packet.body = {'raw': bytes(decoded_body)}
+
+    reader.register_decoder(types.DT_DATA_MESSAGE, decode_raw)
+
+    decoded_header, decoded_body = reader.decode_rtmp_stream()
+    assert reader.generate_packet(decoded_header, decoded_body).body == {'raw': 'xyz'}
+
+
+def test_command_body_is_decoded_on_first_use():
+    body_stream = pyamf.util.BufferedByteStream()
+    encoder = pyamf.amf0.Encoder(body_stream)
+    for element in (u'_result', 1, None, {'code': u'NetConnection.Connect.Success'}):
+        encoder.writeElement(element)
+    body = body_stream.getvalue()
+
+    reader = create_reader(full_header(3, 0, len(body), types.DT_COMMAND, 0) + body)
+    decoded_header, decoded_body = reader.decode_rtmp_stream()
+    received_packet = reader.generate_packet(decoded_header, decoded_body)
+
+    assert not received_packet.is_body_decoded()
+    assert received_packet.get_command_name() == u'_result'
+    assert received_packet.is_body_decoded()
+    assert received_packet.get_transaction_id() == 1
+    assert received_packet.get_response() == [{'code': u'NetConnection.Connect.Success'}]
+
+
+def test_command_is_peeked_without_decoding():
+    body = amf_codec.PyAmfCodec().encode([u'_result', 3, None, u'ok'])
+    reader = create_reader(full_header(3, 0, len(body), types.DT_COMMAND, 0) + body)
+    received_packet = reader.generate_packet(*reader.decode_rtmp_stream())
+
+    assert received_packet.peek_command() == (u'_result', 3)
+    assert not received_packet.is_body_decoded()
+    assert received_packet.get_response() == [u'ok']
+
+
+def test_failed_decoder_keeps_the_body():
+    reader = create_reader(full_header(3, 0, 3, types.DT_DATA_MESSAGE, 1) + 'xyz')
+    failures = []
+
+    def decode_raw(received_packet, decoded_body):
+        if not failures:
+            failures.append(decoded_body)
+            raise ValueError('Not ready to decode the body.')
+        received_packet.body = {'raw': bytes(decoded_body)}
+
+    reader.register_decoder(types.DT_DATA_MESSAGE, decode_raw)
+    received_packet = reader.generate_packet(*reader.decode_rtmp_stream())
+
+    with pytest.raises(ValueError):
+        received_packet.body
+    assert not received_packet.is_body_decoded()
+    assert received_packet.body == {'raw': 'xyz'}
+
+
+def test_trace_events():
+    data = full_header(3, 0, 200, types.DT_COMMAND, 0) + 'x' * 128 + continuation_header(3) + 'x' * 72
+    reader = create_reader(data)
+
+    events = []
+    reader.trace = lambda event, details: events.append((event, details.get('length')))
+    reader.decode_rtmp_stream()
+
+    assert events == [(types.TRACE_CHUNK_READ, 128), (types.TRACE_CHUNK_READ, 72), (types.TRACE_MESSAGE_READ, None)]
+
+
+def aggregate_tag(data_type, timestamp, body):
+    # An FLV tag header: the data type, body length, timestamp (and its upper 8 bits) and the stream id,
+    # followed by the body and the back pointer.
+    return struct.pack('>B', data_type) + struct.pack('>I', len(body))[1:] + struct.pack('>I', timestamp)[1:] + \
+        struct.pack('>B', timestamp >> 24) + '\x00\x00\x00' + body + struct.pack('>I', 11 + len(body))
+
+
+def test_aggregate_message_is_split():
+    body = aggregate_tag(types.DT_VIDEO_MESSAGE, 1000, '\x17key') + \
+        aggregate_tag(types.DT_AUDIO_MESSAGE, 1020, '\xafa') + aggregate_tag(types.DT_VIDEO_MESSAGE, 1040, '\x27inter')
+    reader = create_reader(full_header(5, 5000, len(body), types.DT_AGGREGATE_MESSAGE, 1) + body)
+
+    decoded_header, decoded_body = reader.decode_rtmp_stream()
+    aggregate_packet = reader.generate_packet(decoded_header, decoded_body)
+
+    messages = [(packet.header.data_type, packet.header.timestamp, packet.header.stream_id, packet.body['control'])
+                for packet in aggregate_packet.body['messages']]
+    assert messages == [(types.DT_VIDEO_MESSAGE, 5000, 1, 0x17), (types.DT_AUDIO_MESSAGE, 5020, 1, 0xaf),
+                        (types.DT_VIDEO_MESSAGE, 5040, 1, 0x27)]
+
+    # The messages are split out again each time they are iterated over.
+    assert [packet.header.timestamp for packet in aggregate_packet.body['messages']] == [5000, 5020, 5040]
+
+
+def test_truncated_aggregate_message():
+    body = aggregate_tag(types.DT_AUDIO_MESSAGE, 0, '\xafa') + aggregate_tag(types.DT_AUDIO_MESSAGE, 20, '\xafb')[:-6]
+    reader = create_reader(full_header(5, 0, len(body), types.DT_AGGREGATE_MESSAGE, 1) + body)
+
+    decoded_header, decoded_body = reader.decode_rtmp_stream()
+    packets = list(reader.iter_aggregate(decoded_header, decoded_body))
+
+    assert len(packets) == 1
+    assert packets[0].body['audio_data'].tobytes() == 'a'
@@ -0,0 +1,72 @@
+""" Test the client side of the simple and digest RTMP handshakes against a server side made in the test. """
+
+import hashlib
+import hmac
+import os
+
+import qrtmp.formats.handshake as handshake
+
+
+def chunk_data(chunk):
+    return handshake._HANDSHAKE_FIELDS.pack(chunk.first, chunk.second) + chunk.payload
+
+
+def find_digest(data, key):
+    # The digest may be at the offset given by either scheme.
+    for scheme in (8, 772):
+        offset = sum(bytearray(data[scheme:scheme + 4])) % 728 + scheme + 4
+        digest = data[offset:offset + 32]
+        if hmac.new(key, data[:offset] + data[offset + 32:], hashlib.sha256).digest() == digest:
+            return digest
+    return None
+
+
+def create_server_s1(scheme):
+    data = bytearray(os.urandom(1536))
+    offset = sum(data[scheme:scheme + 4]) % 728 + scheme + 4
+    data = str(data)
+    digest = hmac.new(handshake.GENUINE_FMS_KEY[:36], data[:offset] + data[offset + 32:], hashlib.sha256).digest()
+    data = data[:offset] + digest + data[offset + 32:]
+    return handshake._split_chunk(data), digest
+
+
+def create_response(key, digest):
+    random_data = os.urandom(1504)
+    response_key = hmac.new(key, digest, hashlib.sha256).digest()
+    return random_data + hmac.new(response_key, random_data, hashlib.sha256).digest()
+
+
+def test_digest_handshake():
+    for scheme in (8, 772):
+        client_handshake = handshake.ClientHandshake(handshake.HANDSHAKE_DIGEST)
+
+        # The server finds and checks the digest in C1.
+        c1 = client_handshake.create_c1()
+        assert c1.second == handshake.DIGEST_CLIENT_VERSION
+        c1_digest = find_digest(chunk_data(c1), handshake.GENUINE_FP_KEY[:30])
+        assert c1_digest is not None
+
+        # The client checks the digest in S1 and responds to it in C2, which the server checks.
+        s1, s1_digest = create_server_s1(scheme)
+        c2_data = chunk_data(client_handshake.create_c2(s1))
+        assert client_handshake.server_digest
+        c2_key = hmac.new(handshake.GENUINE_FP_KEY, s1_digest, hashlib.sha256).digest()
+        assert hmac.new(c2_key, c2_data[:-32], hashlib.sha256).digest() == c2_data[-32:]
+
+        # The server responds to C1 in S2, which the client checks.
+        s2 = handshake._split_chunk(create_response(handshake.GENUINE_FMS_KEY, c1_digest))
+        assert client_handshake.verify_s2(s2)
+        assert not client_handshake.verify_s2(handshake._split_chunk(os.urandom(1536)))
+
+
+def test_digest_handshake_falls_back_to_simple():
+    client_handshake = handshake.ClientHandshake(handshake.HANDSHAKE_DIGEST)
+    c1 = client_handshake.create_c1()
+
+    # A server which only supports the simple handshake sends S1 without a digest and echoes C1 in S2.
+    s1 = handshake._split_chunk('\x00' * 8 + os.urandom(1528))
+    c2 = client_handshake.create_c2(s1)
+
+    assert not client_handshake.server_digest
+    assert c2.payload == s1.payload
+    assert client_handshake.verify_s2(handshake._split_chunk(chunk_data(c1)))
@@ -0,0 +1,58 @@
+""" Test that the headers sent are compressed with timestamp deltas and read back as the same messages. """
+
+import pyamf.util
+
+import qrtmp.formats.rtmp_header as rtmp_header
+import qrtmp.formats.types as types
+import qrtmp.io.rtmp_reader as rtmp_reader
+import qrtmp.io.rtmp_writer as rtmp_writer
+
+
+def send_video(writer, timestamp, video_data):
+    packet = writer.new_packet()
+    packet.set_type(types.DT_VIDEO_MESSAGE)
+    packet.set_timestamp(timestamp)
+    packet.body = {'control': 0x27, 'video_data': video_data}
+    writer.send_packet(packet)
+
+
+def read_messages(data):
+    rtmp_stream = pyamf.util.BufferedByteStream(data)
+    reader = rtmp_reader.RtmpReader(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+
+    messages = []
+    while not rtmp_stream.at_eof():
+        decoded_header, decoded_body = reader.decode_rtmp_stream()
+        messages.append((decoded_header.timestamp, bytes(decoded_body[1:])))
+    return messages
+
+
+def test_header_compression():
+    rtmp_stream = pyamf.util.BufferedByteStream()
+    header_handler = rtmp_header.RtmpHeaderHandler(rtmp_stream)
+    writer = rtmp_writer.RtmpWriter(rtmp_stream, header_handler)
+
+    chunk_types = []
+    header_handler.trace = lambda event, details: \
+        event == types.TRACE_HEADER_ENCODED and chunk_types.append(details['chunk_type'])
+
+    # The frame sizes (and the timestamp deltas) change and stay the same, the last frame goes over
+    # the chunk size and the timestamp goes backwards after it.
+    sent = [(0, 'a' * 10), (33, 'b' * 10), (66, 'c' * 10), (100, 'd' * 10), (133, 'e' * 20), (166, 'f' * 300),
+            (50, 'g' * 10)]
+    for timestamp, video_data in sent:
+        send_video(writer, timestamp, video_data)
+
+    assert chunk_types == [0x00, 0x80, 0xc0, 0x80, 0x40, 0x40, 0xc0, 0xc0, 0x00]
+    assert read_messages(rtmp_stream.getvalue()) == sent
+
+
+def test_extended_timestamp_deltas():
+    rtmp_stream = pyamf.util.BufferedByteStream()
+    writer = rtmp_writer.RtmpWriter(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+
+    sent = [(0x1000000, 'a' * 200), (0x1000000 + 0x1000000, 'b' * 200), (0x1000000 + 0x1000021, 'c' * 200)]
+    for timestamp, video_data in sent:
+        send_video(writer, timestamp, video_data)
+
+    assert read_messages(rtmp_stream.getvalue()) == sent
@@ -0,0 +1,116 @@
+""" Test that calls time out and queued packets are sent while the NetConnection waits for data to read. """
+
+import socket
+import struct
+import threading
+import time
+
+import qrtmp.base.data_wrapper as data_wrapper
+import qrtmp.base.net_connection as net_connection_module
+import qrtmp.formats.types as types
+import qrtmp.io.net_connection.transactions as transactions
+import qrtmp.io.shaper as shaper
+
+
+def create_net_connection(send_queue_size=None):
+    client_socket, server_socket = socket.socketpair()
+
+    net_connection = net_connection_module.NetConnection()
+    net_connection.send_queue_size = send_queue_size
+    net_connection._socket_object = client_socket
+    net_connection._socket_reader = data_wrapper.SocketRawIO(client_socket)
+    net_connection._socket_file = data_wrapper.make_socket_file(client_socket, net_connection._socket_reader)
+    net_connection._rtmp_stream = data_wrapper.SocketDataTypeMixInFile(net_connection._socket_file)
+    net_connection._set_rtmp_io()
+    return net_connection, server_socket
+
+
+def send_video(writer, frame_type, size):
+    packet = writer.new_packet()
+    packet.set_type(types.DT_VIDEO_MESSAGE)
+    packet.set_stream_id(1)
+    packet.body = {'control': (frame_type << 4) | 0x7, 'video_data': 'v' * size}
+    writer.send_packet(packet)
+
+
+def send_audio(server_socket):
+    audio_header = struct.pack('>B3s3sB', 4, '', '\x00\x00\x01', types.DT_AUDIO_MESSAGE) + struct.pack('<I', 1)
+    server_socket.sendall(audio_header + '\xaf')
+
+
+def test_queued_packets_are_sent_while_reading():
+    net_connection, server_socket = create_net_connection()
+    writer = net_connection.rtmp_writer
+    writer.shaper = shaper.OutputShaper(1000)
+    writer.queue_blocked = net_connection._output_blocked
+
+    # The second frame waits (about 0.2 seconds) for the output window, sending it does not block.
+    started = time.time()
+    for _ in range(2):
+        send_video(writer, types.VF_INTER_FRAME, 580)
+    assert time.time() - started < 0.1
+    assert len(writer.shaper) == 1
+    assert 0 < net_connection.send_queued() <= 0.2
+
+    # The server only replies once it has received both frames.
+    def reply():
+        received = ''
+        while received.count('v') < 2 * 580:
+            received += server_socket.recv(4096)
+        send_audio(server_socket)
+
+    server_socket.settimeout(5)
+
+    server_thread = threading.Thread(target=reply)
+    server_thread.start()
+    received_packet = net_connection.read_packet()
+    server_thread.join()
+
+    assert received_packet.header.data_type == types.DT_AUDIO_MESSAGE
+    assert len(writer.shaper) == 0
+
+
+def test_call_times_out_while_reading():
+    net_connection, server_socket = create_net_connection()
+    timed_out = []
+
+    started = time.time()
+    transaction = net_connection.call('getInfo', timeout=0.1,
+                                      callback=lambda _: timed_out.append(time.time() - started))
+
+    # The server does not reply to the call, it only sends a message a while later.
+    server_thread = threading.Timer(1.0, send_audio, [server_socket])
+    server_thread.start()
+    received_packet = net_connection.read_packet()
+    server_thread.join()
+
+    assert received_packet.header.data_type == types.DT_AUDIO_MESSAGE
+    assert isinstance(transaction.exception(), transactions.TransactionTimeout)
+    assert timed_out[0] < 0.5
+
+
+def test_full_socket_fills_the_send_queue():
+    net_connection, server_socket = create_net_connection(send_queue_size=20000)
+    writer = net_connection.rtmp_writer
+
+    # The server does not read anything, so the socket's send buffer fills up and the frames wait in the send queue
+    # (and are then dropped) rather than blocking the sender.
+    started = time.time()
+    send_video(writer, types.VF_KEYFRAME, 1000)
+    for _ in range(2000):
+        send_video(writer, types.VF_INTER_FRAME, 1000)
+    assert time.time() - started < 5
+
+    metrics = net_connection.get_send_queue_metrics()
+    assert metrics['dropped_frames'] > 0 and metrics['dropped_bytes'] > 0
+    assert 0 < metrics['queue_size'] <= 20000
+
+    # The frames left in the queue are sent once the server reads the data.
+    server_socket.setblocking(False)
+    while len(writer.shaper) > 0 and time.time() - started < 10:
+        try:
+            server_socket.recv(65536)
+        except socket.error:
+            pass
+        net_connection._on_idle()
+    assert len(writer.shaper) == 0
@@ -0,0 +1,136 @@
+""" Test that the audio and video messages we send are packed into aggregate messages within the limits set. """
+
+import pyamf.util
+
+import qrtmp.formats.rtmp_header as rtmp_header
+import qrtmp.formats.types as types
+import qrtmp.io.aggregator as aggregator
+import qrtmp.io.rtmp_reader as rtmp_reader
+import qrtmp.io.rtmp_writer as rtmp_writer
+import qrtmp.io.shaper as shaper
+
+
+def create_writer(media_aggregator):
+    rtmp_stream = pyamf.util.BufferedByteStream()
+    writer = rtmp_writer.RtmpWriter(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+    writer.aggregator = media_aggregator
+    return writer, rtmp_stream
+
+
+def send_media(writer, data_type, timestamp, data, control=0x27):
+    packet = writer.new_packet()
+    packet.set_type(data_type)
+    packet.set_timestamp(timestamp)
+    if data_type == types.DT_AUDIO_MESSAGE:
+        packet.body = {'control': 0xaf, 'audio_data': data}
+    else:
+        packet.body = {'control': control, 'video_data': data}
+    writer.send_packet(packet)
+
+
+def read_packets(rtmp_stream):
+    rtmp_stream.seek(0)
+    reader = rtmp_reader.RtmpReader(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+
+    packets = []
+    while not rtmp_stream.at_eof():
+        decoded_header, decoded_body = reader.decode_rtmp_stream()
+        packets.append(reader.generate_packet(decoded_header, decoded_body))
+    return packets
+
+
+def test_media_messages_are_aggregated():
+    writer, rtmp_stream = create_writer(aggregator.MediaAggregator(max_duration=100))
+
+    send_media(writer, types.DT_VIDEO_MESSAGE, 0, 'frame1')
+    send_media(writer, types.DT_AUDIO_MESSAGE, 20, 'sample1')
+    send_media(writer, types.DT_VIDEO_MESSAGE, 40, 'frame2')
+    assert rtmp_stream.tell() == 0
+
+    # The duration limit is reached, the messages before this one are sent together.
+    send_media(writer, types.DT_AUDIO_MESSAGE, 120, 'sample2')
+    # Any other message sends the media waiting before it.
+    set_chunk_size = writer.new_packet()
+    set_chunk_size.set_type(types.DT_SET_CHUNK_SIZE)
+    set_chunk_size.body = {'chunk_size': 128}
+    writer.send_packet(set_chunk_size)
+
+    packets = read_packets(rtmp_stream)
+    assert [packet.header.data_type for packet in packets] == [types.DT_AGGREGATE_MESSAGE, types.DT_AUDIO_MESSAGE,
+                                                               types.DT_SET_CHUNK_SIZE]
+
+    messages = [(packet.header.data_type, packet.header.timestamp, packet.header.stream_id,
+                 packet.body['video_data' if packet.header.data_type == types.DT_VIDEO_MESSAGE else 'audio_data'])
+                for packet in packets[0].body['messages']]
+    assert messages == [(types.DT_VIDEO_MESSAGE, 0, 1, 'frame1'), (types.DT_AUDIO_MESSAGE, 20, 1, 'sample1'),
+                        (types.DT_VIDEO_MESSAGE, 40, 1, 'frame2')]
+    assert packets[1].header.timestamp == 120
+
+
+def test_size_limit_and_flush():
+    writer, rtmp_stream = create_writer(aggregator.MediaAggregator(max_size=100))
+
+    # Each message takes up 45 bytes as a tag, so only two of them fit in an aggregate message.
+    for timestamp in xrange(0, 200, 40):
+        send_media(writer, types.DT_VIDEO_MESSAGE, timestamp, 'v' * 29)
+    writer.flush()
+
+    # The message left over is sent on its own.
+    packets = read_packets(rtmp_stream)
+    assert [packet.header.data_type for packet in packets] == [types.DT_AGGREGATE_MESSAGE, types.DT_AGGREGATE_MESSAGE,
+                                                               types.DT_VIDEO_MESSAGE]
+    assert [len(list(packet.body['messages'])) for packet in packets[:2]] == [2, 2]
+    assert [packet.header.timestamp for packet in packets] == [0, 80, 160]
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_held_messages_are_sent_after_the_max_duration():
+    clock = Clock()
+    writer, rtmp_stream = create_writer(aggregator.MediaAggregator(max_duration=500, clock=clock))
+    waits = []
+    writer.aggregate_held = waits.append
+
+    send_media(writer, types.DT_VIDEO_MESSAGE, 0, 'frame1')
+    send_media(writer, types.DT_AUDIO_MESSAGE, 20, 'sample1')
+    assert waits == [0.5, 0.5]
+
+    # No further message is sent, the messages are sent once they have been held for the max duration.
+    clock.now = 0.3
+    assert writer.send_aggregate_due() == 0.2 and rtmp_stream.tell() == 0
+    clock.now = 0.5
+    assert writer.send_aggregate_due() is None
+    assert [packet.header.data_type for packet in read_packets(rtmp_stream)] == [types.DT_AGGREGATE_MESSAGE]
+
+
+def test_aggregate_priority_and_dropping():
+    media_aggregator = aggregator.MediaAggregator()
+    writer, _ = create_writer(media_aggregator)
+    writer.shaper = shaper.OutputShaper(1000, max_queue_size=100)
+
+    def aggregate(*messages):
+        for data_type, control in messages:
+            send_media(writer, data_type, 0, 'x' * 60, control)
+        return media_aggregator.take()
+
+    mostly_audio = aggregate((types.DT_AUDIO_MESSAGE, None), (types.DT_AUDIO_MESSAGE, None),
+                             (types.DT_VIDEO_MESSAGE, 0x27))
+    inter_frames = aggregate((types.DT_VIDEO_MESSAGE, 0x27), (types.DT_VIDEO_MESSAGE, 0x27))
+    keyframe = aggregate((types.DT_VIDEO_MESSAGE, 0x17), (types.DT_VIDEO_MESSAGE, 0x27))
+
+    # An aggregate message is sent with the priority of the most important message inside it.
+    assert shaper.get_packet_priority(mostly_audio) == shaper.PRIORITY_AUDIO
+    assert shaper.get_packet_priority(inter_frames) == shaper.PRIORITY_VIDEO
+
+    # Once the queue is full, only the aggregate message of inter frames is dropped.
+    for packet in (mostly_audio, inter_frames, keyframe):
+        writer.shaper.push(packet, shaper.get_wire_size(packet, writer.chunk_size))
+    assert writer.shaper.dropped_frames == 1
+    assert [writer.shaper.pop() for _ in range(2)] == [mostly_audio, keyframe]
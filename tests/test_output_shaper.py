@@ -0,0 +1,135 @@
+""" Test that the packets sent through the output shaper keep to the bandwidth and are sent in priority order. """
+
+import pyamf.util
+
+import qrtmp.formats.rtmp_header as rtmp_header
+import qrtmp.formats.types as types
+import qrtmp.io.rtmp_reader as rtmp_reader
+import qrtmp.io.rtmp_writer as rtmp_writer
+import qrtmp.io.shaper as shaper
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def new_packet(writer, data_type, body):
+    packet = writer.new_packet()
+    packet.set_type(data_type)
+    packet.body = body
+    return packet
+
+
+def read_data_types(rtmp_stream):
+    rtmp_stream.seek(0)
+    reader = rtmp_reader.RtmpReader(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+
+    data_types = []
+    while not rtmp_stream.at_eof():
+        decoded_header, _ = reader.decode_rtmp_stream()
+        data_types.append(decoded_header.data_type)
+    return data_types
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = shaper.TokenBucket(1000, clock=clock)
+
+    assert bucket.consume(600) == 0.0
+    assert bucket.consume(600) == 0.2
+
+    clock.now = 0.2
+    assert bucket.consume(600) == 0.0
+
+    # A packet larger than the burst size waits for a full bucket.
+    assert bucket.consume(5000) == 1.0
+    clock.now = 1.2
+    assert bucket.consume(5000) == 0.0
+
+
+def test_priority_order():
+    clock = Clock()
+    rtmp_stream = pyamf.util.BufferedByteStream()
+    writer = rtmp_writer.RtmpWriter(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+    writer.shaper = shaper.OutputShaper(1000, clock=clock)
+
+    waits = []
+    writer.queue_blocked = waits.append
+
+    # The first video frame uses up the output window, everything after it is queued.
+    writer.send_packet(new_packet(writer, types.DT_VIDEO_MESSAGE, {'control': 0x17, 'video_data': 'v' * 980}))
+    writer.send_packet(new_packet(writer, types.DT_VIDEO_MESSAGE, {'control': 0x27, 'video_data': 'v' * 300}))
+    writer.send_packet(new_packet(writer, types.DT_AUDIO_MESSAGE, {'control': 0xaf, 'audio_data': 'a' * 300}))
+    writer.send_packet(new_packet(writer, types.DT_SET_CHUNK_SIZE, {'chunk_size': 4096}))
+
+    assert len(writer.shaper) == 3
+    assert len(waits) == 3 and waits[0] > 0
+
+    clock.now = 10.0
+    assert writer.send_queued() == 0.0
+    assert read_data_types(rtmp_stream) == [types.DT_VIDEO_MESSAGE, types.DT_SET_CHUNK_SIZE,
+                                            types.DT_AUDIO_MESSAGE, types.DT_VIDEO_MESSAGE]
+
+
+def test_frames_are_dropped_until_the_next_keyframe():
+    rtmp_stream = pyamf.util.BufferedByteStream()
+    writer = rtmp_writer.RtmpWriter(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+    writer.shaper = shaper.OutputShaper(max_queue_size=1000)
+
+    # Nothing is sent while the writer is paused, so the frames fill up the queue.
+    writer.paused = True
+
+    def send_frame(control, length):
+        writer.send_packet(new_packet(writer, types.DT_VIDEO_MESSAGE, {'control': control, 'video_data': 'v' * length}))
+
+    send_frame(0x17, 400)
+    send_frame(0x27, 400)
+    # The queue is full, this frame and the ones depending on it are dropped, even once there is space again.
+    send_frame(0x27, 400)
+    writer.send_packet(new_packet(writer, types.DT_AUDIO_MESSAGE, {'control': 0xaf, 'audio_data': 'a' * 400}))
+    send_frame(0x27, 10)
+
+    metrics = writer.shaper.get_metrics()
+    assert metrics['queue_length'] == 3
+    assert metrics['dropped_frames'] == 2
+
+    # The keyframe replaces the frames waiting before it.
+    send_frame(0x17, 100)
+    send_frame(0x27, 10)
+    assert writer.shaper.get_metrics()['dropped_frames'] == 4
+
+    writer.paused = False
+    assert writer.send_queued() == 0.0
+    assert read_data_types(rtmp_stream) == [types.DT_AUDIO_MESSAGE, types.DT_VIDEO_MESSAGE, types.DT_VIDEO_MESSAGE]
+    assert writer.shaper.queue_size == 0
+
+
+def test_disposable_frames_are_dropped_first():
+    rtmp_stream = pyamf.util.BufferedByteStream()
+    writer = rtmp_writer.RtmpWriter(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+    writer.shaper = shaper.OutputShaper(max_queue_size=1000)
+    writer.paused = True
+
+    def send_frame(control, length):
+        writer.send_packet(new_packet(writer, types.DT_VIDEO_MESSAGE, {'control': control, 'video_data': 'v' * length}))
+
+    send_frame(0x17, 400)
+    send_frame(0x37, 300)
+    # The queue is full, the disposable frame is dropped without cutting the stream off.
+    send_frame(0x37, 400)
+    assert writer.shaper.get_metrics()['dropped_frames'] == 1
+
+    # The queued disposable frame is dropped to make space for the inter frame, so it is still accepted.
+    send_frame(0x27, 400)
+    send_frame(0x27, 10)
+    metrics = writer.shaper.get_metrics()
+    assert metrics['dropped_frames'] == 2 and metrics['queue_length'] == 3
+
+    writer.paused = False
+    assert writer.send_queued() == 0.0
+    assert read_data_types(rtmp_stream) == [types.DT_VIDEO_MESSAGE] * 3
@@ -0,0 +1,180 @@
+""" Test the handling of the default RTMP messages read by the NetConnection. """
+
+import struct
+
+import pyamf.util
+
+import qrtmp.formats.amf_codec as amf_codec
+import qrtmp.formats.rtmp_header as rtmp_header
+import qrtmp.formats.types as types
+import qrtmp.io.net_connection.messages as messages
+import qrtmp.io.rtmp_reader as rtmp_reader
+import qrtmp.io.rtmp_writer as rtmp_writer
+from qrtmp.base.net_connection import NetConnection
+
+
+def full_header(chunk_stream_id, body_length, data_type, stream_id):
+    return struct.pack('>B', chunk_stream_id) + '\x00\x00\x00' + struct.pack('>I', body_length)[1:] + \
+        struct.pack('>B', data_type) + struct.pack('<I', stream_id)
+
+
+def user_control(event_type, event_data):
+    body = struct.pack('>H', event_type) + event_data
+    return full_header(2, len(body), types.DT_USER_CONTROL, 0) + body
+
+
+def create_net_connection(data):
+    net_connection = NetConnection()
+    net_connection._rtmp_stream = pyamf.util.BufferedByteStream(data)
+    net_connection.rtmp_reader = rtmp_reader.RtmpReader(
+        net_connection._rtmp_stream, rtmp_header.RtmpHeaderHandler(net_connection._rtmp_stream))
+
+    # The responses are written into a stream of their own.
+    response_stream = pyamf.util.BufferedByteStream()
+    net_connection.rtmp_writer = rtmp_writer.RtmpWriter(response_stream, rtmp_header.RtmpHeaderHandler(response_stream))
+    net_connection.messages = messages.NetConnectionMessages(net_connection.rtmp_writer)
+    return net_connection, response_stream
+
+
+def test_handled_packets_do_not_grow_the_stack():
+    # Many more pings than the recursion limit, followed by a message for the client.
+    data = user_control(types.UC_PING_REQUEST, struct.pack('>I', 1)) * 5000 + \
+        full_header(4, 3, types.DT_AUDIO_MESSAGE, 1) + '\xafxy'
+    net_connection, response_stream = create_net_connection(data)
+
+    received_packet = net_connection.read_packet()
+    assert received_packet.header.data_type == types.DT_AUDIO_MESSAGE
+    assert response_stream.tell() > 0
+
+
+def test_registered_handler():
+    stream_id = struct.pack('>I', 1)
+    data = user_control(types.UC_STREAM_BEGIN, stream_id) + user_control(types.UC_STREAM_EOF, stream_id) + \
+        user_control(types.UC_STREAM_DRY, stream_id)
+    net_connection, _ = create_net_connection(data)
+
+    handled = []
+    net_connection.register_handler(types.DT_USER_CONTROL, lambda packet: handled.append(packet) or True,
+                                    event_type=types.UC_STREAM_EOF)
+    net_connection.register_handler(types.DT_USER_CONTROL, None, event_type=types.UC_STREAM_BEGIN)
+
+    assert net_connection.read_packet().body['event_type'] == types.UC_STREAM_BEGIN
+    assert net_connection.read_packet().body['event_type'] == types.UC_STREAM_DRY
+    assert [packet.body['event_type'] for packet in handled] == [types.UC_STREAM_EOF]
+
+
+def read_responses(response_stream):
+    response_stream.seek(0)
+    reader = rtmp_reader.RtmpReader(response_stream, rtmp_header.RtmpHeaderHandler(response_stream))
+
+    responses = []
+    while not response_stream.at_eof():
+        decoded_header, decoded_body = reader.decode_rtmp_stream()
+        responses.append(reader.generate_packet(decoded_header, decoded_body))
+    return responses
+
+
+def test_acknowledgements():
+    window_ack_size = struct.pack('>I', 100)
+    audio = full_header(4, 50, types.DT_AUDIO_MESSAGE, 1) + '\xaf' * 50
+    data = full_header(2, 4, types.DT_WINDOW_ACKNOWLEDGEMENT_SIZE, 0) + window_ack_size + audio * 4
+    net_connection, response_stream = create_net_connection(data)
+
+    for _ in range(4):
+        net_connection.read_packet()
+
+    # An acknowledgement is sent once at least 100 bytes have been received since the last one, the bytes
+    # received are the handshake (3073 bytes) and the chunks which have been read (16 bytes, then 62 per message).
+    responses = read_responses(response_stream)
+    assert [response.header.data_type for response in responses] == [types.DT_ACKNOWLEDGEMENT] * 2
+    assert [response.body['sequence_number'] for response in responses] == [3073 + 78, 3073 + 202]
+    assert net_connection.rtmp_reader.bytes_read == len(data)
+
+
+def test_peer_bandwidth_limits():
+    def set_peer_bandwidth(window_size, limit_type):
+        return full_header(2, 5, types.DT_SET_PEER_BANDWIDTH, 0) + struct.pack('>IB', window_size, limit_type)
+
+    # The dynamic limit after the hard limit is applied, the soft limit can not raise the window and
+    # the dynamic limit after the soft limit is ignored.
+    data = set_peer_bandwidth(5000, types.HARD) + set_peer_bandwidth(3000, types.DYNAMIC) + \
+        set_peer_bandwidth(8000, types.SOFT) + set_peer_bandwidth(9000, types.DYNAMIC) + \
+        full_header(4, 1, types.DT_AUDIO_MESSAGE, 1) + '\xaf'
+    net_connection, response_stream = create_net_connection(data)
+
+    net_connection.read_packet()
+    assert net_connection.peer_bandwidth == 3000
+    assert net_connection.peer_bandwidth_limit_type == types.SOFT
+
+    # The window acknowledgement size is only sent when the output window changes.
+    responses = read_responses(response_stream)
+    assert [response.body['window_acknowledgement_size'] for response in responses] == [5000, 3000]
+
+    # The output is only shaped if it has been turned on.
+    assert net_connection.rtmp_writer.shaper is None
+
+
+def test_output_window_rate():
+    data = full_header(2, 5, types.DT_SET_PEER_BANDWIDTH, 0) + struct.pack('>IB', 5000, types.HARD) + \
+        full_header(4, 1, types.DT_AUDIO_MESSAGE, 1) + '\xaf'
+    net_connection, _ = create_net_connection(data)
+    net_connection.shape_output = True
+    net_connection.output_window_duration = 2.0
+
+    net_connection.read_packet()
+    assert net_connection.rtmp_writer.shaper.bucket.rate == 2500.0
+
+
+class FlushCounter(object):
+    """ Counts the flushes of the stream the responses are written into. """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.flushes = 0
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def flush(self):
+        self.flushes += 1
+
+
+def test_replies_are_coalesced():
+    data = user_control(types.UC_PING_REQUEST, struct.pack('>I', 1)) * 10 + \
+        full_header(4, 3, types.DT_AUDIO_MESSAGE, 1) + '\xafxy'
+    net_connection, response_stream = create_net_connection(data)
+    flush_counter = FlushCounter(response_stream)
+    net_connection.rtmp_writer._rtmp_stream = flush_counter
+
+    net_connection.read_packet()
+
+    # The ten ping responses are sent in a single flush.
+    assert len(read_responses(response_stream)) == 10
+    assert flush_counter.flushes == 1
+
+
+def test_aggregate_messages_are_returned_one_by_one():
+    tags = ''
+    for timestamp, body in ((0, '\x17a'), (40, '\x27b')):
+        tags += struct.pack('>B', types.DT_VIDEO_MESSAGE) + struct.pack('>I', len(body))[1:] + \
+            struct.pack('>I', timestamp) + '\x00\x00\x00' + body + struct.pack('>I', 11 + len(body))
+    data = full_header(5, len(tags), types.DT_AGGREGATE_MESSAGE, 1) + tags + \
+        full_header(4, 1, types.DT_AUDIO_MESSAGE, 1) + '\xaf'
+    net_connection, _ = create_net_connection(data)
+
+    data_types = [net_connection.read_packet().header.data_type for _ in range(3)]
+    assert data_types == [types.DT_VIDEO_MESSAGE, types.DT_VIDEO_MESSAGE, types.DT_AUDIO_MESSAGE]
+
+
+def test_dispatch_does_not_decode_the_body():
+    command = amf_codec.PyAmfCodec().encode([u'onStatus', 0, None, {'code': u'NetStream.Play.Start'}])
+    shared_object = amf_codec.encode_name('chat') + '\x00' * 12
+    data = full_header(3, len(command), types.DT_COMMAND, 0) + command + \
+        full_header(3, len(shared_object), types.DT_SHARED_OBJECT, 0) + shared_object
+    net_connection, _ = create_net_connection(data)
+    net_connection.call('getInfo')
+
+    # Neither message is for the call waiting for a reply or a shared object we are using.
+    received_packets = [net_connection.read_packet() for _ in range(2)]
+    assert [received_packet.is_body_decoded() for received_packet in received_packets] == [False, False]
+    assert received_packets[0].get_response() == [{'code': u'NetStream.Play.Start'}]
@@ -0,0 +1,48 @@
+""" Test that the messages sent in a single write are the same on the wire as the messages sent chunk by chunk. """
+
+import pyamf.util
+
+import qrtmp.formats.rtmp_header as rtmp_header
+import qrtmp.formats.types as types
+import qrtmp.io.rtmp_writer as rtmp_writer
+
+# The bodies are larger than the chunk size, the second message is sent with compressed headers.
+MESSAGES = [(0, 'a' * 1000), (40, 'b' * 300)]
+
+
+class SendmsgSocket(object):
+    """ A socket with sendmsg (Python 3.3+), which sends at most 100 bytes at a time. """
+
+    def __init__(self):
+        self.sent = []
+
+    def sendmsg(self, buffers):
+        data = ''.join(buffer_data if type(buffer_data) is str else buffer_data.tobytes() for buffer_data in buffers)
+        self.sent.append(data[:100])
+        return len(self.sent[-1])
+
+
+def send_messages(scatter_gather, socket_object=None):
+    rtmp_stream = pyamf.util.BufferedByteStream()
+    writer = rtmp_writer.RtmpWriter(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream), socket_object)
+    writer.scatter_gather = scatter_gather
+
+    for timestamp, data in MESSAGES:
+        packet = writer.new_packet()
+        packet.set_type(types.DT_VIDEO_MESSAGE)
+        packet.set_timestamp(timestamp)
+        packet.body = {'control': 0x27, 'video_data': data}
+        writer.send_packet(packet)
+
+    return rtmp_stream.getvalue()
+
+
+def test_single_write_matches_chunk_writes():
+    assert send_messages(True) == send_messages(False)
+
+
+def test_sendmsg_matches_chunk_writes():
+    sendmsg_socket = SendmsgSocket()
+
+    assert send_messages(True, sendmsg_socket) == ''
+    assert ''.join(sendmsg_socket.sent) == send_messages(False)
@@ -0,0 +1,117 @@
+""" Test that the shared object changes are applied in one pass and only the changed attributes are sent back. """
+
+import pyamf.util
+
+import qrtmp.formats.rtmp_header as rtmp_header
+import qrtmp.formats.types as types
+import qrtmp.io.rtmp_reader as rtmp_reader
+import qrtmp.io.rtmp_writer as rtmp_writer
+
+
+class SharedObject(rtmp_writer.FlashSharedObject):
+
+    def __init__(self, name):
+        rtmp_writer.FlashSharedObject.__init__(self, name)
+        self.synced = []
+
+    def on_sync(self, changes):
+        self.synced.append(changes)
+
+
+def create_writer():
+    rtmp_stream = pyamf.util.BufferedByteStream()
+    return rtmp_writer.RtmpWriter(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream)), rtmp_stream
+
+
+def read_packets(rtmp_stream):
+    rtmp_stream.seek(0)
+    reader = rtmp_reader.RtmpReader(rtmp_stream, rtmp_header.RtmpHeaderHandler(rtmp_stream))
+
+    packets = []
+    while not rtmp_stream.at_eof():
+        decoded_header, decoded_body = reader.decode_rtmp_stream()
+        packets.append(reader.generate_packet(decoded_header, decoded_body))
+    return packets
+
+
+def server_message(name, version, events):
+    # Encoded with the writer, as the server would send it.
+    writer, rtmp_stream = create_writer()
+    packet = writer.new_packet()
+    packet.set_type(types.DT_SHARED_OBJECT)
+    packet.set_stream_id(0)
+    packet.body = {'obj_name': name, 'curr_version': version, 'flags': '\x00' * 8, 'events': events}
+    writer.send_packet(packet)
+    return read_packets(rtmp_stream)[0]
+
+
+def test_changes_are_coalesced_per_message():
+    shared_object = SharedObject('chat')
+    message = server_message('chat', 3, [
+        {'type': types.SO_USE_SUCCESS, 'data': ''},
+        {'type': types.SO_CLEAR, 'data': ''},
+        {'type': types.SO_CHANGE, 'data': {'topic': u'hello', 'users': 2}},
+        {'type': types.SO_CHANGE, 'data': {'users': 3, 'muted': False}},
+        {'type': types.SO_REMOVE, 'data': 'muted'}
+    ])
+
+    assert shared_object.handle_message(message)
+    assert not SharedObject('other').handle_message(message)
+
+    assert shared_object.use_success and shared_object.version == 3
+    assert shared_object.data == {'topic': u'hello', 'users': 3}
+    assert shared_object.synced == [{'changed': {'topic': u'hello', 'users': 3}, 'deleted': ['muted'],
+                                     'cleared': True}]
+
+
+def test_only_changed_attributes_are_sent():
+    shared_object = SharedObject('chat')
+    shared_object.handle_message(server_message('chat', 5, [{'type': types.SO_CHANGE,
+                                                             'data': {'topic': u'hello', 'users': 3}}]))
+
+    writer, rtmp_stream = create_writer()
+    shared_object.set('topic', u'hello')
+    assert not shared_object.send_changes(writer)
+
+    shared_object.set('users', 4)
+    shared_object.set('users', 5)
+    shared_object.remove('topic')
+    assert shared_object.send_changes(writer)
+
+    packet = read_packets(rtmp_stream)[0]
+    assert packet.body['curr_version'] == 5
+    assert packet.body['events'] == [{'type': types.SO_REQUEST_CHANGE, 'data': {'users': 5}},
+                                     {'type': types.SO_REQUEST_REMOVE, 'data': 'topic'}]
+
+
+def test_server_removal_replaces_unsent_change():
+    shared_object = SharedObject('chat')
+    shared_object.handle_message(server_message('chat', 1, [{'type': types.SO_CHANGE, 'data': {'topic': u'hello'}}]))
+
+    # The server removes the attribute before our change to it is sent, so it is not brought back.
+    shared_object.set('topic', u'bye')
+    shared_object.handle_message(server_message('chat', 2, [{'type': types.SO_REMOVE, 'data': 'topic'}]))
+
+    writer, _ = create_writer()
+    assert not shared_object.has_changes()
+    assert not shared_object.send_changes(writer)
+    assert 'topic' not in shared_object.data
+
+
+def test_deprecated_listeners_are_called():
+    class ListenerSharedObject(rtmp_writer.FlashSharedObject):
+
+        def __init__(self, name):
+            rtmp_writer.FlashSharedObject.__init__(self, name)
+            self.events = []
+
+        def on_change(self, key):
+            self.events.append(('change', key))
+
+        def on_delete(self, key):
+            self.events.append(('delete', key))
+
+    shared_object = ListenerSharedObject('chat')
+    shared_object.handle_message(server_message('chat', 1, [{'type': types.SO_CHANGE, 'data': {'topic': u'hello'}},
+                                                            {'type': types.SO_REMOVE, 'data': 'users'}]))
+    assert shared_object.events == [('change', 'topic'), ('delete', 'users')]
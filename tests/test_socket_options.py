@@ -0,0 +1,40 @@
+""" Test setting the socket options the connection is made with. """
+
+import socket
+
+import pytest
+
+import qrtmp.base.socket_options as socket_options
+from qrtmp.base.net_connection import NetConnection
+
+
+def test_options_are_set_on_the_socket():
+    options = socket_options.SocketOptions.low_latency()
+    options.receive_buffer_size = 256 * 1024
+
+    socket_object = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        options.apply(socket_object)
+
+        assert socket_object.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) != 0
+        assert socket_object.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE) != 0
+        # The kernel may double the buffer size given.
+        assert socket_object.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 256 * 1024
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            assert socket_object.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 30
+    finally:
+        socket_object.close()
+
+
+def test_set_socket_options():
+    net_connection = NetConnection()
+    assert net_connection.socket_options.tcp_nodelay is True
+
+    net_connection.set_socket_options(socket_options.PRESET_HIGH_THROUGHPUT, read_timeout=30)
+    assert net_connection.socket_options.send_buffer_size == 4 * 1024 * 1024
+    assert net_connection.socket_options.read_timeout == 30
+
+    with pytest.raises(TypeError):
+        net_connection.set_socket_options(nodelay=False)
+    with pytest.raises(ValueError):
+        net_connection.set_socket_options('fastest')
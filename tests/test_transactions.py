@@ -0,0 +1,58 @@
+""" Test matching the replies from the server to the remote procedure calls waiting for them. """
+
+import qrtmp.formats.rtmp_header as rtmp_header
+import qrtmp.formats.rtmp_packet as rtmp_packet
+import qrtmp.formats.types as types
+import qrtmp.io.net_connection.transactions as transactions
+
+
+def create_reply(command_name, transaction_id, response):
+    reply = rtmp_packet.RtmpPacket(rtmp_header.RtmpHeader(3, 0, 0, types.DT_COMMAND, 0))
+    reply.body = {
+        'command_name': command_name,
+        'transaction_id': float(transaction_id),
+        'command_object': None,
+        'response': [response]
+    }
+    reply.body_is_amf = True
+    return reply
+
+
+def test_replies_are_matched_out_of_order():
+    table = transactions.TransactionTable()
+    replies = []
+
+    create_stream = transactions.Transaction(2, 'createStream')
+    custom_call = transactions.Transaction(3, 'customCall')
+    custom_call.add_done_callback(lambda transaction: replies.append(transaction.result().get_response()))
+    table.add(create_stream)
+    table.add(custom_call)
+
+    assert table.resolve(create_reply('_result', 3, 'custom')) is True
+    assert replies == [['custom']]
+    assert not create_stream.done()
+
+    assert table.resolve(create_reply('_error', 2, {'code': 'NetConnection.Call.Failed'})) is True
+    assert isinstance(create_stream.exception(), transactions.TransactionError)
+
+    # Replies to calls which are not waiting (e.g. the connect call) are left for the client.
+    assert table.resolve(create_reply('_result', 1, None)) is False
+    assert table.resolve(create_reply('onStatus', 0, None)) is False
+    assert len(table) == 0
+
+
+def test_timeouts():
+    table = transactions.TransactionTable()
+
+    first_call = transactions.Transaction(2, 'first', deadline=10.0)
+    second_call = transactions.Transaction(3, 'second', deadline=20.0)
+    table.add(first_call)
+    table.add(second_call)
+
+    assert table.expire(now=15.0) == [first_call]
+    assert isinstance(first_call.exception(), transactions.TransactionTimeout)
+    assert table.next_deadline() == 20.0
+
+    assert table.resolve(create_reply('_result', 3, None)) is True
+    assert table.next_deadline() is None
+    assert table.expire(now=25.0) == []